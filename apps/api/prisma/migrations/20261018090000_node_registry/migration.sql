@@ -0,0 +1,6 @@
+-- AlterTable
+ALTER TABLE "Node" ADD COLUMN     "capacity" INTEGER,
+ADD COLUMN     "draining" BOOLEAN NOT NULL DEFAULT false,
+ADD COLUMN     "enabled" BOOLEAN NOT NULL DEFAULT true,
+ADD COLUMN     "poolEnd" TEXT,
+ADD COLUMN     "poolStart" TEXT;
@@ -0,0 +1,35 @@
+-- CreateEnum
+CREATE TYPE "ProvisionJobStatus" AS ENUM ('QUEUED', 'RUNNING', 'DONE', 'FAILED');
+
+-- CreateTable
+CREATE TABLE "ProvisionJob" (
+    "id" TEXT NOT NULL,
+    "status" "ProvisionJobStatus" NOT NULL DEFAULT 'QUEUED',
+    "peerId" TEXT NOT NULL,
+    "nodeId" TEXT NOT NULL,
+    "deviceId" TEXT NOT NULL,
+    "connectToken" TEXT,
+    "attempts" INTEGER NOT NULL DEFAULT 0,
+    "maxAttempts" INTEGER NOT NULL DEFAULT 5,
+    "lastError" TEXT,
+    "runAfter" TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    "lockedAt" TIMESTAMP(3),
+    "lockedBy" TEXT,
+    "finishedAt" TIMESTAMP(3),
+    "createdAt" TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    "updatedAt" TIMESTAMP(3) NOT NULL,
+
+    CONSTRAINT "ProvisionJob_pkey" PRIMARY KEY ("id")
+);
+
+-- CreateIndex
+CREATE INDEX "ProvisionJob_status_runAfter_idx" ON "ProvisionJob"("status", "runAfter");
+
+-- CreateIndex
+CREATE INDEX "ProvisionJob_deviceId_status_idx" ON "ProvisionJob"("deviceId", "status");
+
+-- CreateIndex
+CREATE INDEX "ProvisionJob_connectToken_idx" ON "ProvisionJob"("connectToken");
+
+-- CreateIndex
+CREATE INDEX "ProvisionJob_peerId_idx" ON "ProvisionJob"("peerId");
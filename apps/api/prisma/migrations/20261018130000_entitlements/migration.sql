@@ -0,0 +1,22 @@
+-- CreateTable
+CREATE TABLE "Entitlement" (
+    "userId" TEXT NOT NULL,
+    "activeDevices" INTEGER NOT NULL DEFAULT 0,
+    "deviceLimit" INTEGER NOT NULL DEFAULT 0,
+    "status" TEXT,
+    "activeUntil" TIMESTAMP(3),
+    "updatedAt" TIMESTAMP(3) NOT NULL,
+
+    CONSTRAINT "Entitlement_pkey" PRIMARY KEY ("userId")
+);
+
+-- Backfill from subscriptions and active peers
+INSERT INTO "Entitlement" ("userId", "activeDevices", "deviceLimit", "status", "activeUntil", "updatedAt")
+SELECT u."id",
+       (SELECT COUNT(*) FROM "Peer" p WHERE p."userId" = u."id" AND p."revokedAt" IS NULL),
+       COALESCE(s."deviceLimit", 0),
+       s."status",
+       s."activeUntil",
+       CURRENT_TIMESTAMP
+FROM "User" u
+LEFT JOIN "Subscription" s ON s."userId" = u."id";
@@ -0,0 +1,12 @@
+-- CreateTable
+CREATE TABLE "BotConversationState" (
+    "key" TEXT NOT NULL,
+    "value" TEXT NOT NULL,
+    "expiresAt" TIMESTAMP(3) NOT NULL,
+    "updatedAt" TIMESTAMP(3) NOT NULL,
+
+    CONSTRAINT "BotConversationState_pkey" PRIMARY KEY ("key")
+);
+
+-- CreateIndex
+CREATE INDEX "BotConversationState_expiresAt_idx" ON "BotConversationState"("expiresAt");
@@ -0,0 +1,27 @@
+-- CreateEnum
+CREATE TYPE "PaymentCallbackStatus" AS ENUM ('QUEUED', 'DONE', 'FAILED');
+
+-- CreateTable
+CREATE TABLE "PaymentCallback" (
+    "id" TEXT NOT NULL,
+    "provider" "PaymentProvider" NOT NULL,
+    "invId" BIGINT NOT NULL,
+    "outSumRaw" TEXT NOT NULL,
+    "payload" JSONB NOT NULL,
+    "status" "PaymentCallbackStatus" NOT NULL DEFAULT 'QUEUED',
+    "result" TEXT,
+    "attempts" INTEGER NOT NULL DEFAULT 0,
+    "lastError" TEXT,
+    "runAfter" TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    "processedAt" TIMESTAMP(3),
+    "createdAt" TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    "updatedAt" TIMESTAMP(3) NOT NULL,
+
+    CONSTRAINT "PaymentCallback_pkey" PRIMARY KEY ("id")
+);
+
+-- CreateIndex
+CREATE UNIQUE INDEX "PaymentCallback_provider_invId_key" ON "PaymentCallback"("provider", "invId");
+
+-- CreateIndex
+CREATE INDEX "PaymentCallback_status_runAfter_idx" ON "PaymentCallback"("status", "runAfter");
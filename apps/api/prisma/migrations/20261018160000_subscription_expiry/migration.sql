@@ -0,0 +1,2 @@
+-- CreateIndex
+CREATE INDEX "Subscription_status_activeUntil_idx" ON "Subscription"("status", "activeUntil");
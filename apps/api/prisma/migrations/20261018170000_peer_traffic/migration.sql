@@ -0,0 +1,45 @@
+-- CreateEnum
+CREATE TYPE "TrafficResolution" AS ENUM ('MINUTE', 'HOUR', 'DAY');
+
+-- CreateTable
+CREATE TABLE "PeerTraffic" (
+    "peerId" TEXT NOT NULL,
+    "resolution" "TrafficResolution" NOT NULL,
+    "bucket" TIMESTAMP(3) NOT NULL,
+    "userId" TEXT NOT NULL,
+    "deviceId" TEXT NOT NULL,
+    "nodeId" TEXT NOT NULL,
+    "rxBytes" BIGINT NOT NULL,
+    "txBytes" BIGINT NOT NULL,
+
+    CONSTRAINT "PeerTraffic_pkey" PRIMARY KEY ("peerId","resolution","bucket")
+);
+
+-- CreateTable
+CREATE TABLE "PeerTrafficCursor" (
+    "nodeId" TEXT NOT NULL,
+    "publicKey" TEXT NOT NULL,
+    "rxBytes" BIGINT NOT NULL,
+    "txBytes" BIGINT NOT NULL,
+    "sampledAt" TIMESTAMP(3) NOT NULL,
+
+    CONSTRAINT "PeerTrafficCursor_pkey" PRIMARY KEY ("nodeId","publicKey")
+);
+
+-- CreateTable
+CREATE TABLE "TrafficRollup" (
+    "resolution" "TrafficResolution" NOT NULL,
+    "through" TIMESTAMP(3) NOT NULL,
+    "updatedAt" TIMESTAMP(3) NOT NULL,
+
+    CONSTRAINT "TrafficRollup_pkey" PRIMARY KEY ("resolution")
+);
+
+-- CreateIndex
+CREATE INDEX "PeerTraffic_userId_resolution_bucket_idx" ON "PeerTraffic"("userId", "resolution", "bucket");
+
+-- CreateIndex
+CREATE INDEX "PeerTraffic_nodeId_resolution_bucket_idx" ON "PeerTraffic"("nodeId", "resolution", "bucket");
+
+-- CreateIndex
+CREATE INDEX "PeerTraffic_resolution_bucket_idx" ON "PeerTraffic"("resolution", "bucket");
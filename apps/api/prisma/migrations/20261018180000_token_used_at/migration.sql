@@ -0,0 +1,5 @@
+-- CreateIndex
+CREATE INDEX "MagicToken_usedAt_idx" ON "MagicToken"("usedAt");
+
+-- CreateIndex
+CREATE INDEX "ConnectToken_usedAt_idx" ON "ConnectToken"("usedAt");
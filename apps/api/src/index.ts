@@ -11,7 +11,27 @@ import { registerAuthRoutes } from "./routes/auth";
 import { registerVpnRoutes } from "./routes/vpn";
 import { registerDeviceRoutes } from "./routes/devices";
 import { registerConnectRoutes } from "./routes/connect";
+import { registerNodeRoutes } from "./routes/nodes";
+import { registerDebugRoutes } from "./routes/debug";
+import { registerJobRoutes } from "./routes/jobs";
+import { registerMetricsRoutes } from "./routes/metrics";
+import { registerBotStateRoutes } from "./routes/bot-state";
+import { registerUsageRoutes } from "./routes/usage";
 import { env } from "./env";
+import { closeSshPools } from "./lib/ssh-pool";
+import { coolNodeCache, warmNodeCache } from "./lib/node-cache";
+import { startWgStatsPoller, stopWgStatsPoller } from "./lib/wg-stats";
+import { ensureNode } from "./lib/device-flow";
+import { startKeypairPool } from "./lib/keypair-pool";
+import { startProvisionWorker, stopProvisionWorker } from "./lib/provision-queue";
+import { startTokenSweeper, stopTokenSweeper } from "./lib/token-sweeper";
+import { startBotStateSweeper, stopBotStateSweeper } from "./lib/bot-state";
+import { startPaymentInbox, stopPaymentInbox } from "./lib/payment-inbox";
+import { startSubscriptionExpiry, stopSubscriptionExpiry } from "./lib/subscription-expiry";
+import { startTrafficRollup, stopTrafficRollup } from "./lib/traffic";
+import { prisma } from "./lib/prisma";
+import { instrumentHttp } from "./lib/metrics";
+import { instrumentRequests, setQueryLogger } from "./lib/query-stats";
 
 import { plansRoutes } from "./routes/plans";
 import { subscriptionsRoutes } from "./routes/subscriptions";
@@ -20,8 +40,22 @@ import { paymentsRobokassaRoutes } from "./routes/payments.robokassa";
 async function main() {
   const app = Fastify({ logger: true });
 
+  instrumentRequests(app);
+  instrumentHttp(app);
+  setQueryLogger(app.log);
+
   await app.register(prismaPlugin);
 
+  // нода из env всегда есть в реестре (single-node setup), остальные добавляются tools/wg-nodes.ts.
+  // Ошибка здесь не мешает старту: auth, платежи и бот работают, провижн отвечает ошибкой ноды.
+  try {
+    await warmNodeCache(prisma);
+    await ensureNode(prisma);
+  } catch (err) {
+    app.log.error({ err }, "env node registration failed; provisioning may be unavailable");
+    coolNodeCache();
+  }
+
   // --- global error handler ---
   // Zod validation errors must return 400 (not 500)
   app.setErrorHandler((err: any, req: any, reply: any) => {
@@ -58,11 +92,29 @@ async function main() {
   await app.register(authPlugin);
 
   app.get("/health", async () => ({ ok: true }));
+  await registerMetricsRoutes(app);
+
+  // закрываем мастер-соединения к нодам, иначе они живут до ControlPersist
+  app.addHook("onClose", async () => {
+    stopWgStatsPoller();
+    stopTokenSweeper();
+    stopBotStateSweeper();
+    stopPaymentInbox();
+    stopSubscriptionExpiry();
+    stopTrafficRollup();
+    await stopProvisionWorker();
+    await closeSshPools();
+  });
 
   await registerAuthRoutes(app);
   await registerVpnRoutes(app);
   await registerDeviceRoutes(app);
   await registerConnectRoutes(app);
+  await registerNodeRoutes(app);
+  await registerJobRoutes(app);
+  await registerBotStateRoutes(app);
+  await registerUsageRoutes(app);
+  if (process.env.API_DEBUG_STATS === "1") await registerDebugRoutes(app);
 
   await app.register(plansRoutes);
   await app.register(subscriptionsRoutes);
@@ -71,6 +123,15 @@ async function main() {
   const port = Number(env.PORT || 3001);
   const host = "0.0.0.0";
   await app.listen({ port, host });
+
+  startWgStatsPoller(prisma, app.log);
+  startProvisionWorker(prisma, app.log);
+  startKeypairPool();
+  startTokenSweeper(prisma, app.log);
+  startBotStateSweeper(prisma, app.log);
+  startPaymentInbox(prisma, app.log);
+  startSubscriptionExpiry(prisma, app.log);
+  startTrafficRollup(prisma, app.log);
 }
 
 main().catch((e) => {
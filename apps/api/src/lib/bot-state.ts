@@ -0,0 +1,75 @@
+import type { PrismaClient } from "@prisma/client";
+
+// Deletes expired bot conversation state (routes/bot-state.ts) as soon as it
+// expires: the rows only steer the support flow, nothing to audit. Same batching
+// as the token sweeper: DELETE ... WHERE key IN (SELECT ... LIMIT n FOR UPDATE
+// SKIP LOCKED) on the expiresAt index, so replicas sweep side by side.
+
+function numEnv(name: string, fallback: number): number {
+  const n = Number(process.env[name]);
+  return Number.isFinite(n) && n >= 0 ? n : fallback;
+}
+
+// 0 disables the sweeper
+const INTERVAL_MS = () => numEnv("BOT_STATE_SWEEP_INTERVAL_MS", 10 * 60_000);
+const BATCH = () => Math.max(1, numEnv("BOT_STATE_SWEEP_BATCH", 1_000));
+// per run; the rest waits for the next tick
+const MAX_BATCHES = 50;
+
+let timer: NodeJS.Timeout | null = null;
+let running = false;
+
+const stats = { runs: 0, deleted: 0, errors: 0, lastRunAt: null as string | null };
+
+export async function sweepExpiredBotState(prisma: PrismaClient) {
+  let total = 0;
+  for (let i = 0; i < MAX_BATCHES; i++) {
+    const n = await prisma.$executeRaw`
+      DELETE FROM "BotConversationState"
+      WHERE "key" IN (
+        SELECT "key" FROM "BotConversationState"
+        WHERE "expiresAt" < now()
+        LIMIT ${BATCH()}
+        FOR UPDATE SKIP LOCKED
+      )`;
+    total += n;
+    if (n < BATCH()) break;
+  }
+  stats.runs++;
+  stats.deleted += total;
+  stats.lastRunAt = new Date().toISOString();
+  return total;
+}
+
+export function startBotStateSweeper(prisma: PrismaClient, logger?: any) {
+  const interval = INTERVAL_MS();
+  if (timer || interval === 0) return;
+
+  const tick = () => {
+    if (running) return;
+    running = true;
+    sweepExpiredBotState(prisma)
+      .then((deleted) => {
+        if (deleted > 0) logger?.info?.({ deleted }, "expired bot state swept");
+      })
+      .catch((err) => {
+        stats.errors++;
+        logger?.warn?.({ err }, "bot state sweep failed");
+      })
+      .finally(() => {
+        running = false;
+      });
+  };
+  timer = setInterval(tick, interval);
+  timer.unref();
+}
+
+export function stopBotStateSweeper() {
+  if (!timer) return;
+  clearInterval(timer);
+  timer = null;
+}
+
+export function botStateSweeperStats() {
+  return { ...stats };
+}
@@ -0,0 +1,103 @@
+import { createHash } from "node:crypto";
+
+// Rendered WireGuard client configs, cached per (peer, node config version).
+//
+// The key carries everything the text depends on: peer id + public key (a reused
+// row gets a new key, and with it a new private key), the peer address and a
+// version derived from the node's endpoint/server key. When any of them change
+// the old entry is simply never hit again and ages out of the LRU; revoke and
+// slot reuse also drop a peer's entries explicitly. The ETag is the key's hash,
+// so a conditional GET is answered without rendering anything.
+
+const MAX_ENTRIES = () => {
+  const n = Number(process.env.CONFIG_CACHE_MAX);
+  return Number.isFinite(n) && n > 0 ? n : 20_000;
+};
+
+type ConfigNode = { id: string; endpointHost: string; wgPort: number; serverPublicKey: string };
+type ConfigPeer = { id: string; publicKey: string; allowedIp: string };
+type Rendered = { body: string; etag: string };
+
+const rendered = new Map<string, Rendered>();
+const keysByPeer = new Map<string, Set<string>>();
+const nodeVersions = new WeakMap<ConfigNode, string>(); // node-cache hands out the same object until reload
+
+const stats = { hits: 0, misses: 0, evictions: 0, invalidations: 0 };
+
+function sha1(text: string) {
+  return createHash("sha1").update(text).digest("hex");
+}
+
+export function nodeConfigVersion(node: ConfigNode, dns: string) {
+  let v = nodeVersions.get(node);
+  if (!v) {
+    v = sha1(`${node.serverPublicKey}|${node.endpointHost}|${node.wgPort}`).slice(0, 12);
+    nodeVersions.set(node, v);
+  }
+  return `${v}.${dns}`;
+}
+
+// variant: what else shapes the text (template vs full config with a private key)
+export function peerConfigKey(peer: ConfigPeer, node: ConfigNode, dns: string, variant: string) {
+  return `${peer.id}|${peer.publicKey}|${peer.allowedIp}|${node.id}|${nodeConfigVersion(node, dns)}|${variant}`;
+}
+
+export function configEtag(key: string) {
+  return `"${sha1(key).slice(0, 20)}"`;
+}
+
+function peerIdOf(key: string) {
+  return key.slice(0, key.indexOf("|"));
+}
+
+export function getRenderedConfig(key: string, render: () => string): Rendered {
+  const hit = rendered.get(key);
+  if (hit) {
+    stats.hits++;
+    rendered.delete(key);
+    rendered.set(key, hit);
+    return hit;
+  }
+
+  stats.misses++;
+  const value = { body: render(), etag: configEtag(key) };
+  rendered.set(key, value);
+
+  const peerId = peerIdOf(key);
+  let keys = keysByPeer.get(peerId);
+  if (!keys) keysByPeer.set(peerId, (keys = new Set()));
+  keys.add(key);
+
+  while (rendered.size > MAX_ENTRIES()) {
+    const oldest = rendered.keys().next().value as string;
+    rendered.delete(oldest);
+    const peerKeys = keysByPeer.get(peerIdOf(oldest));
+    peerKeys?.delete(oldest);
+    if (peerKeys?.size === 0) keysByPeer.delete(peerIdOf(oldest));
+    stats.evictions++;
+  }
+  return value;
+}
+
+// revoke / slot reuse
+export function invalidatePeerConfigs(peerId: string) {
+  const keys = keysByPeer.get(peerId);
+  if (!keys) return;
+  for (const k of keys) rendered.delete(k);
+  keysByPeer.delete(peerId);
+  stats.invalidations++;
+}
+
+// If-None-Match may list several tags or be "*"
+export function etagMatches(ifNoneMatch: string | string[] | undefined, etag: string) {
+  if (!ifNoneMatch) return false;
+  const raw = Array.isArray(ifNoneMatch) ? ifNoneMatch.join(",") : ifNoneMatch;
+  return raw
+    .split(",")
+    .map((t) => t.trim().replace(/^W\//, ""))
+    .some((t) => t === etag || t === "*");
+}
+
+export function configCacheStats() {
+  return { ...stats, size: rendered.size, peers: keysByPeer.size };
+}
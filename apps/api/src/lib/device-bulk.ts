@@ -0,0 +1,440 @@
+import type { Node, PrismaClient } from "@prisma/client";
+import { randomUUID } from "node:crypto";
+import {
+  DeviceFlowError,
+  ensureUser,
+  isPeerReserved,
+  nodeOf,
+  provisionResult,
+  reservePeerSlot,
+} from "./device-flow";
+import { adjustActiveDevices } from "./entitlements";
+import { allocateAllowedIps, releaseAllowedIp } from "./ipAllocator";
+import { takeWgKeypair } from "./keypair-pool";
+import { NodeUnavailableError } from "./node-breaker";
+import { NodePlacementError, nodeLoad, nodePoolRange, pickNodeForNewPeer } from "./node-registry";
+import { wgAddPeerBatched } from "./wg-batch";
+
+// Bulk onboarding (POST /v1/devices/bulk): the same outcome as POST /v1/devices +
+// POST /v1/devices/:id/provision for every device, with a fixed number of queries
+// per chunk instead of per device. Existing devices/peers are looked up with one
+// query each, addresses come from the node bitmaps in one pass per placement,
+// devices and peers are inserted with createMany, peers reach the node through
+// the batcher (one `wg set` per WG_BATCH_MAX_OPS) and are activated with a single
+// update. Peer rows that collide with old revoked rows (same address or key) are
+// skipped by the insert and go through the regular reservePeerSlot path.
+
+function numEnv(name: string, fallback: number): number {
+  const n = Number(process.env[name]);
+  return Number.isFinite(n) && n >= 0 ? n : fallback;
+}
+
+export const BULK_MAX_DEVICES = () => Math.max(1, numEnv("BULK_PROVISION_MAX", 1_000));
+// devices per chunk: results of a chunk are streamed before the next one starts
+const CHUNK = () => Math.max(1, numEnv("BULK_PROVISION_CHUNK", 250));
+// addresses taken per placement decision, so a large batch still spreads over nodes
+const PLACEMENT_CHUNK = 64;
+
+export type BulkDeviceInput = { platform: string; name: string; publicKey?: string };
+
+export type BulkDeviceLine = {
+  index: number;
+  statusCode: number;
+  error?: string;
+  id?: string;
+  deviceId?: string;
+  existing?: boolean;
+  jobId?: string | null;
+  peerId?: string;
+  allowedIp?: string;
+  nodeId?: string;
+  endpoint?: string;
+  serverPublicKey?: string;
+  clientConfig?: string;
+};
+
+type Item = BulkDeviceInput & {
+  index: number;
+  device?: { id: string; deviceId: string };
+  created?: boolean;
+};
+
+type Placed = {
+  item: Item;
+  node: Node;
+  allowedIp: string;
+  publicKey: string;
+  privateKey: string;
+  peer?: { id: string; publicKey: string; allowedIp: string; deviceId: string; nodeId: string };
+};
+
+const stats = { requests: 0, devices: 0, devicesCreated: 0, provisioned: 0, existing: 0, fallbacks: 0, failed: 0 };
+
+function deviceKey(d: { platform: string; name: string }) {
+  return `${d.platform}\u0000${d.name}`;
+}
+
+function failure(index: number, err: unknown): BulkDeviceLine {
+  stats.failed++;
+  if (err instanceof DeviceFlowError) return { index, statusCode: err.statusCode, error: err.code };
+  if (err instanceof NodeUnavailableError) return { index, statusCode: 503, error: err.code };
+  if ((err as any)?.code === "WG_POOL_EXHAUSTED") return { index, statusCode: 503, error: "WG_POOL_EXHAUSTED" };
+  throw err;
+}
+
+function success(
+  item: Item,
+  result: ReturnType<typeof provisionResult>
+): BulkDeviceLine {
+  return {
+    index: item.index,
+    statusCode: result.statusCode,
+    id: item.device!.id,
+    deviceId: item.device!.deviceId,
+    existing: result.existing,
+    jobId: result.jobId,
+    peerId: result.peerId,
+    allowedIp: result.allowedIp,
+    nodeId: result.nodeId,
+    endpoint: result.endpoint,
+    serverPublicKey: result.serverPublicKey,
+    clientConfig: result.clientConfig,
+  };
+}
+
+// devices are idempotent by (userId, platform, name), like POST /v1/devices
+async function resolveDevices(prisma: PrismaClient, userId: string, items: Item[]) {
+  const existing = await prisma.device.findMany({
+    where: { userId, name: { in: [...new Set(items.map((i) => i.name))] } },
+    orderBy: { createdAt: "desc" },
+    select: { id: true, deviceId: true, platform: true, name: true },
+  });
+
+  const byKey = new Map<string, { id: string; deviceId: string }>();
+  for (const d of existing) if (!byKey.has(deviceKey(d))) byKey.set(deviceKey(d), d);
+
+  const missing = items.filter((i) => !byKey.has(deviceKey(i)));
+  if (missing.length > 0) {
+    const created = await prisma.device.createManyAndReturn({
+      data: missing.map((i) => ({ deviceId: randomUUID(), userId, platform: i.platform, name: i.name })),
+      select: { id: true, deviceId: true, platform: true, name: true },
+    });
+    for (const d of created) byKey.set(deviceKey(d), d);
+    stats.devicesCreated += created.length;
+  }
+
+  const existingIds = new Set(existing.map((d) => d.id));
+  for (const item of items) {
+    item.device = byKey.get(deviceKey(item));
+    item.created = !existingIds.has(item.device!.id);
+  }
+}
+
+async function* provisionChunk(
+  prisma: PrismaClient,
+  userId: string,
+  items: Item[],
+  logger?: any
+): AsyncGenerator<BulkDeviceLine> {
+  await resolveDevices(prisma, userId, items);
+
+  // devices that already have an active peer or a queued provision: report it, like the single flow
+  const knownIds = items.filter((i) => !i.created).map((i) => i.device!.id);
+  const [activePeers, pendingJobs] =
+    knownIds.length > 0
+      ? await Promise.all([
+          prisma.peer.findMany({
+            where: { deviceId: { in: knownIds }, revokedAt: null },
+            orderBy: { createdAt: "desc" },
+          }),
+          prisma.provisionJob.findMany({
+            where: { deviceId: { in: knownIds }, status: { in: ["QUEUED", "RUNNING"] } },
+            select: { id: true, deviceId: true, peerId: true },
+          }),
+        ])
+      : [[], []];
+  const reserved =
+    pendingJobs.length > 0
+      ? await prisma.peer.findMany({ where: { id: { in: pendingJobs.map((j) => j.peerId) } } })
+      : [];
+
+  const activeByDevice = new Map<string, (typeof activePeers)[number]>();
+  for (const p of activePeers) if (!activeByDevice.has(p.deviceId)) activeByDevice.set(p.deviceId, p);
+  const jobByDevice = new Map(pendingJobs.map((j) => [j.deviceId, j]));
+  const reservedById = new Map(reserved.map((p) => [p.id, p]));
+
+  const todo: Item[] = [];
+  for (const item of items) {
+    const active = activeByDevice.get(item.device!.id);
+    const job = jobByDevice.get(item.device!.id);
+    const peer = active ?? (job ? reservedById.get(job.peerId) : undefined);
+    if (!peer) {
+      todo.push(item);
+      continue;
+    }
+    try {
+      const node = await nodeOf(prisma, peer.nodeId);
+      stats.existing++;
+      yield success(
+        item,
+        provisionResult({
+          statusCode: active ? 200 : 202,
+          existing: true,
+          peer,
+          node,
+          clientPrivateKey: item.publicKey ? null : peer.privateKey || null,
+          jobId: active ? null : job!.id,
+        })
+      );
+    } catch (err) {
+      yield failure(item.index, err);
+    }
+  }
+  if (todo.length === 0) return;
+
+  // placement + addresses
+  let placed: Placed[] = [];
+  let remaining: Item[] = todo;
+  while (remaining.length > 0) {
+    let node: Node;
+    let ips: string[];
+    try {
+      node = await pickNodeForNewPeer(prisma);
+      const load = await nodeLoad(prisma, node);
+      const want = Math.min(remaining.length, load.free, PLACEMENT_CHUNK);
+      ips = await allocateAllowedIps(prisma, { nodeId: node.id, ...nodePoolRange(node) }, want);
+      if (ips.length === 0) throw new DeviceFlowError(503, "NODE_CAPACITY_EXHAUSTED");
+    } catch (err) {
+      const mapped = err instanceof NodePlacementError ? new DeviceFlowError(503, err.code) : err;
+      for (const item of remaining) yield failure(item.index, mapped);
+      remaining = [];
+      break;
+    }
+
+    for (let k = 0; k < ips.length; k++) {
+      const item = remaining[k];
+      const keys = item.publicKey
+        ? { publicKey: item.publicKey, privateKey: "" }
+        : takeWgKeypair();
+      placed.push({ item, node, allowedIp: ips[k], publicKey: keys.publicKey, privateKey: keys.privateKey });
+    }
+    remaining = remaining.slice(ips.length);
+  }
+
+  // a client key can't be placed on a node where another device's row with it is reserved
+  // (same rule as reservePeerSlot; other rows with the key are reused by the fallback below)
+  const withKey = placed.filter((p) => p.item.publicKey);
+  if (withKey.length > 0) {
+    const keyRows = await prisma.peer.findMany({
+      where: { OR: withKey.map((p) => ({ nodeId: p.node.id, publicKey: p.publicKey })) },
+      select: { id: true, nodeId: true, deviceId: true, publicKey: true, revokedAt: true },
+    });
+    const taken = new Set<string>();
+    for (const row of keyRows) {
+      const ours = withKey.find((p) => p.node.id === row.nodeId && p.publicKey === row.publicKey);
+      if (ours && row.deviceId !== ours.item.device!.id && (await isPeerReserved(prisma, row))) {
+        taken.add(`${row.nodeId}|${row.publicKey}`);
+      }
+    }
+    if (taken.size > 0) {
+      const kept: Placed[] = [];
+      for (const p of placed) {
+        if (!taken.has(`${p.node.id}|${p.publicKey}`)) {
+          kept.push(p);
+          continue;
+        }
+        releaseAllowedIp(p.node.id, p.allowedIp);
+        yield failure(p.item.index, new DeviceFlowError(409, "PUBLIC_KEY_IN_USE"));
+      }
+      placed = kept;
+    }
+  }
+  if (placed.length === 0) return;
+
+  // reserve all rows (revokedAt = pending) with one insert
+  const pendingAt = new Date();
+  const inserted = await prisma.peer.createManyAndReturn({
+    data: placed.map((p) => ({
+      nodeId: p.node.id,
+      deviceId: p.item.device!.id,
+      userId,
+      publicKey: p.publicKey,
+      privateKey: p.privateKey,
+      allowedIp: p.allowedIp,
+      revokedAt: pendingAt,
+    })),
+    skipDuplicates: true,
+    select: { id: true, nodeId: true, deviceId: true, publicKey: true, allowedIp: true },
+  });
+  const insertedByAddress = new Map(inserted.map((p) => [`${p.nodeId}|${p.allowedIp}`, p]));
+  for (const p of placed) {
+    const row = insertedByAddress.get(`${p.node.id}|${p.allowedIp}`);
+    if (row && row.publicKey === p.publicKey) p.peer = row;
+  }
+  const collided = placed.filter((p) => !p.peer);
+
+  // an address held by an active row or a live provision job's row stays marked in the pool;
+  // addresses of plain revoked rows go back (same rule as isPeerReserved)
+  const held = new Set<string>();
+  if (collided.length > 0) {
+    const holders = await prisma.peer.findMany({
+      where: { OR: collided.map((p) => ({ nodeId: p.node.id, allowedIp: p.allowedIp })) },
+      select: { id: true, nodeId: true, allowedIp: true, revokedAt: true },
+    });
+    const revokedIds = holders.filter((h) => h.revokedAt !== null).map((h) => h.id);
+    const jobPeers = new Set(
+      revokedIds.length > 0
+        ? (
+            await prisma.provisionJob.findMany({
+              where: { peerId: { in: revokedIds }, status: { in: ["QUEUED", "RUNNING"] } },
+              select: { peerId: true },
+            })
+          ).map((j) => j.peerId)
+        : []
+    );
+    for (const h of holders) {
+      if (h.revokedAt === null || jobPeers.has(h.id)) held.add(`${h.nodeId}|${h.allowedIp}`);
+    }
+  }
+
+  let next = 0;
+  let reserved = false;
+  try {
+    for (; next < collided.length; next++) {
+      const p = collided[next];
+      // collided with an existing row: the regular path reuses or retries it
+      // (reservePeerSlot leaves rows of live provision jobs alone)
+      stats.fallbacks++;
+      if (!held.has(`${p.node.id}|${p.allowedIp}`)) releaseAllowedIp(p.node.id, p.allowedIp);
+      try {
+        const range = nodePoolRange(p.node);
+        p.peer = await reservePeerSlot(prisma, {
+          nodeId: p.node.id,
+          poolStart: range.start,
+          poolEnd: range.end,
+          deviceId: p.item.device!.id,
+          userId,
+          publicKey: p.publicKey,
+          privateKey: p.privateKey,
+        });
+      } catch (err) {
+        yield failure(p.item.index, err);
+      }
+    }
+    reserved = true;
+  } finally {
+    // unmapped error or the consumer went away: nothing of this chunk gets applied,
+    // so give back every reservation and the addresses not looked at yet
+    if (!reserved) {
+      const rows = placed.filter((p) => p.peer);
+      if (rows.length > 0) {
+        await prisma.peer.updateMany({
+          where: { id: { in: rows.map((p) => p.peer!.id) }, revokedAt: { not: null } },
+          data: { revokedAt: new Date() },
+        });
+        for (const p of rows) releaseAllowedIp(p.node.id, p.peer!.allowedIp);
+      }
+      for (const p of collided.slice(next + 1)) {
+        if (!held.has(`${p.node.id}|${p.allowedIp}`)) releaseAllowedIp(p.node.id, p.allowedIp);
+      }
+    }
+  }
+
+  // apply: the batcher coalesces these into a few `wg set` calls per node
+  const ready = placed.filter((p) => p.peer);
+  const errors = await Promise.all(
+    ready.map((p) =>
+      wgAddPeerBatched({
+        publicKey: p.peer!.publicKey,
+        allowedIp: p.peer!.allowedIp,
+        node: { sshHost: p.node.sshHost, sshUser: p.node.sshUser, wgInterface: p.node.wgInterface },
+      }).then(
+        () => null,
+        (err) => err
+      )
+    )
+  );
+  const ok = ready.filter((_, k) => !errors[k]);
+  const failed = ready.flatMap((p, k) => (errors[k] ? [{ p, err: errors[k] }] : []));
+
+  if (failed.length > 0) {
+    logger?.error?.({ err: failed[0].err, count: failed.length }, "bulk wgAddPeer failed");
+    await prisma.peer.updateMany({
+      where: { id: { in: failed.map(({ p }) => p.peer!.id) } },
+      data: { revokedAt: new Date() },
+    });
+    for (const { p, err } of failed) {
+      releaseAllowedIp(p.node.id, p.peer!.allowedIp);
+      // breaker open / node overloaded stays a retryable 503, like the single flow
+      yield failure(
+        p.item.index,
+        err instanceof NodeUnavailableError ? err : new DeviceFlowError(502, "WG_ADD_FAILED")
+      );
+    }
+  }
+
+  if (ok.length > 0) {
+    await prisma.$transaction(async (tx) => {
+      const activated = await tx.peer.updateMany({
+        where: { id: { in: ok.map((p) => p.peer!.id) }, revokedAt: { not: null } },
+        data: { revokedAt: null },
+      });
+      await adjustActiveDevices(tx, userId, activated.count);
+    });
+    stats.provisioned += ok.length;
+
+    for (const p of ok) {
+      yield success(
+        p.item,
+        provisionResult({
+          statusCode: 201,
+          existing: false,
+          peer: p.peer!,
+          node: p.node,
+          clientPrivateKey: p.privateKey || null,
+        })
+      );
+    }
+  }
+}
+
+/**
+ * Creates (or finds) and provisions every device of the list for one user.
+ * Yields one line per input device, in completion order; `index` points back
+ * into the input. Per-device failures are lines with `error`, not exceptions.
+ */
+export async function* bulkProvisionDevices(
+  prisma: PrismaClient,
+  input: { userId: string; devices: BulkDeviceInput[]; logger?: any }
+): AsyncGenerator<BulkDeviceLine> {
+  stats.requests++;
+  stats.devices += input.devices.length;
+  await ensureUser(prisma, input.userId);
+
+  const items: Item[] = [];
+  const seenDevices = new Set<string>();
+  const seenKeys = new Set<string>();
+  for (let index = 0; index < input.devices.length; index++) {
+    const d = input.devices[index];
+    if (seenDevices.has(deviceKey(d))) {
+      yield failure(index, new DeviceFlowError(400, "duplicate_device"));
+      continue;
+    }
+    if (d.publicKey && seenKeys.has(d.publicKey)) {
+      yield failure(index, new DeviceFlowError(409, "PUBLIC_KEY_IN_USE"));
+      continue;
+    }
+    seenDevices.add(deviceKey(d));
+    if (d.publicKey) seenKeys.add(d.publicKey);
+    items.push({ ...d, index });
+  }
+
+  const size = CHUNK();
+  for (let i = 0; i < items.length; i += size) {
+    yield* provisionChunk(prisma, input.userId, items.slice(i, i + size), input.logger);
+  }
+}
+
+export function bulkProvisionStats() {
+  return { ...stats };
+}
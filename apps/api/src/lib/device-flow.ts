@@ -1,12 +1,22 @@
 import type { PrismaClient } from "@prisma/client";
 import { env } from "../env";
-import { allocateAllowedIp } from "./ipAllocator";
-import { generateWgKeypair } from "./wg-keys";
-import { wgAddPeer, wgRemovePeer } from "./wg-node";
+import { getRenderedConfig, invalidatePeerConfigs, peerConfigKey } from "./config-cache";
+import { adjustActiveDevices } from "./entitlements";
+import {
+  allocateAllowedIp,
+  invalidateIpPool,
+  markAllowedIpUsed,
+  releaseAllowedIp,
+} from "./ipAllocator";
+import { NodeUnavailableError } from "./node-breaker";
+import { peerSlotReserveDuration } from "./metrics";
+import { getCachedNode, setCachedNode } from "./node-cache";
+import { NodePlacementError, nodePoolRange, pickNodeForNewPeer } from "./node-registry";
+import { enqueueProvisionJob, findPendingProvisionJob, provisionAsyncByDefault } from "./provision-queue";
+import { takeWgKeypair } from "./keypair-pool";
+import { wgAddPeerBatched, wgRemovePeerBatched } from "./wg-batch";
 
 const DEFAULT_NODE_ID = "wg-node-1";
-const DEFAULT_POOL_START = "10.8.0.2";
-const DEFAULT_POOL_END = "10.8.0.254";
 const PERSISTENT_KEEPALIVE = 25;
 
 export class DeviceFlowError extends Error {
@@ -57,6 +67,62 @@ async function resolveDevice(prisma: PrismaClient, deviceIdentifier: string) {
   });
 }
 
+type DeviceWithActivePeer = {
+  device: { id: string; userId: string };
+  active: { id: string; deviceId: string; nodeId: string; publicKey: string; privateKey: string; allowedIp: string } | null;
+};
+
+// resolveDevice + the device's newest active peer in one round trip (LATERAL on Peer_deviceId_idx).
+// The external deviceId is not unique (same id under several users): the peer is looked up on
+// the one resolved device only; it may live on any node.
+async function resolveDeviceWithActivePeer(
+  prisma: PrismaClient,
+  deviceIdentifier: string
+): Promise<DeviceWithActivePeer | null> {
+  const rows = await prisma.$queryRaw<
+    {
+      deviceId: string;
+      userId: string;
+      peerId: string | null;
+      nodeId: string | null;
+      publicKey: string | null;
+      privateKey: string | null;
+      allowedIp: string | null;
+    }[]
+  >`
+    SELECT d."id" AS "deviceId", d."userId", p."id" AS "peerId", p."nodeId", p."publicKey",
+           p."privateKey", p."allowedIp"
+    FROM (
+      SELECT "id", "userId" FROM "Device"
+      WHERE "id" = ${deviceIdentifier} OR "deviceId" = ${deviceIdentifier}
+      ORDER BY "createdAt" DESC
+      LIMIT 1
+    ) d
+    LEFT JOIN LATERAL (
+      SELECT "id", "nodeId", "publicKey", "privateKey", "allowedIp" FROM "Peer"
+      WHERE "deviceId" = d."id" AND "revokedAt" IS NULL
+      ORDER BY "createdAt" DESC
+      LIMIT 1
+    ) p ON true
+  `;
+  const row = rows[0];
+  if (!row) return null;
+  return {
+    device: { id: row.deviceId, userId: row.userId },
+    active:
+      row.peerId === null
+        ? null
+        : {
+            id: row.peerId,
+            deviceId: row.deviceId,
+            nodeId: row.nodeId!,
+            publicKey: row.publicKey!,
+            privateKey: row.privateKey ?? "",
+            allowedIp: row.allowedIp!,
+          },
+  };
+}
+
 export async function ensureNode(prisma: PrismaClient) {
   const nodeId = process.env.WG_NODE_ID ?? DEFAULT_NODE_ID;
   const endpointHost =
@@ -65,22 +131,28 @@ export async function ensureNode(prisma: PrismaClient) {
     env.WG_NODE_SSH_HOST;
   const wgPort = Number(process.env.WG_PORT ?? process.env.WG_NODE_WG_PORT ?? "51820");
 
-  const existing = await prisma.node.findUnique({ where: { id: nodeId } as any });
-  if (existing) {
-    const updated = await prisma.node.update({
-      where: { id: nodeId } as any,
-      data: {
-        name: nodeId,
-        endpointHost,
-        wgPort,
-        sshHost: env.WG_NODE_SSH_HOST,
-        sshUser: env.WG_NODE_SSH_USER,
-        wgInterface: env.WG_INTERFACE,
-      } as any,
-    });
+  const desired = {
+    name: nodeId,
+    endpointHost,
+    wgPort,
+    sshHost: env.WG_NODE_SSH_HOST,
+    sshUser: env.WG_NODE_SSH_USER,
+    wgInterface: env.WG_INTERFACE,
+  };
 
-    if (!updated.serverPublicKey) throw new DeviceFlowError(500, "NODE_SERVER_PUBLIC_KEY_MISSING");
-    return updated;
+  const existing = await getCachedNode(prisma, nodeId);
+  if (existing) {
+    // write (and lock the row) only when env actually differs from the stored node
+    const changed = (Object.keys(desired) as Array<keyof typeof desired>).some(
+      (k) => existing[k] !== desired[k]
+    );
+    const node = changed
+      ? await prisma.node.update({ where: { id: nodeId } as any, data: desired as any })
+      : existing;
+    if (changed) setCachedNode(node);
+
+    if (!node.serverPublicKey) throw new DeviceFlowError(500, "NODE_SERVER_PUBLIC_KEY_MISSING");
+    return node;
   }
 
   const serverPublicKey = env.WG_SERVER_PUBLIC_KEY;
@@ -98,33 +170,60 @@ export async function ensureNode(prisma: PrismaClient) {
       serverPublicKey,
     } as any,
   });
+  setCachedNode(created);
 
   return created;
 }
 
-async function reservePeerSlot(
-  prisma: PrismaClient,
-  args: {
-    nodeId: string;
-    deviceId: string;
-    userId: string;
-    publicKey: string;
-    privateKey: string;
-  }
-) {
-  const poolStart = process.env.WG_POOL_START ?? DEFAULT_POOL_START;
-  const poolEnd = process.env.WG_POOL_END ?? DEFAULT_POOL_END;
+// allocator contention, exposed for load tests / metrics
+const peerSlotStats = { reservations: 0, retries: 0, failures: 0 };
+
+export function getPeerSlotStats() {
+  return { ...peerSlotStats };
+}
+
+type PeerSlotArgs = {
+  nodeId: string;
+  poolStart: string;
+  poolEnd: string;
+  deviceId: string;
+  userId: string;
+  publicKey: string;
+  privateKey: string;
+};
+
+// Rows that must not be taken over: active peers and peers of a queued/running provision job.
+// A synchronous provision's reservation is not covered; its activation is conditional on the
+// reservation it made, so a takeover fails that provision instead of activating a foreign row.
+export async function isPeerReserved(prisma: PrismaClient, peer: { id: string; revokedAt: Date | null }) {
+  if (peer.revokedAt === null) return true;
+  const job = await prisma.provisionJob.findFirst({
+    where: { peerId: peer.id, status: { in: ["QUEUED", "RUNNING"] } },
+    select: { id: true },
+  });
+  return job !== null;
+}
+
+function isRecordNotFound(err: any) {
+  return err?.code === "P2025";
+}
 
+export function reservePeerSlot(prisma: PrismaClient, args: PeerSlotArgs) {
+  return peerSlotReserveDuration.time({ node: args.nodeId }, () => reservePeerSlotWithRetries(prisma, args));
+}
+
+async function reservePeerSlotWithRetries(prisma: PrismaClient, args: PeerSlotArgs) {
   for (let attempt = 1; attempt <= 10; attempt++) {
+    if (attempt > 1) peerSlotStats.retries++;
     const allowedIp = await allocateAllowedIp(prisma, {
       nodeId: args.nodeId,
-      start: poolStart,
-      end: poolEnd,
+      start: args.poolStart,
+      end: args.poolEnd,
     });
     const pendingAt = new Date();
 
     try {
-      return await prisma.peer.create({
+      const created = await prisma.peer.create({
         data: {
           nodeId: args.nodeId,
           deviceId: args.deviceId,
@@ -135,18 +234,26 @@ async function reservePeerSlot(
           revokedAt: pendingAt,
         } as any,
       });
+      peerSlotStats.reservations++;
+      return created;
     } catch (err: any) {
       if (isUniqueConstraintFor(err, ["nodeId", "publicKey"])) {
+        // the key's row keeps its own address, ours goes back to the pool
+        releaseAllowedIp(args.nodeId, allowedIp);
+
         const existingOnKey = await prisma.peer.findFirst({
           where: { nodeId: args.nodeId, publicKey: args.publicKey } as any,
         });
 
         if (!existingOnKey) continue;
-        if (existingOnKey.revokedAt === null) throw new DeviceFlowError(409, "PUBLIC_KEY_IN_USE");
+        if (await isPeerReserved(prisma, existingOnKey)) throw new DeviceFlowError(409, "PUBLIC_KEY_IN_USE");
 
+        markAllowedIpUsed(args.nodeId, existingOnKey.allowedIp);
+        invalidatePeerConfigs(existingOnKey.id);
         try {
+          // conditional on the revokedAt we checked: a concurrent reuse of the row wins, we retry
           return await prisma.peer.update({
-            where: { id: existingOnKey.id } as any,
+            where: { id: existingOnKey.id, revokedAt: existingOnKey.revokedAt } as any,
             data: {
               deviceId: args.deviceId,
               userId: args.userId,
@@ -156,26 +263,38 @@ async function reservePeerSlot(
           });
         } catch (reuseByKeyErr: any) {
           if (
+            isRecordNotFound(reuseByKeyErr) ||
             isUniqueConstraintFor(reuseByKeyErr, ["nodeId", "allowedIp"]) ||
             isUniqueConstraintFor(reuseByKeyErr, ["nodeId", "publicKey"])
           ) {
             continue;
           }
+          releaseAllowedIp(args.nodeId, existingOnKey.allowedIp);
           throw reuseByKeyErr;
         }
       }
 
-      if (!isUniqueConstraintFor(err, ["nodeId", "allowedIp"])) throw err;
+      if (!isUniqueConstraintFor(err, ["nodeId", "allowedIp"])) {
+        releaseAllowedIp(args.nodeId, allowedIp);
+        throw err;
+      }
 
       const existingOnIp = await prisma.peer.findFirst({
         where: { nodeId: args.nodeId, allowedIp } as any,
       });
 
-      if (!existingOnIp || existingOnIp.revokedAt === null) continue;
+      if (!existingOnIp) {
+        releaseAllowedIp(args.nodeId, allowedIp);
+        continue;
+      }
+      // active or reserved by a queued provision: bitmap drift, the address stays marked
+      // and we take the next one
+      if (await isPeerReserved(prisma, existingOnIp)) continue;
 
+      invalidatePeerConfigs(existingOnIp.id);
       try {
         return await prisma.peer.update({
-          where: { id: existingOnIp.id } as any,
+          where: { id: existingOnIp.id, revokedAt: existingOnIp.revokedAt } as any,
           data: {
             deviceId: args.deviceId,
             userId: args.userId,
@@ -185,20 +304,57 @@ async function reservePeerSlot(
           } as any,
         });
       } catch (reuseErr: any) {
-        if (
-          isUniqueConstraintFor(reuseErr, ["nodeId", "allowedIp"]) ||
-          isUniqueConstraintFor(reuseErr, ["nodeId", "publicKey"])
-        ) {
+        // our key sits on another row: this revoked row stays unused, its address goes back
+        if (isUniqueConstraintFor(reuseErr, ["nodeId", "publicKey"])) {
+          releaseAllowedIp(args.nodeId, allowedIp);
           continue;
         }
+        // taken over concurrently: the address is in use
+        if (isRecordNotFound(reuseErr) || isUniqueConstraintFor(reuseErr, ["nodeId", "allowedIp"])) continue;
+        releaseAllowedIp(args.nodeId, allowedIp);
         throw reuseErr;
       }
     }
   }
 
+  // too much drift between the bitmap and the DB: rebuild it on the next allocation
+  peerSlotStats.failures++;
+  invalidateIpPool(args.nodeId);
   throw new DeviceFlowError(500, "PEER_CREATE_CONFLICT_AFTER_RETRIES");
 }
 
+// gives up a reservation that was never applied; a row reused by another provision keeps its address
+async function releaseReservation(
+  prisma: PrismaClient,
+  pending: { id: string; nodeId: string; allowedIp: string; revokedAt: Date | null }
+) {
+  const released = await prisma.peer.updateMany({
+    where: { id: pending.id, revokedAt: pending.revokedAt } as any,
+    data: { revokedAt: new Date() },
+  });
+  if (released.count > 0) releaseAllowedIp(pending.nodeId, pending.allowedIp);
+}
+
+function poolBounds(node: { poolStart: string | null; poolEnd: string | null }) {
+  const range = nodePoolRange(node);
+  return { poolStart: range.start, poolEnd: range.end };
+}
+
+export async function nodeOf(prisma: PrismaClient, nodeId: string) {
+  const node = await getCachedNode(prisma, nodeId);
+  if (!node) throw new DeviceFlowError(500, "NODE_NOT_FOUND");
+  return node;
+}
+
+async function placeNewPeer(prisma: PrismaClient) {
+  try {
+    return await pickNodeForNewPeer(prisma);
+  } catch (err) {
+    if (err instanceof NodePlacementError) throw new DeviceFlowError(503, err.code);
+    throw err;
+  }
+}
+
 export async function ensureUser(prisma: PrismaClient, userId: string) {
   await prisma.user.upsert({
     where: { id: userId },
@@ -210,46 +366,98 @@ export async function ensureUser(prisma: PrismaClient, userId: string) {
   });
 }
 
-export async function provisionDevicePeer(
-  prisma: PrismaClient,
-  input: { deviceIdentifier: string; publicKey?: string | null; logger?: any }
-) {
-  const device = await resolveDevice(prisma, input.deviceIdentifier);
-  if (!device) throw new DeviceFlowError(404, "device_not_found");
-
-  const node = await ensureNode(prisma);
-
-  const active = await prisma.peer.findFirst({
-    where: { deviceId: device.id, nodeId: node.id, revokedAt: null },
-    orderBy: { createdAt: "desc" } as any,
-  });
+type ProvisionNode = {
+  id: string;
+  endpointHost: string;
+  wgPort: number;
+  serverPublicKey: string;
+};
 
-  if (active) {
-    const clientConfig = buildWgClientConfig({
-      clientPrivateKey: input.publicKey ? null : active.privateKey || null,
-      clientAddress: `${active.allowedIp}/32`,
+export function provisionResult(args: {
+  statusCode: 200 | 201 | 202;
+  existing: boolean;
+  peer: { id: string; publicKey: string; allowedIp: string; deviceId: string };
+  node: ProvisionNode;
+  clientPrivateKey: string | null;
+  jobId?: string | null;
+}) {
+  const { peer, node } = args;
+  // the private key is fixed by (peer id, public key), so the variant only says whether it is included
+  const configKey = peerConfigKey(peer, node, env.WG_CLIENT_DNS, args.clientPrivateKey ? "key" : "nokey");
+  const clientConfig = getRenderedConfig(configKey, () =>
+    buildWgClientConfig({
+      clientPrivateKey: args.clientPrivateKey,
+      clientAddress: `${peer.allowedIp}/32`,
       serverPublicKey: node.serverPublicKey,
       endpointHost: node.endpointHost,
       endpointPort: node.wgPort,
       dns: env.WG_CLIENT_DNS,
       persistentKeepalive: PERSISTENT_KEEPALIVE,
-    });
+    })
+  ).body;
 
-    return {
-      statusCode: 200 as const,
+  return {
+    statusCode: args.statusCode,
+    existing: args.existing,
+    // set for 202: the peer is reserved, the node change is applied by the provision queue
+    jobId: args.jobId ?? null,
+    peerId: peer.id,
+    allowedIp: peer.allowedIp,
+    nodeId: node.id,
+    endpointHost: node.endpointHost,
+    endpointPort: node.wgPort,
+    endpoint: `${node.endpointHost}:${node.wgPort}`,
+    serverPublicKey: node.serverPublicKey,
+    dns: env.WG_CLIENT_DNS,
+    persistentKeepalive: PERSISTENT_KEEPALIVE,
+    clientConfig,
+    deviceId: peer.deviceId,
+  };
+}
+
+export async function provisionDevicePeer(
+  prisma: PrismaClient,
+  input: {
+    deviceIdentifier: string;
+    publicKey?: string | null;
+    logger?: any;
+    // true: reserve + enqueue, return 202 without waiting for the node (default PROVISION_ASYNC)
+    async?: boolean;
+    connectToken?: string | null;
+  }
+) {
+  // Repeat provisions (bot / iOS re-provision on every tap): device and active peer in
+  // one query, node from the node cache.
+  const resolved = await resolveDeviceWithActivePeer(prisma, input.deviceIdentifier);
+  if (!resolved) throw new DeviceFlowError(404, "device_not_found");
+  const { device, active } = resolved;
+
+  if (active) {
+    const node = await nodeOf(prisma, active.nodeId);
+    return provisionResult({
+      statusCode: 200,
       existing: true,
-      peerId: active.id,
-      allowedIp: active.allowedIp,
-      nodeId: node.id,
-      endpointHost: node.endpointHost,
-      endpointPort: node.wgPort,
-      endpoint: `${node.endpointHost}:${node.wgPort}`,
-      serverPublicKey: node.serverPublicKey,
-      dns: env.WG_CLIENT_DNS,
-      persistentKeepalive: PERSISTENT_KEEPALIVE,
-      clientConfig,
-      deviceId: device.id,
-    };
+      peer: active,
+      node,
+      clientPrivateKey: input.publicKey ? null : active.privateKey || null,
+    });
+  }
+
+  // a queued provision for this device is still running: report it instead of reserving another peer
+  const pendingJob = await findPendingProvisionJob(prisma, device.id);
+  if (pendingJob) {
+    const reserved = await prisma.peer.findUnique({ where: { id: pendingJob.peerId } as any });
+    if (reserved) {
+      const node = await nodeOf(prisma, reserved.nodeId);
+      return provisionResult({
+        statusCode: 202,
+        existing: true,
+        peer: reserved,
+        node,
+        clientPrivateKey: input.publicKey ? null : reserved.privateKey || null,
+        jobId: pendingJob.id,
+      });
+    }
   }
 
   let clientPublicKey = "";
@@ -258,64 +466,85 @@ export async function provisionDevicePeer(
     clientPublicKey = input.publicKey.trim();
     clientPrivateKey = "";
   } else {
-    const generated = generateWgKeypair();
+    const generated = takeWgKeypair();
     clientPublicKey = generated.publicKey;
     clientPrivateKey = generated.privateKey;
   }
 
+  const node = await placeNewPeer(prisma);
   const pending = await reservePeerSlot(prisma, {
     nodeId: node.id,
+    ...poolBounds(node),
     deviceId: device.id,
     userId: device.userId,
     publicKey: clientPublicKey,
     privateKey: clientPrivateKey,
   });
 
+  if (input.async ?? provisionAsyncByDefault()) {
+    let job;
+    try {
+      job = await enqueueProvisionJob(prisma, {
+        peerId: pending.id,
+        nodeId: node.id,
+        deviceId: device.id,
+        connectToken: input.connectToken,
+      });
+    } catch (error) {
+      await releaseReservation(prisma, pending);
+      throw error;
+    }
+
+    return provisionResult({
+      statusCode: 202,
+      existing: false,
+      peer: pending,
+      node,
+      clientPrivateKey: clientPrivateKey || null,
+      jobId: job.id,
+    });
+  }
+
   try {
-    await wgAddPeer({
+    await wgAddPeerBatched({
       publicKey: pending.publicKey,
       allowedIp: pending.allowedIp,
       node: { sshHost: node.sshHost, sshUser: node.sshUser, wgInterface: node.wgInterface },
     });
   } catch (error: any) {
     input.logger?.error?.({ err: error }, "wgAddPeer failed");
-    await prisma.peer.update({
-      where: { id: pending.id } as any,
-      data: { revokedAt: new Date() },
-    });
+    await releaseReservation(prisma, pending);
+    // breaker open / too many in-flight commands on the node: retryable, not a node error
+    if (error instanceof NodeUnavailableError) throw new DeviceFlowError(503, error.code);
     throw new DeviceFlowError(502, "WG_ADD_FAILED");
   }
 
-  const activated = await prisma.peer.update({
-    where: { id: pending.id } as any,
-    data: { revokedAt: null },
+  const activated = await prisma.$transaction(async (tx) => {
+    // conditional on our reservation: another provision may have reused the revoked row meanwhile
+    const claimed = await tx.peer.updateMany({
+      where: { id: pending.id, revokedAt: pending.revokedAt } as any,
+      data: { revokedAt: null },
+    });
+    if (claimed.count === 0) return null;
+    await adjustActiveDevices(tx, pending.userId, 1);
+    return { ...pending, revokedAt: null };
   });
+  if (!activated) {
+    input.logger?.warn?.({ peerId: pending.id }, "reserved peer taken over before activation");
+    await wgRemovePeerBatched({
+      publicKey: pending.publicKey,
+      node: { sshHost: node.sshHost, sshUser: node.sshUser, wgInterface: node.wgInterface },
+    }).catch((err) => input.logger?.warn?.({ err }, "wgRemovePeer after lost reservation failed"));
+    throw new DeviceFlowError(409, "PEER_RESERVATION_LOST");
+  }
 
-  const clientConfig = buildWgClientConfig({
+  return provisionResult({
+    statusCode: 201,
+    existing: false,
+    peer: activated,
+    node,
     clientPrivateKey: clientPrivateKey || null,
-    clientAddress: `${activated.allowedIp}/32`,
-    serverPublicKey: node.serverPublicKey,
-    endpointHost: node.endpointHost,
-    endpointPort: node.wgPort,
-    dns: env.WG_CLIENT_DNS,
-    persistentKeepalive: PERSISTENT_KEEPALIVE,
   });
-
-  return {
-    statusCode: 201 as const,
-    existing: false,
-    peerId: activated.id,
-    allowedIp: activated.allowedIp,
-    nodeId: node.id,
-    endpointHost: node.endpointHost,
-    endpointPort: node.wgPort,
-    endpoint: `${node.endpointHost}:${node.wgPort}`,
-    serverPublicKey: node.serverPublicKey,
-    dns: env.WG_CLIENT_DNS,
-    persistentKeepalive: PERSISTENT_KEEPALIVE,
-    clientConfig,
-    deviceId: device.id,
-  };
 }
 
 export async function revokeDevicePeer(
@@ -325,9 +554,8 @@ export async function revokeDevicePeer(
   const device = await resolveDevice(prisma, input.deviceIdentifier);
   if (!device) throw new DeviceFlowError(404, "device_not_found");
 
-  const node = await ensureNode(prisma);
   const active = await prisma.peer.findFirst({
-    where: { deviceId: device.id, nodeId: node.id, revokedAt: null },
+    where: { deviceId: device.id, revokedAt: null },
     orderBy: { createdAt: "desc" } as any,
   });
 
@@ -337,16 +565,19 @@ export async function revokeDevicePeer(
       revoked: false,
       peerId: null,
       deviceId: device.id,
-      nodeId: node.id,
+      nodeId: null,
     };
   }
 
+  const node = await nodeOf(prisma, active.nodeId);
+
   try {
-    await wgRemovePeer({
+    await wgRemovePeerBatched({
       publicKey: active.publicKey,
       node: { sshHost: node.sshHost, sshUser: node.sshUser, wgInterface: node.wgInterface },
     });
   } catch (error: any) {
+    if (error instanceof NodeUnavailableError) throw new DeviceFlowError(503, error.code);
     const message = String(error?.stderr || error?.message || "");
     if (!/no such peer|not found/i.test(message)) {
       input.logger?.error?.({ err: error }, "wgRemovePeer failed");
@@ -355,10 +586,16 @@ export async function revokeDevicePeer(
     input.logger?.warn?.({ err: error }, "wgRemovePeer failed but ignoring (peer missing)");
   }
 
-  await prisma.peer.update({
-    where: { id: active.id } as any,
-    data: { revokedAt: new Date() },
+  await prisma.$transaction(async (tx) => {
+    // a concurrent revoke of the same peer must not decrement twice
+    const revoked = await tx.peer.updateMany({
+      where: { id: active.id, revokedAt: null } as any,
+      data: { revokedAt: new Date() },
+    });
+    if (revoked.count > 0) await adjustActiveDevices(tx, active.userId, -1);
   });
+  releaseAllowedIp(node.id, active.allowedIp);
+  invalidatePeerConfigs(active.id);
 
   return {
     statusCode: 200 as const,
@@ -0,0 +1,94 @@
+import type { Entitlement, Prisma, PrismaClient } from "@prisma/client";
+
+// Entitlement rows (one per user) back assertSubscription.
+// Writers must call these helpers inside the same transaction that changes a
+// peer's active state or the user's subscription, so the counters never drift
+// from the Peer/Subscription tables. Reads go through a short in-process cache.
+
+type Db = PrismaClient | Prisma.TransactionClient;
+
+function numEnv(name: string, fallback: number): number {
+  const n = Number(process.env[name]);
+  return Number.isFinite(n) && n >= 0 ? n : fallback;
+}
+
+// other API replicas see a write after at most this long
+const CACHE_TTL_MS = () => numEnv("ENTITLEMENT_CACHE_TTL_MS", 5_000);
+const CACHE_MAX = 50_000;
+
+const cache = new Map<string, { value: Entitlement; expiresAt: number }>();
+const stats = { hits: 0, misses: 0, backfills: 0 };
+
+export function invalidateEntitlement(userId: string) {
+  cache.delete(userId);
+}
+
+// builds the row from the source tables (users created before the table, or after manual edits)
+export async function backfillEntitlement(db: Db, userId: string): Promise<Entitlement> {
+  stats.backfills++;
+  const [sub, activeDevices] = await Promise.all([
+    db.subscription.findUnique({ where: { userId } }),
+    db.peer.count({ where: { userId, revokedAt: null } }),
+  ]);
+  const data = {
+    activeDevices,
+    deviceLimit: sub?.deviceLimit ?? 0,
+    status: sub?.status ?? null,
+    activeUntil: sub?.activeUntil ?? null,
+  };
+  invalidateEntitlement(userId);
+  return db.entitlement.upsert({
+    where: { userId },
+    update: data,
+    create: { userId, ...data },
+  });
+}
+
+/**
+ * +1 when a peer of the user becomes active, -1 when an active peer is revoked.
+ * Call in the transaction of the peer update.
+ */
+export async function adjustActiveDevices(db: Db, userId: string, delta: number) {
+  if (delta === 0) return;
+  const updated = await db.entitlement.updateMany({
+    where: { userId },
+    data: { activeDevices: { increment: delta } },
+  });
+  invalidateEntitlement(userId);
+  // no row yet: the count from Peer already includes this change
+  if (updated.count === 0) await backfillEntitlement(db, userId);
+}
+
+// limit/expiry after a subscription write (payment, manual activation, expiry)
+export async function syncEntitlementSubscription(
+  db: Db,
+  userId: string,
+  sub: { status: string; deviceLimit: number; activeUntil: Date }
+) {
+  const data = { status: sub.status, deviceLimit: sub.deviceLimit, activeUntil: sub.activeUntil };
+  const updated = await db.entitlement.updateMany({ where: { userId }, data });
+  invalidateEntitlement(userId);
+  if (updated.count === 0) await backfillEntitlement(db, userId);
+}
+
+export async function getEntitlement(prisma: Db, userId: string): Promise<Entitlement> {
+  const now = Date.now();
+  const hit = cache.get(userId);
+  if (hit && hit.expiresAt > now) {
+    stats.hits++;
+    return hit.value;
+  }
+  stats.misses++;
+
+  const row =
+    (await prisma.entitlement.findUnique({ where: { userId } })) ??
+    (await backfillEntitlement(prisma, userId));
+
+  if (cache.size >= CACHE_MAX) cache.clear();
+  cache.set(userId, { value: row, expiresAt: now + CACHE_TTL_MS() });
+  return row;
+}
+
+export function entitlementCacheStats() {
+  return { ...stats, size: cache.size };
+}
@@ -1,5 +1,6 @@
 // IP allocation logic for WG peers
 import type { PrismaClient } from "@prisma/client";
+import { ipAllocateDuration } from "./metrics";
 
 function ipToInt(ip: string): number {
   const parts = ip.split(".");
@@ -21,29 +22,233 @@ function intToIp(n: number): string {
   ].join(".");
 }
 
-// Allocate only from ACTIVE peers (revokedAt = null).
-// Revoked peers must not hold pool capacity.
-export async function allocateAllowedIp(
+// Allocate only from ACTIVE peers (revokedAt = null) and peers reserved by a
+// queued/running provision job (still revoked until the job activates them).
+// Other revoked peers must not hold pool capacity.
+//
+// Each node's pool lives in memory as a bitmap (1 bit per address, a /16 is 8 KiB),
+// loaded from the DB once and then kept in sync by provision/revoke through
+// releaseAllowedIp / markAllowedIpUsed. The DB unique (nodeId, allowedIp) stays the
+// source of truth: on drift callers mark the address and retry, and
+// invalidateIpPool forces a rebuild from the DB.
+
+class NodeIpPool {
+  readonly start: number;
+  readonly end: number;
+  readonly size: number;
+  used = 0;
+  private readonly words: Uint32Array;
+  private cursor = 0; // word index to resume scanning from
+
+  constructor(start: number, end: number) {
+    this.start = start;
+    this.end = end;
+    this.size = end - start + 1;
+    this.words = new Uint32Array(Math.ceil(this.size / 32));
+
+    // bits past the end of the range are permanently "used"
+    const tail = this.size % 32;
+    if (tail !== 0) this.words[this.words.length - 1] = ~((1 << tail) - 1) >>> 0;
+  }
+
+  private index(n: number): number {
+    const i = n - this.start;
+    return i >= 0 && i < this.size ? i : -1;
+  }
+
+  has(n: number): boolean {
+    const i = this.index(n);
+    return i !== -1 && (this.words[i >>> 5] & (1 << (i & 31))) !== 0;
+  }
+
+  mark(n: number): boolean {
+    const i = this.index(n);
+    if (i === -1 || this.has(n)) return false;
+    this.words[i >>> 5] |= 1 << (i & 31);
+    this.used++;
+    return true;
+  }
+
+  clear(n: number): boolean {
+    const i = this.index(n);
+    if (i === -1 || !this.has(n)) return false;
+    this.words[i >>> 5] &= ~(1 << (i & 31));
+    this.used--;
+    if (i >>> 5 < this.cursor) this.cursor = i >>> 5;
+    return true;
+  }
+
+  // Lowest free address at or after the cursor; skips full words 32 addresses at a time.
+  take(): number | null {
+    if (this.used >= this.size) return null;
+
+    const count = this.words.length;
+    for (let k = 0; k < count; k++) {
+      const w = (this.cursor + k) % count;
+      const word = this.words[w];
+      if (word === 0xffffffff) continue;
+
+      const lowestZero = ~word & (word + 1);
+      const bit = 31 - Math.clz32(lowestZero);
+      this.cursor = w;
+
+      const n = this.start + w * 32 + bit;
+      this.mark(n);
+      return n;
+    }
+    return null;
+  }
+}
+
+const pools = new Map<string, NodeIpPool>();
+const loading = new Map<string, Promise<NodeIpPool>>();
+const stats = { loads: 0, allocations: 0, releases: 0, driftMarks: 0, invalidations: 0 };
+
+async function loadPool(
+  prisma: PrismaClient,
+  nodeId: string,
+  startN: number,
+  endN: number
+): Promise<NodeIpPool> {
+  const jobs = await prisma.provisionJob.findMany({
+    where: { nodeId, status: { in: ["QUEUED", "RUNNING"] } },
+    select: { peerId: true },
+  });
+  const activePeers = await prisma.peer.findMany({
+    where: {
+      nodeId,
+      OR: [{ revokedAt: null }, ...(jobs.length > 0 ? [{ id: { in: jobs.map((j) => j.peerId) } }] : [])],
+    },
+    select: { allowedIp: true },
+  });
+
+  const pool = new NodeIpPool(startN, endN);
+  for (const p of activePeers) {
+    try {
+      pool.mark(ipToInt(p.allowedIp));
+    } catch {
+      // garbage in allowedIp does not hold capacity
+    }
+  }
+
+  stats.loads++;
+  return pool;
+}
+
+async function getPool(
   prisma: PrismaClient,
   opts: { nodeId: string; start: string; end: string }
-): Promise<string> {
+): Promise<NodeIpPool> {
   const startN = ipToInt(opts.start);
   const endN = ipToInt(opts.end);
   if (startN > endN) throw new Error(`WG_POOL_START > WG_POOL_END (${opts.start}..${opts.end})`);
 
-  const activePeers = await prisma.peer.findMany({
-    where: { nodeId: opts.nodeId, revokedAt: null },
-    select: { allowedIp: true },
-  });
+  const cached = pools.get(opts.nodeId);
+  if (cached && cached.start === startN && cached.end === endN) return cached;
+
+  let pending = loading.get(opts.nodeId);
+  if (!pending) {
+    pending = loadPool(prisma, opts.nodeId, startN, endN)
+      .then((pool) => {
+        pools.set(opts.nodeId, pool);
+        return pool;
+      })
+      .finally(() => loading.delete(opts.nodeId));
+    loading.set(opts.nodeId, pending);
+  }
+  return pending;
+}
+
+/**
+ * Reserves a free address in the node pool (in memory, no DB scan after the first load).
+ * The caller must persist it or give it back with releaseAllowedIp.
+ */
+export async function allocateAllowedIp(
+  prisma: PrismaClient,
+  opts: { nodeId: string; start: string; end: string }
+): Promise<string> {
+  const startedAt = performance.now();
+  const pool = await getPool(prisma, opts);
+  const n = pool.take();
+  ipAllocateDuration.observe({ node: opts.nodeId }, (performance.now() - startedAt) / 1000);
+
+  if (n === null) {
+    const err: any = new Error("WG_POOL_EXHAUSTED");
+    err.code = "WG_POOL_EXHAUSTED";
+    throw err;
+  }
+
+  stats.allocations++;
+  return intToIp(n);
+}
+
+/**
+ * Bulk variant of allocateAllowedIp: up to `count` addresses in one pass over the
+ * bitmap (fewer when the pool runs out). Each one must be persisted or released.
+ */
+export async function allocateAllowedIps(
+  prisma: PrismaClient,
+  opts: { nodeId: string; start: string; end: string },
+  count: number
+): Promise<string[]> {
+  const startedAt = performance.now();
+  const pool = await getPool(prisma, opts);
+  const out: string[] = [];
+  while (out.length < count) {
+    const n = pool.take();
+    if (n === null) break;
+    out.push(intToIp(n));
+  }
+  ipAllocateDuration.observe({ node: opts.nodeId }, (performance.now() - startedAt) / 1000);
 
-  const used = new Set(activePeers.map((p) => p.allowedIp));
+  stats.allocations += out.length;
+  return out;
+}
 
-  for (let cur = startN; cur <= endN; cur++) {
-    const ip = intToIp(cur);
-    if (!used.has(ip)) return ip;
+export async function ipPoolUsage(
+  prisma: PrismaClient,
+  opts: { nodeId: string; start: string; end: string }
+): Promise<{ size: number; used: number }> {
+  const pool = await getPool(prisma, opts);
+  return { size: pool.size, used: pool.used };
+}
+
+export function releaseAllowedIp(nodeId: string, ip: string) {
+  const pool = pools.get(nodeId);
+  if (!pool) return;
+  try {
+    if (pool.clear(ipToInt(ip))) stats.releases++;
+  } catch {
+    // not an address we manage
+  }
+}
+
+// The address is taken in the DB although the bitmap thought otherwise (another
+// API replica, manual edits): record it so the next allocation skips it.
+export function markAllowedIpUsed(nodeId: string, ip: string) {
+  const pool = pools.get(nodeId);
+  if (!pool) return;
+  try {
+    if (pool.mark(ipToInt(ip))) stats.driftMarks++;
+  } catch {
+    // not an address we manage
   }
+}
+
+export function invalidateIpPool(nodeId?: string) {
+  stats.invalidations++;
+  if (nodeId) pools.delete(nodeId);
+  else pools.clear();
+}
 
-  const err: any = new Error("WG_POOL_EXHAUSTED");
-  err.code = "WG_POOL_EXHAUSTED";
-  throw err;
+export function ipPoolStats() {
+  return {
+    ...stats,
+    nodes: [...pools.entries()].map(([nodeId, pool]) => ({
+      nodeId,
+      size: pool.size,
+      used: pool.used,
+      free: pool.size - pool.used,
+    })),
+  };
 }
@@ -0,0 +1,129 @@
+import { createHash } from "node:crypto";
+
+// Verified-session cache for requireAuth.
+// A valid token is HMAC-verified once; later requests with the same token get
+// the decoded payload from a bounded LRU keyed by sha256(token). Entries live
+// until the token's exp, capped at JWT_CACHE_TTL_MS so secret rotation and
+// user changes are picked up. Logout puts the token on an in-process denylist.
+
+function numEnv(name: string, fallback: number): number {
+  const n = Number(process.env[name]);
+  return Number.isFinite(n) && n >= 0 ? n : fallback;
+}
+
+const MAX_ENTRIES = () => Math.max(1, numEnv("JWT_CACHE_MAX", 10_000));
+const TTL_MS = () => numEnv("JWT_CACHE_TTL_MS", 10 * 60_000);
+const MAX_REVOKED = () => Math.max(1, numEnv("JWT_REVOKED_MAX", 100_000));
+
+type Entry = { payload: any; expiresAt: number };
+
+// Map keeps insertion order: re-inserting on hit makes the first key the least recently used
+const verified = new Map<string, Entry>();
+const revoked = new Map<string, number>(); // token hash -> token exp (ms)
+
+const stats = { hits: 0, misses: 0, evictions: 0, revocations: 0, rejectedRevoked: 0 };
+
+function tokenHash(token: string) {
+  return createHash("sha256").update(token).digest("hex");
+}
+
+// same sources @fastify/jwt reads: Authorization: Bearer, then the cg_session cookie
+export function requestToken(req: any): string | null {
+  const header = req.headers?.authorization;
+  if (typeof header === "string" && /^Bearer\s/i.test(header)) return header.slice(7).trim() || null;
+  const cookie = req.cookies?.cg_session;
+  return typeof cookie === "string" && cookie ? cookie : null;
+}
+
+function tokenExpMs(payload: any): number | null {
+  return typeof payload?.exp === "number" ? payload.exp * 1000 : null;
+}
+
+function isRevoked(hash: string, now: number) {
+  const exp = revoked.get(hash);
+  if (exp === undefined) return false;
+  if (exp <= now) {
+    // expired anyway, jwtVerify rejects it from now on
+    revoked.delete(hash);
+    return false;
+  }
+  return true;
+}
+
+function remember(hash: string, payload: any, now: number) {
+  const exp = tokenExpMs(payload);
+  const expiresAt = Math.min(exp ?? Infinity, now + TTL_MS());
+  if (expiresAt <= now) return;
+
+  verified.delete(hash);
+  verified.set(hash, { payload, expiresAt });
+  while (verified.size > MAX_ENTRIES()) {
+    const oldest = verified.keys().next().value as string;
+    verified.delete(oldest);
+    stats.evictions++;
+  }
+}
+
+/**
+ * Drop-in for `await req.jwtVerify()` in preHandlers: sets req.user, throws the
+ * @fastify/jwt error for bad tokens. Returns false (and replies 401) for a revoked token.
+ */
+export async function verifyJwtCached(req: any, reply: any): Promise<boolean> {
+  const token = requestToken(req);
+  if (!token) {
+    await req.jwtVerify();
+    return true;
+  }
+
+  const now = Date.now();
+  const hash = tokenHash(token);
+
+  if (isRevoked(hash, now)) {
+    stats.rejectedRevoked++;
+    reply.code(401).send({ error: "unauthorized" });
+    return false;
+  }
+
+  const hit = verified.get(hash);
+  if (hit && hit.expiresAt > now) {
+    stats.hits++;
+    verified.delete(hash);
+    verified.set(hash, hit);
+    req.user = hit.payload;
+    return true;
+  }
+  if (hit) verified.delete(hash);
+
+  stats.misses++;
+  const payload = await req.jwtVerify();
+  remember(hash, payload ?? req.user, now);
+  return true;
+}
+
+/**
+ * Logout: the token stops working in this process even though it has not expired yet.
+ * Callers pass the payload of a token they verified (forged tokens must not fill the list).
+ */
+export function revokeJwt(token: string, payload: any) {
+  const now = Date.now();
+  const hash = tokenHash(token);
+  verified.delete(hash);
+  const exp = tokenExpMs(payload) ?? now + 30 * 24 * 60 * 60_000;
+  if (exp <= now) return;
+  revoked.delete(hash);
+  revoked.set(hash, exp);
+  stats.revocations++;
+
+  // drop entries for already expired tokens now and then, and cap the list like the verified cache
+  if (revoked.size % 1_000 === 0) {
+    for (const [h, e] of revoked) if (e <= now) revoked.delete(h);
+  }
+  while (revoked.size > MAX_REVOKED()) {
+    revoked.delete(revoked.keys().next().value as string);
+    stats.evictions++;
+  }
+}
+
+export function jwtCacheStats() {
+  return { ...stats, size: verified.size, revoked: revoked.size };
+}
@@ -0,0 +1,79 @@
+import { generateKeyPair } from "node:crypto";
+import { generateWgKeypair, keypairFromKeyObject } from "./wg-keys";
+
+// Pre-generated WireGuard keypairs for server-side key provisions.
+//
+// Keys are made with the async native X25519 generator, which runs on the libuv
+// threadpool, so the curve math never runs on the event loop of a request.
+// takeWgKeypair() pops one in O(1) and tops the pool up in the background;
+// an empty pool (burst bigger than the pool) falls back to one synchronous
+// native generation.
+
+type Keypair = { privateKey: string; publicKey: string };
+
+function numEnv(name: string, fallback: number): number {
+  const n = Number(process.env[name]);
+  return Number.isFinite(n) && n >= 0 ? n : fallback;
+}
+
+const POOL_SIZE = () => numEnv("WG_KEYPOOL_SIZE", 256);
+// refill starts once the pool drops below this share of its size
+const LOW_WATERMARK = 0.5;
+// keep part of the threadpool (default 4 threads) for fs/dns/zlib
+const FILL_CONCURRENCY = 2;
+
+const pool: Keypair[] = [];
+let filling = 0;
+const stats = { taken: 0, fallbacks: 0, generated: 0, errors: 0 };
+
+function generateAsync(): Promise<Keypair> {
+  return new Promise((resolve, reject) => {
+    generateKeyPair("x25519", (err, _publicKey, privateKey) => {
+      if (err) reject(err);
+      else resolve(keypairFromKeyObject(privateKey));
+    });
+  });
+}
+
+// keeps up to FILL_CONCURRENCY generations in flight until the pool is full
+function refill() {
+  while (filling < FILL_CONCURRENCY && pool.length + filling < POOL_SIZE()) {
+    filling++;
+    void fillOne();
+  }
+}
+
+async function fillOne() {
+  let ok = false;
+  try {
+    const kp = await generateAsync();
+    stats.generated++;
+    if (pool.length < POOL_SIZE()) pool.push(kp);
+    ok = true;
+  } catch {
+    stats.errors++;
+  } finally {
+    filling--;
+  }
+  // after an error the next take retries instead of spinning here
+  if (ok) refill();
+}
+
+// warm up at startup so the first provisions already hit the pool
+export function startKeypairPool() {
+  refill();
+}
+
+export function takeWgKeypair(): Keypair {
+  stats.taken++;
+  const kp = pool.pop();
+  if (pool.length < POOL_SIZE() * LOW_WATERMARK) refill();
+  if (kp) return kp;
+
+  stats.fallbacks++;
+  return generateWgKeypair();
+}
+
+export function keypairPoolStats() {
+  return { ...stats, depth: pool.length, size: POOL_SIZE(), filling };
+}
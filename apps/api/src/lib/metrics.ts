@@ -0,0 +1,193 @@
+import type { FastifyInstance } from "fastify";
+import type { PrismaClient } from "@prisma/client";
+import { recordQuery } from "./query-stats";
+
+// Minimal Prometheus text-format registry (no client library).
+// Hot path cost is one Map lookup + a bucket scan per observation; counters that
+// already live in module stats (allocator, batcher, breakers, queue) are read
+// at scrape time through collectors instead of being double-counted here.
+
+type Labels = Record<string, string | number>;
+
+const DEFAULT_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30];
+
+function labelKey(labels: Labels) {
+  let out = "";
+  for (const k of Object.keys(labels)) {
+    const v = String(labels[k]).replace(/\\/g, "\\\\").replace(/"/g, '\\"').replace(/\n/g, "\\n");
+    out += `${out ? "," : ""}${k}="${v}"`;
+  }
+  return out;
+}
+
+type Series = { labels: string; counts: number[]; sum: number; count: number };
+
+export class Histogram {
+  private series = new Map<string, Series>();
+
+  constructor(
+    readonly name: string,
+    readonly help: string,
+    readonly buckets: number[] = DEFAULT_BUCKETS
+  ) {
+    registry.push(this);
+  }
+
+  observe(labels: Labels, seconds: number) {
+    const key = labelKey(labels);
+    let s = this.series.get(key);
+    if (!s) {
+      s = { labels: key, counts: new Array(this.buckets.length).fill(0), sum: 0, count: 0 };
+      this.series.set(key, s);
+    }
+    for (let i = 0; i < this.buckets.length; i++) {
+      if (seconds <= this.buckets[i]) {
+        s.counts[i]++;
+        break;
+      }
+    }
+    s.sum += seconds;
+    s.count++;
+  }
+
+  // observes the duration of fn, whether it resolves or throws
+  async time<T>(labels: Labels, fn: () => Promise<T>): Promise<T> {
+    const startedAt = performance.now();
+    try {
+      return await fn();
+    } finally {
+      this.observe(labels, (performance.now() - startedAt) / 1000);
+    }
+  }
+
+  render(): string {
+    const lines = [`# HELP ${this.name} ${this.help}`, `# TYPE ${this.name} histogram`];
+    for (const s of this.series.values()) {
+      const sep = s.labels ? "," : "";
+      let cumulative = 0;
+      for (let i = 0; i < this.buckets.length; i++) {
+        cumulative += s.counts[i];
+        lines.push(`${this.name}_bucket{${s.labels}${sep}le="${this.buckets[i]}"} ${cumulative}`);
+      }
+      lines.push(`${this.name}_bucket{${s.labels}${sep}le="+Inf"} ${s.count}`);
+      lines.push(`${this.name}_sum${s.labels ? `{${s.labels}}` : ""} ${s.sum}`);
+      lines.push(`${this.name}_count${s.labels ? `{${s.labels}}` : ""} ${s.count}`);
+    }
+    return lines.join("\n");
+  }
+}
+
+export type MetricSample = { labels?: Labels; value: number };
+
+// counter/gauge whose values are read from existing state at scrape time
+export type Collector = {
+  name: string;
+  help: string;
+  type: "counter" | "gauge";
+  collect: () => MetricSample[] | Promise<MetricSample[]>;
+};
+
+const registry: Histogram[] = [];
+const collectors: Collector[] = [];
+
+export function registerCollector(collector: Collector) {
+  collectors.push(collector);
+}
+
+export async function renderMetrics(): Promise<string> {
+  const parts = registry.map((h) => h.render());
+
+  for (const c of collectors) {
+    let samples: MetricSample[];
+    try {
+      samples = await c.collect();
+    } catch {
+      continue; // a failing source must not break the whole scrape
+    }
+    const lines = [`# HELP ${c.name} ${c.help}`, `# TYPE ${c.name} ${c.type}`];
+    for (const s of samples) {
+      const key = s.labels ? labelKey(s.labels) : "";
+      lines.push(`${c.name}${key ? `{${key}}` : ""} ${Number.isFinite(s.value) ? s.value : 0}`);
+    }
+    parts.push(lines.join("\n"));
+  }
+
+  return `${parts.join("\n")}\n`;
+}
+
+// --- histograms shared across modules ---
+
+export const httpRequestDuration = new Histogram(
+  "http_request_duration_seconds",
+  "HTTP request latency by route"
+);
+
+export const prismaQueryDuration = new Histogram(
+  "prisma_query_duration_seconds",
+  "Prisma query latency by model and operation"
+);
+
+export const requestQueryCount = new Histogram(
+  "http_request_prisma_queries",
+  "Prisma queries per HTTP request by route",
+  [1, 2, 3, 5, 8, 13, 20, 50, 100]
+);
+
+export const sshCommandDuration = new Histogram(
+  "wg_node_ssh_duration_seconds",
+  "Remote node command latency by node and command"
+);
+
+export const ipAllocateDuration = new Histogram(
+  "ip_allocate_duration_seconds",
+  "Address allocation latency by node (includes the first pool load)"
+);
+
+export const peerSlotReserveDuration = new Histogram(
+  "peer_slot_reserve_duration_seconds",
+  "reservePeerSlot latency by node, including conflict retries"
+);
+
+export const subscriptionExpiryDuration = new Histogram(
+  "subscription_expiry_batch_duration_seconds",
+  "Subscription expiry batch latency by phase (db claim + revoke, node removals)"
+);
+
+// --- wiring ---
+
+const instrumentedClients = new WeakSet<object>();
+
+export function instrumentPrisma(prisma: PrismaClient) {
+  if (instrumentedClients.has(prisma)) return;
+  instrumentedClients.add(prisma);
+
+  prisma.$use(async (params, next) => {
+    const startedAt = performance.now();
+    try {
+      return await next(params);
+    } finally {
+      const ms = performance.now() - startedAt;
+      const model = params.model ?? "raw";
+      prismaQueryDuration.observe({ model, operation: params.action }, ms / 1000);
+      recordQuery(model, params.action, ms);
+    }
+  });
+}
+
+export function instrumentHttp(app: FastifyInstance) {
+  app.addHook("onRequest", async (req: any) => {
+    req.metricsStartedAt = performance.now();
+  });
+
+  app.addHook("onResponse", async (req: any, reply) => {
+    if (req.metricsStartedAt === undefined) return;
+    // route pattern, not the raw url: keeps label cardinality bounded
+    const route = req.routeOptions?.url ?? "unmatched";
+    httpRequestDuration.observe(
+      { method: req.method, route, status: reply.statusCode },
+      (performance.now() - req.metricsStartedAt) / 1000
+    );
+    // filled by query-stats.instrumentRequests
+    if (req.queryContext) requestQueryCount.observe({ method: req.method, route }, req.queryContext.queries);
+  });
+}
@@ -0,0 +1,185 @@
+import { isSshTransportError } from "./ssh-pool";
+
+// Per-node circuit breaker and in-flight limit for remote (SSH) operations.
+//
+// closed    -> calls go through; the last WG_NODE_BREAKER_WINDOW outcomes are tracked
+//              and the breaker opens once the failure share reaches WG_NODE_BREAKER_THRESHOLD.
+// open      -> calls fail immediately with NODE_UNAVAILABLE for WG_NODE_BREAKER_OPEN_MS.
+// half-open -> one probe call is let through; success closes the breaker, failure reopens it.
+//
+// Only transport failures (ssh exit 255, timeouts) count: a `wg` error means the node answered.
+// Independently, at most WG_NODE_MAX_INFLIGHT commands per node may be running or queued;
+// the rest are shed with NODE_OVERLOADED instead of piling up ssh processes.
+
+function numEnv(name: string, fallback: number): number {
+  const n = Number(process.env[name]);
+  return Number.isFinite(n) && n >= 0 ? n : fallback;
+}
+
+const WINDOW = () => Math.max(1, numEnv("WG_NODE_BREAKER_WINDOW", 20));
+const MIN_CALLS = () => Math.max(1, numEnv("WG_NODE_BREAKER_MIN_CALLS", 5));
+const THRESHOLD = () => Math.min(1, numEnv("WG_NODE_BREAKER_THRESHOLD", 0.5));
+const OPEN_MS = () => numEnv("WG_NODE_BREAKER_OPEN_MS", 30_000);
+const MAX_INFLIGHT = () => Math.max(1, numEnv("WG_NODE_MAX_INFLIGHT", 32));
+
+export type NodeBreakerState = "closed" | "open" | "half-open";
+
+export class NodeUnavailableError extends Error {
+  code: "NODE_UNAVAILABLE" | "NODE_OVERLOADED";
+  node: string;
+
+  constructor(code: "NODE_UNAVAILABLE" | "NODE_OVERLOADED", node: string) {
+    super(`${code}: ${node}`);
+    this.name = "NodeUnavailableError";
+    this.code = code;
+    this.node = node;
+  }
+}
+
+export function isTransportError(err: any): boolean {
+  return err instanceof NodeUnavailableError || isSshTransportError(err);
+}
+
+class NodeBreaker {
+  state: NodeBreakerState = "closed";
+  openedAt = 0;
+  inFlight = 0;
+  private probing = false;
+  private outcomes: boolean[] = []; // true = failure
+  private failures = 0;
+
+  opens = 0;
+  rejected = 0;
+  shed = 0;
+
+  constructor(readonly key: string) {}
+
+  // open -> half-open once the open period is over
+  private refresh(now: number) {
+    if (this.state === "open" && now - this.openedAt >= OPEN_MS()) {
+      this.state = "half-open";
+      this.probing = false;
+    }
+  }
+
+  isOpen(now = Date.now()) {
+    this.refresh(now);
+    return this.state === "open" || (this.state === "half-open" && this.probing);
+  }
+
+  // returns true when the call is the half-open probe
+  admit(): boolean {
+    this.refresh(Date.now());
+    if (this.state === "open" || (this.state === "half-open" && this.probing)) {
+      this.rejected++;
+      throw new NodeUnavailableError("NODE_UNAVAILABLE", this.key);
+    }
+    if (this.inFlight >= MAX_INFLIGHT()) {
+      this.shed++;
+      throw new NodeUnavailableError("NODE_OVERLOADED", this.key);
+    }
+    this.inFlight++;
+    if (this.state === "half-open") {
+      this.probing = true;
+      return true;
+    }
+    return false;
+  }
+
+  record(probe: boolean, failed: boolean) {
+    this.inFlight--;
+
+    if (probe) {
+      this.probing = false;
+      if (failed) this.open();
+      else this.close();
+      return;
+    }
+    if (this.state !== "closed") return;
+
+    this.outcomes.push(failed);
+    if (failed) this.failures++;
+    while (this.outcomes.length > WINDOW()) {
+      if (this.outcomes.shift()) this.failures--;
+    }
+
+    if (this.outcomes.length >= MIN_CALLS() && this.failures / this.outcomes.length >= THRESHOLD()) {
+      this.open();
+    }
+  }
+
+  private open() {
+    this.state = "open";
+    this.openedAt = Date.now();
+    this.opens++;
+    this.outcomes = [];
+    this.failures = 0;
+  }
+
+  private close() {
+    this.state = "closed";
+    this.outcomes = [];
+    this.failures = 0;
+  }
+
+  stats() {
+    this.refresh(Date.now());
+    return {
+      key: this.key,
+      state: this.state,
+      openedAt: this.openedAt || null,
+      inFlight: this.inFlight,
+      recentCalls: this.outcomes.length,
+      recentFailures: this.failures,
+      opens: this.opens,
+      rejected: this.rejected,
+      shed: this.shed,
+    };
+  }
+}
+
+const breakers = new Map<string, NodeBreaker>();
+
+function getBreaker(key: string) {
+  let breaker = breakers.get(key);
+  if (!breaker) {
+    breaker = new NodeBreaker(key);
+    breakers.set(key, breaker);
+  }
+  return breaker;
+}
+
+// same identity as the ssh pool: one breaker per user@host
+export function nodeBreakerKey(node: { sshHost: string; sshUser: string }) {
+  return `${node.sshUser}@${node.sshHost}`;
+}
+
+export async function withNodeBreaker<T>(key: string, fn: () => Promise<T>): Promise<T> {
+  const breaker = getBreaker(key);
+  const probe = breaker.admit();
+  try {
+    const result = await fn();
+    breaker.record(probe, false);
+    return result;
+  } catch (err) {
+    breaker.record(probe, isTransportError(err));
+    throw err;
+  }
+}
+
+// fast-fail check for callers that queue work before reaching the node (batcher, placement)
+export function assertNodeAvailable(key: string) {
+  const breaker = breakers.get(key);
+  if (breaker?.isOpen()) {
+    breaker.rejected++;
+    throw new NodeUnavailableError("NODE_UNAVAILABLE", key);
+  }
+}
+
+export function isNodeAvailable(node: { sshHost: string; sshUser: string }) {
+  return !breakers.get(nodeBreakerKey(node))?.isOpen();
+}
+
+export function nodeBreakerStats() {
+  return [...breakers.values()].map((b) => b.stats());
+}
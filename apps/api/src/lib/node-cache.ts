@@ -0,0 +1,115 @@
+import type { Node, PrismaClient } from "@prisma/client";
+
+// In-process copy of the Node table. Hot paths (placement, provision, revoke,
+// pollers) read node endpoint/key/ssh data from here; the table is re-read
+// after NODE_CACHE_TTL_MS, or as soon as a background version check
+// (count + max(updatedAt), every NODE_CACHE_CHECK_MS) sees a registry write
+// from another process (tools/wg-nodes.ts, other replicas).
+
+function numEnv(name: string, fallback: number): number {
+  const n = Number(process.env[name]);
+  return Number.isFinite(n) && n >= 0 ? n : fallback;
+}
+
+const TTL_MS = () => numEnv("NODE_CACHE_TTL_MS", 30_000);
+// 0 disables the version check (TTL only)
+const CHECK_MS = () => numEnv("NODE_CACHE_CHECK_MS", 2_000);
+// an unknown id forces a reload, but not more often than this
+const MISS_RELOAD_MS = 1_000;
+
+let nodes: Map<string, Node> | null = null;
+let loadedAt = 0;
+let loading: Promise<Map<string, Node>> | null = null;
+let checkedAt = 0;
+let checking = false;
+const stats = { loads: 0, hits: 0, misses: 0, versionReloads: 0 };
+
+// count + newest updatedAt: changes on every insert, update and delete of a node
+function versionOf(rows: Pick<Node, "updatedAt">[]) {
+  let newest = 0;
+  for (const n of rows) newest = Math.max(newest, n.updatedAt.getTime());
+  return `${rows.length}:${newest}`;
+}
+
+function reload(prisma: PrismaClient): Promise<Map<string, Node>> {
+  if (!loading) {
+    loading = prisma.node
+      .findMany({ orderBy: { id: "asc" } })
+      .then((rows) => {
+        nodes = new Map(rows.map((n) => [n.id, n]));
+        loadedAt = Date.now();
+        checkedAt = loadedAt;
+        stats.loads++;
+        return nodes;
+      })
+      .finally(() => {
+        loading = null;
+      });
+  }
+  return loading;
+}
+
+// off the request path: callers keep the current map, the next read sees the reload
+function checkVersion(prisma: PrismaClient) {
+  if (checking || loading) return;
+  checking = true;
+  checkedAt = Date.now();
+  prisma.node
+    .aggregate({ _count: { _all: true }, _max: { updatedAt: true } })
+    .then((agg) => {
+      const remote = `${agg._count._all}:${agg._max.updatedAt?.getTime() ?? 0}`;
+      if (nodes && remote !== versionOf([...nodes.values()])) {
+        stats.versionReloads++;
+        return reload(prisma);
+      }
+    })
+    .catch(() => {})
+    .finally(() => {
+      checking = false;
+    });
+}
+
+async function current(prisma: PrismaClient): Promise<Map<string, Node>> {
+  const now = Date.now();
+  if (nodes && now - loadedAt < TTL_MS()) {
+    if (CHECK_MS() > 0 && now - checkedAt >= CHECK_MS()) checkVersion(prisma);
+    return nodes;
+  }
+  return reload(prisma);
+}
+
+export async function getCachedNodes(prisma: PrismaClient): Promise<Node[]> {
+  return [...(await current(prisma)).values()];
+}
+
+export async function getCachedNode(prisma: PrismaClient, id: string): Promise<Node | null> {
+  const map = await current(prisma);
+  const hit = map.get(id);
+  if (hit) {
+    stats.hits++;
+    return hit;
+  }
+
+  stats.misses++;
+  if (Date.now() - loadedAt < MISS_RELOAD_MS) return null;
+  return (await reload(prisma)).get(id) ?? null;
+}
+
+// after a write through this process: keep the cache exact without a reload
+export function setCachedNode(node: Node) {
+  if (nodes) nodes.set(node.id, node);
+}
+
+export async function warmNodeCache(prisma: PrismaClient) {
+  await reload(prisma);
+}
+
+// drops the copy: the next read loads the table again
+export function coolNodeCache() {
+  nodes = null;
+  loadedAt = 0;
+}
+
+export function nodeCacheStats() {
+  return { ...stats, size: nodes?.size ?? 0, ageMs: nodes ? Date.now() - loadedAt : null };
+}
@@ -0,0 +1,82 @@
+import type { Node, PrismaClient } from "@prisma/client";
+import { ipPoolUsage } from "./ipAllocator";
+import { isNodeAvailable } from "./node-breaker";
+import { getCachedNodes } from "./node-cache";
+
+const DEFAULT_POOL_START = "10.8.0.2";
+const DEFAULT_POOL_END = "10.8.0.254";
+
+// Nodes are rows in the Node table. A node takes new peers only while
+// enabled && !draining; draining keeps existing peers but stops placement,
+// disabled also hides the node from reconcile/pollers.
+
+export class NodePlacementError extends Error {
+  code: string;
+
+  constructor(code: string) {
+    super(code);
+    this.name = "NodePlacementError";
+    this.code = code;
+  }
+}
+
+// per-node pool falls back to the global env range (single-node setups)
+export function nodePoolRange(node: Pick<Node, "poolStart" | "poolEnd">) {
+  return {
+    start: node.poolStart ?? process.env.WG_POOL_START ?? DEFAULT_POOL_START,
+    end: node.poolEnd ?? process.env.WG_POOL_END ?? DEFAULT_POOL_END,
+  };
+}
+
+export async function listNodes(prisma: PrismaClient, opts: { enabledOnly?: boolean } = {}) {
+  return prisma.node.findMany({
+    where: opts.enabledOnly ? { enabled: true } : {},
+    orderBy: { id: "asc" },
+  });
+}
+
+export type NodeLoad = {
+  node: Node;
+  limit: number; // min(pool size, capacity)
+  used: number;
+  free: number;
+};
+
+export async function nodeLoad(prisma: PrismaClient, node: Node): Promise<NodeLoad> {
+  const usage = await ipPoolUsage(prisma, { nodeId: node.id, ...nodePoolRange(node) });
+  const limit = node.capacity != null ? Math.min(node.capacity, usage.size) : usage.size;
+  return { node, limit, used: usage.used, free: Math.max(0, limit - usage.used) };
+}
+
+/**
+ * Picks the node for a new peer: among enabled, non-draining nodes with free
+ * capacity, the one with the largest free share of its limit; ties go to the
+ * node with fewer peers. Nodes whose circuit breaker is open are skipped.
+ * Nodes come from the node cache and usage from the in-memory IP pools,
+ * so placement does no per-request queries.
+ */
+export async function pickNodeForNewPeer(prisma: PrismaClient): Promise<Node> {
+  const placeable = (await getCachedNodes(prisma)).filter((n) => n.enabled && !n.draining);
+  if (placeable.length === 0) throw new NodePlacementError("NO_NODES_AVAILABLE");
+
+  // nodes with an open circuit breaker would only fail the provision after reserving an address
+  const candidates = placeable.filter((n) => isNodeAvailable(n));
+  if (candidates.length === 0) throw new NodePlacementError("NODE_UNAVAILABLE");
+
+  const loads = await Promise.all(candidates.map((node) => nodeLoad(prisma, node)));
+
+  let best: NodeLoad | null = null;
+  for (const load of loads) {
+    if (load.free <= 0) continue;
+    if (!best) {
+      best = load;
+      continue;
+    }
+    const share = load.free / load.limit;
+    const bestShare = best.free / best.limit;
+    if (share > bestShare || (share === bestShare && load.used < best.used)) best = load;
+  }
+
+  if (!best) throw new NodePlacementError("NODE_CAPACITY_EXHAUSTED");
+  return best.node;
+}
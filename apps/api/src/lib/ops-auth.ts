@@ -0,0 +1,10 @@
+// preHandler for ops routes (/metrics, /v1/nodes/*): peer keys, client endpoints,
+// traffic and per-user usage. Fails closed like /v1/bot/state: without METRICS_TOKEN
+// the routes answer 503, with it the bearer token is required.
+export async function requireOpsToken(req: any, reply: any) {
+  const token = process.env.METRICS_TOKEN;
+  if (!token) return reply.code(503).send({ error: "ops_token_not_configured" });
+  if (req.headers.authorization !== `Bearer ${token}`) {
+    return reply.code(401).send({ error: "UNAUTHORIZED" });
+  }
+}
@@ -0,0 +1,254 @@
+import type { Prisma, PrismaClient } from "@prisma/client";
+import { randomUUID } from "node:crypto";
+import { syncEntitlementSubscription } from "./entitlements";
+import { formatOutSum, robokassaIsTest } from "./robokassa";
+
+// Robokassa ResultURL processing.
+//
+// The HTTP handler only checks the signature, stores the callback in the
+// PaymentCallback inbox (INSERT ... ON CONFLICT DO NOTHING, so provider retries
+// collapse into one row) and answers OK<invId>. The worker applies callbacks;
+// each one is a single transaction: a conditional PENDING -> PAID update of the
+// payment (a second delivery matches nothing), one upsert that sets the
+// subscription to now() + plan duration and the inbox row marked DONE.
+// Claims use FOR UPDATE SKIP LOCKED with a visibility timeout, so any number of
+// API instances can run the worker.
+
+function numEnv(name: string, fallback: number): number {
+  const n = Number(process.env[name]);
+  return Number.isFinite(n) && n >= 0 ? n : fallback;
+}
+
+const POLL_MS = () => numEnv("PAYMENT_INBOX_POLL_MS", 1_000);
+const BATCH = () => Math.max(1, numEnv("PAYMENT_INBOX_BATCH", 50));
+const CONCURRENCY = () => Math.max(1, numEnv("PAYMENT_INBOX_CONCURRENCY", 8));
+// a claimed callback becomes visible again after this (worker died mid-batch)
+const LEASE_MS = () => Math.max(1_000, numEnv("PAYMENT_INBOX_LEASE_MS", 60_000));
+const MAX_ATTEMPTS = 10;
+const RETRY_BASE_MS = 1_000;
+const RETRY_MAX_MS = 5 * 60_000;
+
+export function paymentInboxEnabled(): boolean {
+  const v = (process.env.ROBOKASSA_INBOX ?? "1").trim().toLowerCase();
+  return v !== "0" && v !== "false";
+}
+
+export type RobokassaResult = "paid" | "already_paid" | "not_found" | "bad_amount";
+
+export type RobokassaCallback = {
+  invId: bigint;
+  outSum: string;
+  payload: Record<string, unknown>;
+  isTest: boolean;
+};
+
+type ClaimedCallback = {
+  id: string;
+  invId: bigint;
+  outSumRaw: string;
+  payload: any;
+  attempts: number;
+};
+
+const stats = { received: 0, duplicates: 0, processed: 0, paid: 0, rejected: 0, retried: 0, failed: 0 };
+
+let timer: NodeJS.Timeout | null = null;
+let ticking = false;
+let tickAgain = false;
+let workerPrisma: PrismaClient | null = null;
+let workerLogger: any = null;
+
+/**
+ * Applies one verified callback inside the caller's transaction.
+ * Safe to run any number of times for the same invoice: only the first run
+ * finds the payment PENDING and extends the subscription.
+ */
+export async function applyRobokassaResult(
+  tx: Prisma.TransactionClient,
+  cb: RobokassaCallback
+): Promise<RobokassaResult> {
+  const payment = await tx.payment.findUnique({
+    where: { invId: cb.invId },
+    include: { plan: true },
+  });
+  if (!payment) return "not_found";
+
+  const expectedOutSum = formatOutSum(payment.amountKopeks, cb.isTest);
+  if (expectedOutSum !== cb.outSum) {
+    await tx.payment.updateMany({
+      where: { invId: cb.invId, status: "PENDING" },
+      data: { rawPayload: cb.payload as any, outSumRaw: cb.outSum, status: "FAILED" },
+    });
+    return "bad_amount";
+  }
+
+  const claimed = await tx.payment.updateMany({
+    where: { invId: cb.invId, status: "PENDING" },
+    data: { status: "PAID", paidAt: new Date(), rawPayload: cb.payload as any, outSumRaw: cb.outSum },
+  });
+  if (claimed.count === 0) return "already_paid";
+
+  // same terms as before the inbox: the paid period starts now (routes/subscriptions.ts does
+  // the same); the row lock of the upsert orders concurrent payments
+  const plan = payment.plan;
+  const rows = await tx.$queryRaw<{ status: string; deviceLimit: number; activeUntil: Date }[]>`
+    INSERT INTO "Subscription" ("id", "userId", "planId", "status", "activeFrom", "activeUntil", "deviceLimit", "updatedAt")
+    VALUES (${randomUUID()}, ${payment.userId}, ${plan.id}, 'ACTIVE', now(),
+            now() + ${plan.durationDays}::int * interval '1 day', ${plan.deviceLimit}, now())
+    ON CONFLICT ("userId") DO UPDATE SET
+      "planId" = EXCLUDED."planId",
+      "status" = 'ACTIVE',
+      "activeFrom" = EXCLUDED."activeFrom",
+      "activeUntil" = EXCLUDED."activeUntil",
+      "deviceLimit" = EXCLUDED."deviceLimit",
+      "updatedAt" = now()
+    RETURNING "status", "deviceLimit", "activeUntil"
+  `;
+  await syncEntitlementSubscription(tx, payment.userId, rows[0]);
+  return "paid";
+}
+
+// stores a verified callback; false when this invoice's callback is already in the inbox
+export async function enqueueRobokassaCallback(
+  prisma: PrismaClient,
+  cb: { invId: bigint; outSum: string; payload: Record<string, unknown> }
+): Promise<boolean> {
+  const inserted = await prisma.paymentCallback.createMany({
+    data: [{ provider: "ROBOKASSA", invId: cb.invId, outSumRaw: cb.outSum, payload: cb.payload as any }],
+    skipDuplicates: true,
+  });
+  stats.received++;
+  if (inserted.count === 0) {
+    stats.duplicates++;
+    return false;
+  }
+  kickPaymentInbox();
+  return true;
+}
+
+async function claimCallbacks(prisma: PrismaClient, limit: number): Promise<ClaimedCallback[]> {
+  const leaseSec = Math.ceil(LEASE_MS() / 1000);
+  return prisma.$queryRaw<ClaimedCallback[]>`
+    UPDATE "PaymentCallback"
+    SET "attempts" = "attempts" + 1,
+        "runAfter" = now() + ${leaseSec}::int * interval '1 second',
+        "updatedAt" = now()
+    WHERE "id" IN (
+      SELECT "id" FROM "PaymentCallback"
+      WHERE "status" = 'QUEUED' AND "runAfter" <= now()
+      ORDER BY "runAfter"
+      LIMIT ${limit}
+      FOR UPDATE SKIP LOCKED
+    )
+    RETURNING "id", "invId", "outSumRaw", "payload", "attempts"
+  `;
+}
+
+async function processCallback(prisma: PrismaClient, cb: ClaimedCallback) {
+  try {
+    const result = await prisma.$transaction(async (tx) => {
+      const r = await applyRobokassaResult(tx, {
+        invId: BigInt(cb.invId),
+        outSum: cb.outSumRaw,
+        payload: cb.payload,
+        isTest: robokassaIsTest(),
+      });
+      await tx.paymentCallback.update({
+        where: { id: cb.id },
+        data: {
+          status: r === "paid" || r === "already_paid" ? "DONE" : "FAILED",
+          result: r,
+          processedAt: new Date(),
+        },
+      });
+      return r;
+    });
+
+    stats.processed++;
+    if (result === "paid") stats.paid++;
+    if (result === "not_found" || result === "bad_amount") {
+      stats.rejected++;
+      workerLogger?.warn?.({ invId: String(cb.invId), result }, "robokassa callback rejected");
+    }
+  } catch (err: any) {
+    const lastError = String(err?.code || err?.message || err).slice(0, 500);
+    workerLogger?.warn?.({ err, invId: String(cb.invId), attempts: cb.attempts }, "robokassa callback failed");
+
+    if (cb.attempts >= MAX_ATTEMPTS) {
+      stats.failed++;
+      await prisma.paymentCallback.update({
+        where: { id: cb.id },
+        data: { status: "FAILED", lastError, processedAt: new Date() },
+      });
+      return;
+    }
+    stats.retried++;
+    const delay = Math.min(RETRY_MAX_MS, RETRY_BASE_MS * 2 ** (cb.attempts - 1));
+    await prisma.paymentCallback.update({
+      where: { id: cb.id },
+      data: { lastError, runAfter: new Date(Date.now() + delay) },
+    });
+  }
+}
+
+async function processBatch(prisma: PrismaClient, batch: ClaimedCallback[]) {
+  let next = 0;
+  const workers = Array.from({ length: Math.min(CONCURRENCY(), batch.length) }, async () => {
+    while (next < batch.length) {
+      const cb = batch[next++];
+      await processCallback(prisma, cb).catch((err) =>
+        workerLogger?.error?.({ err, invId: String(cb.invId) }, "robokassa callback crashed")
+      );
+    }
+  });
+  await Promise.all(workers);
+}
+
+async function tick() {
+  const prisma = workerPrisma;
+  if (!prisma) return;
+  if (ticking) {
+    tickAgain = true;
+    return;
+  }
+  ticking = true;
+  try {
+    do {
+      tickAgain = false;
+      const batch = await claimCallbacks(prisma, BATCH());
+      if (batch.length === 0) break;
+      await processBatch(prisma, batch);
+      if (batch.length === BATCH()) tickAgain = true;
+    } while (tickAgain && workerPrisma);
+  } catch (err) {
+    workerLogger?.warn?.({ err }, "payment inbox poll failed");
+  } finally {
+    ticking = false;
+  }
+}
+
+// picks up a callback stored by this process without waiting for the next poll
+export function kickPaymentInbox() {
+  if (!workerPrisma) return;
+  tick().catch(() => {});
+}
+
+export function startPaymentInbox(prisma: PrismaClient, logger?: any) {
+  if (timer || !paymentInboxEnabled()) return;
+  workerPrisma = prisma;
+  workerLogger = logger ?? null;
+
+  timer = setInterval(() => kickPaymentInbox(), Math.max(50, POLL_MS()));
+  timer.unref();
+  kickPaymentInbox();
+}
+
+export function stopPaymentInbox() {
+  if (timer) clearInterval(timer);
+  timer = null;
+  workerPrisma = null;
+}
+
+export function paymentInboxStats() {
+  return { ...stats };
+}
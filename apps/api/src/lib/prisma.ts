@@ -1,3 +1,6 @@
 import { PrismaClient } from "@prisma/client";
+import { instrumentPrisma } from "./metrics";
 
-export const prisma = new PrismaClient();
\ No newline at end of file
+export const prisma = new PrismaClient();
+// latency histograms + per-request query accounting (see query-stats.ts)
+instrumentPrisma(prisma);
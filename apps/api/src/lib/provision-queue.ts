@@ -0,0 +1,367 @@
+import type { PrismaClient } from "@prisma/client";
+import { randomUUID } from "node:crypto";
+import { hostname } from "node:os";
+import { adjustActiveDevices } from "./entitlements";
+import { releaseAllowedIp } from "./ipAllocator";
+import { NodeUnavailableError } from "./node-breaker";
+import { getCachedNode } from "./node-cache";
+import { wgAddPeerBatched, wgRemovePeerBatched } from "./wg-batch";
+
+// Durable provisioning queue (ProvisionJob table).
+//
+// Provision in async mode reserves the peer row (revokedAt set, address taken)
+// and enqueues a job; the HTTP request returns 202 right away. Workers claim
+// jobs with FOR UPDATE SKIP LOCKED, so several API instances can share the
+// table, apply the peer on its node and activate it. A claimed job holds a
+// lease; if its worker dies, the job is picked up again after the lease expires.
+
+function numEnv(name: string, fallback: number): number {
+  const n = Number(process.env[name]);
+  return Number.isFinite(n) && n >= 0 ? n : fallback;
+}
+
+const POLL_MS = () => numEnv("PROVISION_QUEUE_POLL_MS", 500);
+const CONCURRENCY = () => Math.max(1, numEnv("PROVISION_QUEUE_CONCURRENCY", 16));
+const NODE_CONCURRENCY = () => Math.max(1, numEnv("PROVISION_QUEUE_NODE_CONCURRENCY", 4));
+const LEASE_MS = () => Math.max(1_000, numEnv("PROVISION_QUEUE_LEASE_MS", 120_000));
+// refunded retries (node unavailable) don't count as attempts; past this age the job fails anyway
+const MAX_AGE_MS = () => Math.max(1_000, numEnv("PROVISION_QUEUE_MAX_AGE_MS", 15 * 60_000));
+const RETRY_BASE_MS = 2_000;
+const RETRY_MAX_MS = 60_000;
+
+export function provisionAsyncByDefault(): boolean {
+  const v = (process.env.PROVISION_ASYNC ?? "0").trim().toLowerCase();
+  return v === "1" || v === "true";
+}
+
+function workerEnabled(): boolean {
+  const v = (process.env.PROVISION_QUEUE_WORKER ?? "1").trim().toLowerCase();
+  return v !== "0" && v !== "false";
+}
+
+// job cannot succeed on retry (peer gone or taken over, node removed)
+class PermanentJobError extends Error {
+  constructor(code: string) {
+    super(code);
+    this.name = "PermanentJobError";
+  }
+}
+
+type ClaimedJob = {
+  id: string;
+  peerId: string;
+  nodeId: string;
+  deviceId: string;
+  connectToken: string | null;
+  attempts: number;
+  maxAttempts: number;
+  createdAt: Date;
+};
+
+const workerId = `${hostname()}:${process.pid}:${randomUUID().slice(0, 8)}`;
+
+const stats = { enqueued: 0, claimed: 0, done: 0, retried: 0, failed: 0 };
+const runningByNode = new Map<string, number>();
+const nodeWaiters = new Map<string, Array<() => void>>();
+const inFlight = new Set<Promise<void>>();
+
+let timer: NodeJS.Timeout | null = null;
+let ticking = false;
+let tickAgain = false;
+let workerPrisma: PrismaClient | null = null;
+let workerLogger: any = null;
+
+export async function enqueueProvisionJob(
+  prisma: PrismaClient,
+  args: { peerId: string; nodeId: string; deviceId: string; connectToken?: string | null }
+) {
+  const job = await prisma.provisionJob.create({
+    data: {
+      peerId: args.peerId,
+      nodeId: args.nodeId,
+      deviceId: args.deviceId,
+      connectToken: args.connectToken ?? null,
+    },
+  });
+  stats.enqueued++;
+  kickProvisionWorker();
+  return job;
+}
+
+export function getProvisionJob(prisma: PrismaClient, id: string) {
+  return prisma.provisionJob.findUnique({ where: { id } });
+}
+
+// queued or running job of a device: repeat provisions join it instead of reserving another peer
+export function findPendingProvisionJob(prisma: PrismaClient, deviceId: string) {
+  return prisma.provisionJob.findFirst({
+    where: { deviceId, status: { in: ["QUEUED", "RUNNING"] } },
+    orderBy: { createdAt: "desc" },
+  });
+}
+
+export function findLatestTokenJob(prisma: PrismaClient, connectToken: string) {
+  return prisma.provisionJob.findFirst({
+    where: { connectToken },
+    orderBy: { createdAt: "desc" },
+  });
+}
+
+async function acquireNode(nodeId: string) {
+  const running = runningByNode.get(nodeId) ?? 0;
+  if (running < NODE_CONCURRENCY()) {
+    runningByNode.set(nodeId, running + 1);
+    return;
+  }
+  await new Promise<void>((resolve) => {
+    const list = nodeWaiters.get(nodeId) ?? [];
+    list.push(resolve);
+    nodeWaiters.set(nodeId, list);
+  });
+  runningByNode.set(nodeId, (runningByNode.get(nodeId) ?? 0) + 1);
+}
+
+function releaseNode(nodeId: string) {
+  const running = (runningByNode.get(nodeId) ?? 1) - 1;
+  if (running > 0) runningByNode.set(nodeId, running);
+  else runningByNode.delete(nodeId);
+
+  const list = nodeWaiters.get(nodeId);
+  const next = list?.shift();
+  if (list && list.length === 0) nodeWaiters.delete(nodeId);
+  if (next) next();
+}
+
+async function claimJobs(prisma: PrismaClient, limit: number): Promise<ClaimedJob[]> {
+  // saturated nodes are skipped so their backlog doesn't starve other nodes
+  const busyNodes = [...runningByNode.entries()]
+    .filter(([, n]) => n >= NODE_CONCURRENCY())
+    .map(([id]) => id);
+  const leaseSec = Math.ceil(LEASE_MS() / 1000);
+
+  return prisma.$queryRaw<ClaimedJob[]>`
+    UPDATE "ProvisionJob"
+    SET "status" = 'RUNNING', "lockedAt" = now(), "lockedBy" = ${workerId},
+        "attempts" = "attempts" + 1, "updatedAt" = now()
+    WHERE "id" IN (
+      SELECT "id" FROM "ProvisionJob"
+      WHERE (("status" = 'QUEUED' AND "runAfter" <= now())
+          OR ("status" = 'RUNNING' AND "lockedAt" < now() - ${leaseSec}::int * interval '1 second'))
+        AND NOT ("nodeId" = ANY(${busyNodes}::text[]))
+      ORDER BY "runAfter"
+      LIMIT ${limit}
+      FOR UPDATE SKIP LOCKED
+    )
+    RETURNING "id", "peerId", "nodeId", "deviceId", "connectToken", "attempts", "maxAttempts", "createdAt"
+  `;
+}
+
+async function completeJob(prisma: PrismaClient, job: ClaimedJob, userId: string) {
+  await prisma.$transaction(async (tx) => {
+    // lease lost to another worker: it owns the job now
+    const owned = await tx.provisionJob.updateMany({
+      where: { id: job.id, status: "RUNNING", lockedBy: workerId },
+      data: { status: "DONE", finishedAt: new Date(), lockedAt: null, lockedBy: null, lastError: null },
+    });
+    if (owned.count === 0) return;
+
+    const activated = await tx.peer.updateMany({
+      where: { id: job.peerId, deviceId: job.deviceId, revokedAt: { not: null } },
+      data: { revokedAt: null },
+    });
+    if (activated.count === 0) {
+      const peer = await tx.peer.findUnique({ where: { id: job.peerId } });
+      // already active (job re-run after a lost lease): nothing to count
+      if (peer?.deviceId !== job.deviceId) throw new PermanentJobError("PEER_REASSIGNED");
+    } else {
+      await adjustActiveDevices(tx, userId, 1);
+    }
+  });
+}
+
+// takes a key this job may have put on the node (this or an earlier attempt) off it again
+async function removeJobKey(prisma: PrismaClient, job: ClaimedJob, publicKey: string) {
+  // the key's row belongs to another device now: the key is theirs
+  const owner = await prisma.peer.findFirst({
+    where: { nodeId: job.nodeId, publicKey },
+    select: { deviceId: true },
+  });
+  if (owner && owner.deviceId !== job.deviceId) return true;
+
+  const node = await getCachedNode(prisma, job.nodeId);
+  if (!node) return true;
+  try {
+    await wgRemovePeerBatched({
+      publicKey,
+      node: { sshHost: node.sshHost, sshUser: node.sshUser, wgInterface: node.wgInterface },
+    });
+    return true;
+  } catch (err: any) {
+    const message = String(err?.stderr || err?.message || "");
+    if (/no such peer|not found/i.test(message)) return true;
+    workerLogger?.warn?.({ err, jobId: job.id }, "failed provision job: key not removed from node");
+    return false;
+  }
+}
+
+// appliedKey: the key this attempt added to the node (the peer row may have changed since)
+async function failJob(prisma: PrismaClient, job: ClaimedJob, reason: string, appliedKey?: string) {
+  const owned = await prisma.provisionJob.updateMany({
+    where: { id: job.id, status: "RUNNING", lockedBy: workerId },
+    data: { status: "FAILED", finishedAt: new Date(), lockedAt: null, lockedBy: null, lastError: reason },
+  });
+  if (owned.count === 0) return;
+  stats.failed++;
+
+  // the connect token was claimed when the job was enqueued: let the user tap it again
+  if (job.connectToken) {
+    await prisma.connectToken.updateMany({
+      where: { token: job.connectToken, usedAt: { not: null } },
+      data: { usedAt: null },
+    });
+  }
+
+  const peer = await prisma.peer.findUnique({ where: { id: job.peerId } });
+  const ours = peer && peer.deviceId === job.deviceId && peer.revokedAt !== null;
+
+  if (appliedKey && appliedKey !== (ours ? peer.publicKey : undefined)) await removeJobKey(prisma, job, appliedKey);
+  if (!ours) return;
+
+  // an earlier attempt may have applied the key before failing to activate it
+  const removed = await removeJobKey(prisma, job, peer.publicKey);
+
+  // the reserved row stays revoked; its address goes back to the pool only once the
+  // node no longer routes it to our key (otherwise reconcile-wg / a pool rebuild frees it)
+  await prisma.peer.update({ where: { id: peer.id }, data: { revokedAt: new Date() } });
+  if (removed) releaseAllowedIp(peer.nodeId, peer.allowedIp);
+}
+
+// refund: the node was never tried (breaker open / overloaded), the attempt doesn't count
+async function retryJob(prisma: PrismaClient, job: ClaimedJob, reason: string, refund = false) {
+  const delay = Math.min(RETRY_MAX_MS, RETRY_BASE_MS * 2 ** Math.max(0, job.attempts - 1));
+  const owned = await prisma.provisionJob.updateMany({
+    where: { id: job.id, status: "RUNNING", lockedBy: workerId },
+    data: {
+      ...(refund ? { attempts: { decrement: 1 } } : {}),
+      status: "QUEUED",
+      runAfter: new Date(Date.now() + delay),
+      lockedAt: null,
+      lockedBy: null,
+      lastError: reason,
+    },
+  });
+  if (owned.count > 0) stats.retried++;
+}
+
+async function runJob(prisma: PrismaClient, job: ClaimedJob) {
+  let appliedKey: string | undefined;
+  try {
+    // reclaimed after expired leases too many times
+    if (job.attempts > job.maxAttempts) throw new PermanentJobError("MAX_ATTEMPTS_EXCEEDED");
+
+    const peer = await prisma.peer.findUnique({ where: { id: job.peerId } });
+    if (!peer || peer.deviceId !== job.deviceId) throw new PermanentJobError("PEER_NOT_FOUND");
+
+    const node = await getCachedNode(prisma, job.nodeId);
+    if (!node) throw new PermanentJobError("NODE_NOT_FOUND");
+
+    await wgAddPeerBatched({
+      publicKey: peer.publicKey,
+      allowedIp: peer.allowedIp,
+      node: { sshHost: node.sshHost, sshUser: node.sshUser, wgInterface: node.wgInterface },
+    });
+    appliedKey = peer.publicKey;
+    await completeJob(prisma, job, peer.userId);
+    stats.done++;
+  } catch (err: any) {
+    const reason = err instanceof PermanentJobError ? err.message : String(err?.code || err?.message || err);
+    workerLogger?.warn?.({ err, jobId: job.id, attempts: job.attempts }, "provision job failed");
+
+    if (err instanceof NodeUnavailableError && Date.now() - job.createdAt.getTime() < MAX_AGE_MS()) {
+      await retryJob(prisma, job, err.code, true);
+    } else if (err instanceof NodeUnavailableError) {
+      // breaker stayed open for the whole window: give the peer and address back
+      await failJob(prisma, job, `${err.code}_TIMEOUT`, appliedKey);
+    } else if (err instanceof PermanentJobError || job.attempts >= job.maxAttempts) {
+      await failJob(prisma, job, reason, appliedKey);
+    } else {
+      await retryJob(prisma, job, reason);
+    }
+  }
+}
+
+function startJob(prisma: PrismaClient, job: ClaimedJob) {
+  const p = (async () => {
+    await acquireNode(job.nodeId);
+    try {
+      await runJob(prisma, job);
+    } finally {
+      releaseNode(job.nodeId);
+    }
+  })()
+    .catch((err) => workerLogger?.error?.({ err, jobId: job.id }, "provision job crashed"))
+    .finally(() => {
+      inFlight.delete(p);
+      kickProvisionWorker();
+    });
+  inFlight.add(p);
+}
+
+async function tick() {
+  const prisma = workerPrisma;
+  if (!prisma) return;
+  if (ticking) {
+    tickAgain = true;
+    return;
+  }
+  ticking = true;
+  try {
+    do {
+      tickAgain = false;
+      const free = CONCURRENCY() - inFlight.size;
+      if (free <= 0) break;
+
+      const jobs = await claimJobs(prisma, free);
+      stats.claimed += jobs.length;
+      for (const job of jobs) startJob(prisma, job);
+      if (jobs.length === free) tickAgain = true;
+    } while (tickAgain && workerPrisma);
+  } catch (err) {
+    workerLogger?.warn?.({ err }, "provision queue poll failed");
+  } finally {
+    ticking = false;
+  }
+}
+
+// picks up a job enqueued by this process without waiting for the next poll
+export function kickProvisionWorker() {
+  if (!workerPrisma) return;
+  tick().catch(() => {});
+}
+
+export function startProvisionWorker(prisma: PrismaClient, logger?: any) {
+  if (timer || !workerEnabled()) return;
+  workerPrisma = prisma;
+  workerLogger = logger ?? null;
+
+  timer = setInterval(() => kickProvisionWorker(), Math.max(50, POLL_MS()));
+  timer.unref();
+  kickProvisionWorker();
+}
+
+// stops claiming and waits for running jobs; unfinished leases are reclaimed by other workers
+export async function stopProvisionWorker() {
+  if (timer) clearInterval(timer);
+  timer = null;
+  workerPrisma = null;
+  await Promise.allSettled([...inFlight]);
+}
+
+export function provisionQueueStats() {
+  return {
+    workerId,
+    ...stats,
+    running: inFlight.size,
+    runningByNode: Object.fromEntries(runningByNode),
+  };
+}
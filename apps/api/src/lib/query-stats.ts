@@ -0,0 +1,109 @@
+import { AsyncLocalStorage } from "node:async_hooks";
+import type { FastifyInstance } from "fastify";
+
+// Per-request Prisma accounting. Every HTTP request runs inside an
+// AsyncLocalStorage context; the Prisma middleware (metrics.instrumentPrisma)
+// adds each query to it. Slow queries are logged with their route, requests
+// over the query budget are flagged when they finish.
+
+function numEnv(name: string, fallback: number): number {
+  const n = Number(process.env[name]);
+  return Number.isFinite(n) && n >= 0 ? n : fallback;
+}
+
+const SLOW_QUERY_MS = () => numEnv("PRISMA_SLOW_QUERY_MS", 200);
+// 0 disables the budget warning
+const QUERY_BUDGET = () => numEnv("PRISMA_QUERY_BUDGET", 15);
+const LOG_ALL = () => process.env.PRISMA_QUERY_LOG === "1";
+
+export type QueryContext = {
+  route: string;
+  method: string;
+  queries: number;
+  queryMs: number;
+  // "model.operation" -> count, to spot the repeated query in an N+1
+  byQuery: Map<string, number>;
+  log: any;
+};
+
+const storage = new AsyncLocalStorage<QueryContext>();
+let fallbackLogger: any = null;
+
+const stats = { queries: 0, slowQueries: 0, overBudgetRequests: 0 };
+
+// logger for slow queries outside a request (workers, pollers)
+export function setQueryLogger(logger: any) {
+  fallbackLogger = logger;
+}
+
+export function currentQueryContext(): QueryContext | undefined {
+  return storage.getStore();
+}
+
+export function recordQuery(model: string, operation: string, ms: number) {
+  stats.queries++;
+  const ctx = storage.getStore();
+  const name = `${model}.${operation}`;
+
+  if (ctx) {
+    ctx.queries++;
+    ctx.queryMs += ms;
+    ctx.byQuery.set(name, (ctx.byQuery.get(name) ?? 0) + 1);
+  }
+
+  if (ms >= SLOW_QUERY_MS()) {
+    stats.slowQueries++;
+    const log = ctx?.log ?? fallbackLogger;
+    log?.warn?.(
+      { query: name, ms: Math.round(ms), route: ctx ? `${ctx.method} ${ctx.route}` : null },
+      "slow prisma query"
+    );
+  }
+}
+
+function topQueries(byQuery: Map<string, number>) {
+  return [...byQuery.entries()]
+    .sort((a, b) => b[1] - a[1])
+    .slice(0, 5)
+    .map(([query, count]) => ({ query, count }));
+}
+
+export function instrumentRequests(app: FastifyInstance) {
+  // callback-style hook: the rest of the request runs inside storage.run()
+  app.addHook("onRequest", (req: any, _reply, done) => {
+    const ctx: QueryContext = {
+      route: req.routeOptions?.url ?? "unmatched",
+      method: req.method,
+      queries: 0,
+      queryMs: 0,
+      byQuery: new Map(),
+      log: req.log,
+    };
+    req.queryContext = ctx;
+    storage.run(ctx, done);
+  });
+
+  app.addHook("onResponse", async (req: any, reply) => {
+    const ctx: QueryContext | undefined = req.queryContext;
+    if (!ctx || ctx.queries === 0) return;
+
+    const summary = {
+      route: `${ctx.method} ${ctx.route}`,
+      statusCode: reply.statusCode,
+      queries: ctx.queries,
+      queryMs: Math.round(ctx.queryMs),
+    };
+
+    const budget = QUERY_BUDGET();
+    if (budget > 0 && ctx.queries > budget) {
+      stats.overBudgetRequests++;
+      req.log.warn({ ...summary, budget, top: topQueries(ctx.byQuery) }, "request over prisma query budget");
+    } else if (LOG_ALL()) {
+      req.log.info(summary, "prisma queries");
+    }
+  });
+}
+
+export function queryStats() {
+  return { ...stats };
+}
@@ -2,6 +2,11 @@ import crypto from "node:crypto";
 
 export type RoboHashAlg = "MD5" | "SHA256";
 
+export function robokassaIsTest(): boolean {
+  const v = (process.env.ROBOKASSA_IS_TEST ?? "1").trim().toLowerCase();
+  return v === "1" || v === "true";
+}
+
 export function formatOutSum(amountKopeks: number, isTest: boolean): string {
   if (amountKopeks < 0) throw new Error("amountKopeks must be >= 0");
   const rub = Math.floor(amountKopeks / 100);
@@ -0,0 +1,318 @@
+import { execFile } from "node:child_process";
+import { createHash } from "node:crypto";
+import { tmpdir } from "node:os";
+import path from "node:path";
+import { promisify } from "node:util";
+
+const execFileAsync = promisify(execFile);
+
+// Persistent, multiplexed SSH sessions per node (OpenSSH ControlMaster).
+//
+// The first command for a node starts a background master connection
+// (`ssh -M -N -f`), every following command rides it over the control socket,
+// so we pay TCP + key exchange once per node instead of once per wg call.
+// If the master dies, ssh transparently falls back to a direct connection
+// and the next health check / exec restarts the master.
+// A call's timeout covers the master start too: the start gets at most
+// WG_NODE_SSH_MASTER_TIMEOUT_MS of it, the command the rest. A master that
+// fails to connect fails the calls waiting on it as a transport error (the
+// node breaker counts it) instead of paying a second handshake.
+
+const DEFAULT_TIMEOUT_MS = 30_000;
+const DEFAULT_MAX_BUFFER = 10 * 1024 * 1024;
+
+function numEnv(name: string, fallback: number): number {
+  const n = Number(process.env[name]);
+  return Number.isFinite(n) && n >= 0 ? n : fallback;
+}
+
+function poolEnabled(): boolean {
+  const v = (process.env.WG_NODE_SSH_POOL ?? "1").trim().toLowerCase();
+  return v !== "0" && v !== "false";
+}
+
+// sshd MaxSessions defaults to 10 channels per connection; keep headroom.
+const MAX_SESSIONS = () => Math.max(1, numEnv("WG_NODE_SSH_MAX_SESSIONS", 8));
+const IDLE_MS = () => numEnv("WG_NODE_SSH_IDLE_MS", 5 * 60_000);
+const HEALTH_INTERVAL_MS = () => numEnv("WG_NODE_SSH_HEALTH_MS", 30_000);
+const MASTER_RETRY_MS = 15_000;
+const MASTER_TIMEOUT_MS = () => Math.max(1_000, numEnv("WG_NODE_SSH_MASTER_TIMEOUT_MS", 10_000));
+const CONTROL_DIR = () => process.env.WG_NODE_SSH_CONTROL_DIR || tmpdir();
+
+export type SshTarget = {
+  host: string;
+  user: string;
+  args?: string[]; // extra ssh args placed before user@host (-o ..., -i ..., -p ...)
+};
+
+export type SshExecResult = { stdout: string; stderr: string };
+
+type MasterStart = { up: boolean; err: unknown };
+
+// the node did not answer: ssh exits with 255 on connection errors, execFile sets
+// `killed` on timeout (node-breaker counts only these)
+export function isSshTransportError(err: any): boolean {
+  return err?.code === 255 || err?.killed === true || err?.code === "ETIMEDOUT";
+}
+
+export type SshPoolStats = {
+  key: string;
+  masterUp: boolean;
+  inFlight: number;
+  queued: number;
+  maxSessions: number;
+  execs: number;
+  failures: number;
+  masterStarts: number;
+  masterFailures: number;
+  healthChecks: number;
+  healthFailures: number;
+  totalExecMs: number;
+  lastUsedAt: number;
+};
+
+class NodeSshPool {
+  readonly key: string;
+  readonly destination: string;
+  readonly baseArgs: string[];
+  readonly controlPath: string;
+
+  masterUp = false;
+  private starting: Promise<MasterStart> | null = null;
+  private nextMasterAttemptAt = 0;
+  private inFlight = 0;
+  private waiters: Array<() => void> = [];
+  lastUsedAt = Date.now();
+
+  execs = 0;
+  failures = 0;
+  masterStarts = 0;
+  masterFailures = 0;
+  healthChecks = 0;
+  healthFailures = 0;
+  totalExecMs = 0;
+
+  constructor(key: string, target: SshTarget) {
+    this.key = key;
+    this.destination = `${target.user}@${target.host}`;
+    this.baseArgs = target.args ?? [];
+    // unix socket paths are limited to ~104 bytes, keep the name short
+    const digest = createHash("sha1").update(key).digest("hex").slice(0, 16);
+    this.controlPath = path.join(CONTROL_DIR(), `cg-ssh-${digest}`);
+  }
+
+  private controlArgs(master: "yes" | "no"): string[] {
+    return ["-o", `ControlMaster=${master}`, "-o", `ControlPath=${this.controlPath}`];
+  }
+
+  private controlCommandArgs(op: "check" | "exit"): string[] {
+    return [...this.baseArgs, ...this.controlArgs("no"), "-O", op, this.destination];
+  }
+
+  private async acquire() {
+    if (this.inFlight < MAX_SESSIONS()) {
+      this.inFlight++;
+      return;
+    }
+    await new Promise<void>((resolve) => this.waiters.push(resolve));
+    this.inFlight++;
+  }
+
+  private release() {
+    this.inFlight--;
+    const next = this.waiters.shift();
+    if (next) next();
+  }
+
+  private async ensureMaster(timeoutMs: number): Promise<MasterStart> {
+    if (this.masterUp) return { up: true, err: null };
+    // node is failing to accept a master: don't add a second handshake to every call
+    if (!this.starting && Date.now() < this.nextMasterAttemptAt) return { up: false, err: null };
+    if (!this.starting) {
+      this.starting = this.startMaster(Math.min(timeoutMs, MASTER_TIMEOUT_MS())).finally(() => {
+        this.starting = null;
+      });
+    }
+    return this.starting;
+  }
+
+  private async startMaster(timeoutMs: number): Promise<MasterStart> {
+    // ControlPersist is a safety net: an orphaned master exits on its own once idle.
+    const persistSec = Math.max(1, Math.ceil(IDLE_MS() / 1000) * 2);
+    const args = [
+      ...this.baseArgs,
+      ...this.controlArgs("yes"),
+      "-o", `ControlPersist=${persistSec}s`,
+      "-N", "-f",
+      this.destination,
+    ];
+
+    try {
+      await execFileAsync("ssh", args, { timeout: timeoutMs });
+      this.masterStarts++;
+      this.masterUp = true;
+      return { up: true, err: null };
+    } catch (err) {
+      // other failures are not fatal: commands still run over a direct connection
+      this.masterFailures++;
+      this.masterUp = false;
+      this.nextMasterAttemptAt = Date.now() + MASTER_RETRY_MS;
+      return { up: false, err };
+    }
+  }
+
+  async exec(cmd: string, opts: { timeoutMs: number; maxBuffer: number }): Promise<SshExecResult> {
+    const calledAt = Date.now();
+    this.lastUsedAt = calledAt;
+    const master = await this.ensureMaster(opts.timeoutMs);
+    // unreachable node: this call fails now, the breaker sees a transport error
+    if (!master.up && isSshTransportError(master.err)) {
+      this.failures++;
+      throw master.err;
+    }
+    await this.acquire();
+
+    const startedAt = Date.now();
+    try {
+      // master start and the wait for a session slot come out of the same budget
+      const remainingMs = opts.timeoutMs - (startedAt - calledAt);
+      if (remainingMs <= 0) {
+        throw Object.assign(new Error(`ssh ${this.destination}: timed out before the command started`), {
+          code: "ETIMEDOUT",
+        });
+      }
+      const args = [...this.baseArgs, ...this.controlArgs("no"), this.destination, cmd];
+      const { stdout, stderr } = await execFileAsync("ssh", args, {
+        timeout: remainingMs,
+        maxBuffer: opts.maxBuffer,
+      });
+      return { stdout: String(stdout ?? ""), stderr: String(stderr ?? "") };
+    } catch (err) {
+      this.failures++;
+      throw err;
+    } finally {
+      this.execs++;
+      this.totalExecMs += Date.now() - startedAt;
+      this.lastUsedAt = Date.now();
+      this.release();
+    }
+  }
+
+  async check(): Promise<boolean> {
+    this.healthChecks++;
+    try {
+      await execFileAsync("ssh", this.controlCommandArgs("check"), { timeout: 5_000 });
+      this.masterUp = true;
+    } catch {
+      this.healthFailures++;
+      this.masterUp = false;
+    }
+    return this.masterUp;
+  }
+
+  async close() {
+    this.masterUp = false;
+    try {
+      await execFileAsync("ssh", this.controlCommandArgs("exit"), { timeout: 5_000 });
+    } catch {
+      // master already gone
+    }
+  }
+
+  isIdle(now: number) {
+    return this.inFlight === 0 && this.waiters.length === 0 && now - this.lastUsedAt > IDLE_MS();
+  }
+
+  stats(): SshPoolStats {
+    return {
+      key: this.key,
+      masterUp: this.masterUp,
+      inFlight: this.inFlight,
+      queued: this.waiters.length,
+      maxSessions: MAX_SESSIONS(),
+      execs: this.execs,
+      failures: this.failures,
+      masterStarts: this.masterStarts,
+      masterFailures: this.masterFailures,
+      healthChecks: this.healthChecks,
+      healthFailures: this.healthFailures,
+      totalExecMs: this.totalExecMs,
+      lastUsedAt: this.lastUsedAt,
+    };
+  }
+}
+
+const pools = new Map<string, NodeSshPool>();
+let evictedPools = 0;
+let maintenanceTimer: NodeJS.Timeout | null = null;
+
+function poolKey(target: SshTarget) {
+  return `${target.user}@${target.host} ${(target.args ?? []).join(" ")}`.trim();
+}
+
+function getPool(target: SshTarget): NodeSshPool {
+  const key = poolKey(target);
+  let pool = pools.get(key);
+  if (!pool) {
+    pool = new NodeSshPool(key, target);
+    pools.set(key, pool);
+    startMaintenance();
+  }
+  return pool;
+}
+
+async function maintain() {
+  const now = Date.now();
+  for (const [key, pool] of pools) {
+    if (pool.isIdle(now)) {
+      pools.delete(key);
+      evictedPools++;
+      await pool.close();
+      continue;
+    }
+    if (pool.masterUp) await pool.check();
+  }
+  if (pools.size === 0) stopMaintenance();
+}
+
+function startMaintenance() {
+  if (maintenanceTimer || HEALTH_INTERVAL_MS() === 0) return;
+  maintenanceTimer = setInterval(() => {
+    maintain().catch(() => {});
+  }, HEALTH_INTERVAL_MS());
+  maintenanceTimer.unref();
+}
+
+function stopMaintenance() {
+  if (!maintenanceTimer) return;
+  clearInterval(maintenanceTimer);
+  maintenanceTimer = null;
+}
+
+export async function sshPoolExec(
+  target: SshTarget,
+  cmd: string,
+  opts: { timeoutMs?: number; maxBuffer?: number } = {}
+): Promise<SshExecResult> {
+  const timeoutMs = opts.timeoutMs ?? DEFAULT_TIMEOUT_MS;
+  const maxBuffer = opts.maxBuffer ?? DEFAULT_MAX_BUFFER;
+
+  if (!poolEnabled()) {
+    const args = [...(target.args ?? []), `${target.user}@${target.host}`, cmd];
+    const { stdout, stderr } = await execFileAsync("ssh", args, { timeout: timeoutMs, maxBuffer });
+    return { stdout: String(stdout ?? ""), stderr: String(stderr ?? "") };
+  }
+
+  return getPool(target).exec(cmd, { timeoutMs, maxBuffer });
+}
+
+export function sshPoolStats(): { pools: SshPoolStats[]; evictedPools: number } {
+  return { pools: [...pools.values()].map((p) => p.stats()), evictedPools };
+}
+
+export async function closeSshPools() {
+  stopMaintenance();
+  const all = [...pools.values()];
+  pools.clear();
+  await Promise.all(all.map((p) => p.close()));
+}
@@ -1,7 +1,4 @@
-import { execFile } from "node:child_process";
-import { promisify } from "node:util";
-
-const execFileAsync = promisify(execFile);
+import { sshPoolExec } from "./ssh-pool";
 
 export async function sshExec(params: {
   host: string;
@@ -17,13 +14,8 @@ export async function sshExec(params: {
     args.push(...params.sshOpts.trim().split(/\s+/g));
   }
 
-  args.push(`${params.user}@${params.host}`);
-  args.push(params.cmd);
-
-  const { stdout, stderr } = await execFileAsync("ssh", args, {
-    timeout: params.timeoutMs ?? 30_000,
+  return sshPoolExec({ host: params.host, user: params.user, args }, params.cmd, {
+    timeoutMs: params.timeoutMs ?? 30_000,
     maxBuffer: 10 * 1024 * 1024,
   });
-
-  return { stdout: stdout ?? "", stderr: stderr ?? "" };
 }
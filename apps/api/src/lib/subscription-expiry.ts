@@ -0,0 +1,245 @@
+import type { PrismaClient } from "@prisma/client";
+import { invalidatePeerConfigs } from "./config-cache";
+import { invalidateEntitlement } from "./entitlements";
+import { releaseAllowedIp } from "./ipAllocator";
+import { subscriptionExpiryDuration } from "./metrics";
+import { getCachedNode } from "./node-cache";
+import { wgApplyPeerOps } from "./wg-node";
+
+// Revokes access of subscriptions whose activeUntil has passed.
+//
+// Per batch (Subscription_status_activeUntil_idx, oldest first):
+// one transaction claims up to SUB_EXPIRY_BATCH ACTIVE rows with FOR UPDATE
+// SKIP LOCKED and marks them EXPIRED, marks all active peers of those users
+// revoked (UPDATE ... RETURNING) and zeroes their entitlements. After commit the
+// peers are removed with one `wg set` per node. A renewal that commits first
+// moves activeUntil forward and the row no longer matches; one that waits on the
+// claim lock renews an EXPIRED row as usual (the user provisions again).
+// A node that cannot be reached keeps its peers until reconcile-wg removes them
+// (the DB already says revoked).
+//
+// SUB_EXPIRY_DRY_RUN=1 only reads: logs and counts what a run would expire.
+
+function numEnv(name: string, fallback: number): number {
+  const n = Number(process.env[name]);
+  return Number.isFinite(n) && n >= 0 ? n : fallback;
+}
+
+// 0 disables the sweeper
+const INTERVAL_MS = () => numEnv("SUB_EXPIRY_INTERVAL_MS", 60_000);
+const BATCH = () => Math.max(1, numEnv("SUB_EXPIRY_BATCH", 200));
+// per run; the rest waits for the next tick
+const MAX_BATCHES = () => Math.max(1, numEnv("SUB_EXPIRY_MAX_BATCHES", 50));
+
+export function subscriptionExpiryDryRun(): boolean {
+  const v = (process.env.SUB_EXPIRY_DRY_RUN ?? "0").trim().toLowerCase();
+  return v === "1" || v === "true";
+}
+
+type RevokedPeer = { id: string; userId: string; nodeId: string; publicKey: string; allowedIp: string };
+
+let timer: NodeJS.Timeout | null = null;
+let running = false;
+
+const stats = {
+  runs: 0,
+  batches: 0,
+  subscriptionsExpired: 0,
+  peersRevoked: 0,
+  nodeCalls: 0,
+  nodeFailures: 0,
+  dryRunSubscriptions: 0,
+  dryRunPeers: 0,
+  errors: 0,
+  lastRunAt: null as string | null,
+  lastRunMs: 0,
+  // subscriptions expired per second of the last run that found any
+  lastRate: 0,
+};
+
+function groupByNode(peers: RevokedPeer[]) {
+  const out = new Map<string, RevokedPeer[]>();
+  for (const p of peers) {
+    const list = out.get(p.nodeId);
+    if (list) list.push(p);
+    else out.set(p.nodeId, [p]);
+  }
+  return out;
+}
+
+async function claimBatch(prisma: PrismaClient, limit: number) {
+  return prisma.$transaction(async (tx) => {
+    const subs = await tx.$queryRaw<{ userId: string }[]>`
+      UPDATE "Subscription"
+      SET "status" = 'EXPIRED', "updatedAt" = now()
+      WHERE "id" IN (
+        SELECT "id" FROM "Subscription"
+        WHERE "status" = 'ACTIVE' AND "activeUntil" <= now()
+        ORDER BY "activeUntil"
+        LIMIT ${limit}
+        FOR UPDATE SKIP LOCKED
+      )
+      RETURNING "userId"
+    `;
+    if (subs.length === 0) return { userIds: [] as string[], peers: [] as RevokedPeer[] };
+
+    const userIds = subs.map((s) => s.userId);
+    const peers = await tx.$queryRaw<RevokedPeer[]>`
+      UPDATE "Peer"
+      SET "revokedAt" = now()
+      WHERE "userId" = ANY(${userIds}::text[]) AND "revokedAt" IS NULL
+      RETURNING "id", "userId", "nodeId", "publicKey", "allowedIp"
+    `;
+    // every active peer of these users is revoked above; users without a row are backfilled on read
+    await tx.entitlement.updateMany({
+      where: { userId: { in: userIds } },
+      data: { status: "EXPIRED", activeDevices: 0 },
+    });
+    return { userIds, peers };
+  });
+}
+
+// one `wg set` per node; true when the node no longer lists any of the keys
+async function removeFromNode(prisma: PrismaClient, nodeId: string, peers: RevokedPeer[], logger?: any) {
+  stats.nodeCalls++;
+  try {
+    const node = await getCachedNode(prisma, nodeId);
+    if (!node) throw new Error(`node ${nodeId} not found`);
+
+    const left = await wgApplyPeerOps({
+      node: { sshHost: node.sshHost, sshUser: node.sshUser, wgInterface: node.wgInterface },
+      ops: peers.map((p) => ({ kind: "remove" as const, publicKey: p.publicKey })),
+    });
+    if (left.size > 0) throw new Error(`${left.size} peers still present after remove`);
+
+    for (const p of peers) releaseAllowedIp(nodeId, p.allowedIp);
+    return true;
+  } catch (err) {
+    // revoked in the DB already; reconcile-wg removes the leftovers
+    stats.nodeFailures++;
+    logger?.warn?.({ err, nodeId, peers: peers.length }, "expired peers not removed from node");
+    return false;
+  }
+}
+
+async function expireBatch(prisma: PrismaClient, logger?: any) {
+  const { userIds, peers } = await subscriptionExpiryDuration.time({ phase: "db" }, () =>
+    claimBatch(prisma, BATCH())
+  );
+  for (const userId of userIds) invalidateEntitlement(userId);
+  for (const p of peers) invalidatePeerConfigs(p.id);
+
+  if (peers.length > 0) {
+    await subscriptionExpiryDuration.time({ phase: "nodes" }, () =>
+      Promise.all([...groupByNode(peers)].map(([nodeId, list]) => removeFromNode(prisma, nodeId, list, logger)))
+    );
+  }
+
+  stats.batches++;
+  stats.subscriptionsExpired += userIds.length;
+  stats.peersRevoked += peers.length;
+  return { subscriptions: userIds.length, peers: peers.length };
+}
+
+// read-only pass over the same rows, keyset-paginated since nothing changes
+async function dryRunBatches(prisma: PrismaClient, logger?: any) {
+  let total = { subscriptions: 0, peers: 0 };
+  let after: { activeUntil: Date; id: string } | null = null;
+
+  for (let i = 0; i < MAX_BATCHES(); i++) {
+    const subs: { id: string; userId: string; activeUntil: Date }[] = await prisma.subscription.findMany({
+      where: {
+        status: "ACTIVE",
+        activeUntil: { lte: new Date() },
+        ...(after
+          ? { OR: [{ activeUntil: { gt: after.activeUntil } }, { activeUntil: after.activeUntil, id: { gt: after.id } }] }
+          : {}),
+      },
+      orderBy: [{ activeUntil: "asc" }, { id: "asc" }],
+      take: BATCH(),
+      select: { id: true, userId: true, activeUntil: true },
+    });
+    if (subs.length === 0) break;
+
+    const perNode = await prisma.peer.groupBy({
+      by: ["nodeId"],
+      where: { userId: { in: subs.map((s) => s.userId) }, revokedAt: null },
+      _count: { _all: true },
+    });
+    const peers = perNode.reduce((n, r) => n + r._count._all, 0);
+    logger?.info?.(
+      {
+        subscriptions: subs.length,
+        peers,
+        nodes: Object.fromEntries(perNode.map((r) => [r.nodeId, r._count._all])),
+        oldest: subs[0].activeUntil,
+      },
+      "subscription expiry dry run: would expire"
+    );
+
+    stats.batches++;
+    total = { subscriptions: total.subscriptions + subs.length, peers: total.peers + peers };
+    if (subs.length < BATCH()) break;
+    after = subs[subs.length - 1];
+  }
+
+  stats.dryRunSubscriptions += total.subscriptions;
+  stats.dryRunPeers += total.peers;
+  return total;
+}
+
+export async function expireSubscriptions(prisma: PrismaClient, logger?: any) {
+  const startedAt = performance.now();
+  const dryRun = subscriptionExpiryDryRun();
+  let total = { subscriptions: 0, peers: 0 };
+
+  if (dryRun) {
+    total = await dryRunBatches(prisma, logger);
+  } else {
+    for (let i = 0; i < MAX_BATCHES(); i++) {
+      const r = await expireBatch(prisma, logger);
+      total = { subscriptions: total.subscriptions + r.subscriptions, peers: total.peers + r.peers };
+      if (r.subscriptions < BATCH()) break;
+    }
+  }
+
+  const ms = performance.now() - startedAt;
+  stats.runs++;
+  stats.lastRunAt = new Date().toISOString();
+  stats.lastRunMs = Math.round(ms);
+  if (total.subscriptions > 0 && !dryRun) stats.lastRate = Math.round((total.subscriptions / ms) * 1000);
+  return { ...total, dryRun, ms: Math.round(ms) };
+}
+
+export function startSubscriptionExpiry(prisma: PrismaClient, logger?: any) {
+  const interval = INTERVAL_MS();
+  if (timer || interval === 0) return;
+
+  const tick = () => {
+    if (running) return;
+    running = true;
+    expireSubscriptions(prisma, logger)
+      .then((r) => {
+        if (r.subscriptions > 0 && !r.dryRun) logger?.info?.(r, "expired subscriptions revoked");
+      })
+      .catch((err) => {
+        stats.errors++;
+        logger?.warn?.({ err }, "subscription expiry failed");
+      })
+      .finally(() => {
+        running = false;
+      });
+  };
+  timer = setInterval(tick, interval);
+  timer.unref();
+}
+
+export function stopSubscriptionExpiry() {
+  if (!timer) return;
+  clearInterval(timer);
+  timer = null;
+}
+
+export function subscriptionExpiryStats() {
+  return { ...stats };
+}
@@ -0,0 +1,108 @@
+import type { PrismaClient } from "@prisma/client";
+
+// Deletes connect/magic tokens that expired or were used more than
+// TOKEN_RETENTION_MS ago.
+// Small batches (DELETE ... WHERE pk IN (SELECT ... LIMIT n)) keep each statement
+// short; SKIP LOCKED lets several API replicas sweep at once without waiting on
+// each other. Both tables have indexes on expiresAt and usedAt.
+
+function numEnv(name: string, fallback: number): number {
+  const n = Number(process.env[name]);
+  return Number.isFinite(n) && n >= 0 ? n : fallback;
+}
+
+// 0 disables the sweeper
+const INTERVAL_MS = () => numEnv("TOKEN_SWEEP_INTERVAL_MS", 10 * 60_000);
+const RETENTION_MS = () => numEnv("TOKEN_RETENTION_MS", 7 * 24 * 60 * 60_000);
+const BATCH = () => Math.max(1, numEnv("TOKEN_SWEEP_BATCH", 1_000));
+// per table and run; the rest waits for the next tick
+const MAX_BATCHES = () => Math.max(1, numEnv("TOKEN_SWEEP_MAX_BATCHES", 50));
+
+let timer: NodeJS.Timeout | null = null;
+let running = false;
+
+const stats = {
+  runs: 0,
+  connectDeleted: 0,
+  magicDeleted: 0,
+  errors: 0,
+  lastRunAt: null as string | null,
+};
+
+async function sweepConnectTokens(prisma: PrismaClient, cutoff: Date) {
+  let total = 0;
+  for (let i = 0; i < MAX_BATCHES(); i++) {
+    const n = await prisma.$executeRaw`
+      DELETE FROM "ConnectToken"
+      WHERE "token" IN (
+        SELECT "token" FROM "ConnectToken"
+        WHERE "expiresAt" < ${cutoff} OR "usedAt" < ${cutoff}
+        LIMIT ${BATCH()}
+        FOR UPDATE SKIP LOCKED
+      )`;
+    total += n;
+    if (n < BATCH()) break;
+  }
+  return total;
+}
+
+async function sweepMagicTokens(prisma: PrismaClient, cutoff: Date) {
+  let total = 0;
+  for (let i = 0; i < MAX_BATCHES(); i++) {
+    const n = await prisma.$executeRaw`
+      DELETE FROM "MagicToken"
+      WHERE "tokenHash" IN (
+        SELECT "tokenHash" FROM "MagicToken"
+        WHERE "expiresAt" < ${cutoff} OR "usedAt" < ${cutoff}
+        LIMIT ${BATCH()}
+        FOR UPDATE SKIP LOCKED
+      )`;
+    total += n;
+    if (n < BATCH()) break;
+  }
+  return total;
+}
+
+export async function sweepExpiredTokens(prisma: PrismaClient) {
+  const cutoff = new Date(Date.now() - RETENTION_MS());
+  const connect = await sweepConnectTokens(prisma, cutoff);
+  const magic = await sweepMagicTokens(prisma, cutoff);
+  stats.runs++;
+  stats.connectDeleted += connect;
+  stats.magicDeleted += magic;
+  stats.lastRunAt = new Date().toISOString();
+  return { connect, magic };
+}
+
+export function startTokenSweeper(prisma: PrismaClient, logger?: any) {
+  const interval = INTERVAL_MS();
+  if (timer || interval === 0) return;
+
+  const tick = () => {
+    if (running) return;
+    running = true;
+    sweepExpiredTokens(prisma)
+      .then((deleted) => {
+        if (deleted.connect || deleted.magic) logger?.info?.(deleted, "expired and used tokens swept");
+      })
+      .catch((err) => {
+        stats.errors++;
+        logger?.warn?.({ err }, "token sweep failed");
+      })
+      .finally(() => {
+        running = false;
+      });
+  };
+  timer = setInterval(tick, interval);
+  timer.unref();
+}
+
+export function stopTokenSweeper() {
+  if (!timer) return;
+  clearInterval(timer);
+  timer = null;
+}
+
+export function tokenSweeperStats() {
+  return { ...stats };
+}
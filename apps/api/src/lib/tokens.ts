@@ -1,4 +1,5 @@
 import crypto from "crypto";
+import type { PrismaClient } from "@prisma/client";
 
 export function genToken(bytes = 32) {
   return crypto.randomBytes(bytes).toString("hex");
@@ -6,4 +7,60 @@ export function genToken(bytes = 32) {
 
 export function sha256(input: string) {
   return crypto.createHash("sha256").update(input).digest("hex");
-}
\ No newline at end of file
+}
+
+// Single-statement token claims: the conditions are checked by the UPDATE itself,
+// so two concurrent taps cannot both pass, and the happy path is one round trip.
+
+export type ClaimedConnectToken = {
+  token: string;
+  userId: string;
+  deviceId: string;
+  expiresAt: Date;
+  usedAt: Date;
+};
+
+export type TokenClaimFailure = "not_found" | "expired" | "used";
+
+export async function claimConnectToken(
+  prisma: PrismaClient,
+  token: string
+): Promise<ClaimedConnectToken | TokenClaimFailure> {
+  const rows = await prisma.$queryRaw<ClaimedConnectToken[]>`
+    UPDATE "ConnectToken" SET "usedAt" = date_trunc('milliseconds', now())
+    WHERE "token" = ${token} AND "usedAt" IS NULL AND "expiresAt" > now()
+    RETURNING "token", "userId", "deviceId", "expiresAt", "usedAt"
+  `;
+  if (rows[0]) return rows[0];
+
+  // failure path only: tell the caller why
+  const record = await prisma.connectToken.findUnique({ where: { token } });
+  if (!record) return "not_found";
+  return record.expiresAt <= new Date() ? "expired" : "used";
+}
+
+// provisioning failed after the claim: the token can be tapped again.
+// Matching on usedAt (truncated to ms above so it survives the JS Date round trip)
+// keeps a late release from undoing someone else's newer claim.
+export async function releaseConnectToken(prisma: PrismaClient, token: string, claimedAt: Date) {
+  await prisma.connectToken.updateMany({
+    where: { token, usedAt: claimedAt },
+    data: { usedAt: null },
+  });
+}
+
+export async function claimMagicToken(
+  prisma: PrismaClient,
+  tokenHash: string
+): Promise<{ email: string } | TokenClaimFailure> {
+  const rows = await prisma.$queryRaw<{ email: string }[]>`
+    UPDATE "MagicToken" SET "usedAt" = now()
+    WHERE "tokenHash" = ${tokenHash} AND "usedAt" IS NULL AND "expiresAt" > now()
+    RETURNING "email"
+  `;
+  if (rows[0]) return rows[0];
+
+  const record = await prisma.magicToken.findUnique({ where: { tokenHash } });
+  if (!record) return "not_found";
+  return record.usedAt ? "used" : "expired";
+}
@@ -0,0 +1,389 @@
+import { Prisma, type PrismaClient } from "@prisma/client";
+import type { PeerStats } from "./wg-stats";
+
+// Per-peer traffic accounting.
+//
+// Ingest: after every successful poll (lib/wg-stats.ts) the transfer counters of
+// a node are compared with PeerTrafficCursor (last counters per key, in the DB so
+// restarts and several API replicas do not double count; a per-node advisory
+// lock orders concurrent ingests) and the deltas are added to MINUTE rows of
+// PeerTraffic. The first sample of a key only sets its baseline; a counter that
+// went down (interface or peer re-created) counts from zero.
+//
+// Rollup: a worker folds closed hours of MINUTE rows into HOUR rows and closed
+// days of HOUR rows into DAY rows, moving a watermark per resolution
+// (TrafficRollup), then prunes fine rows that are rolled up and past retention.
+// Usage queries read DAY rows for whole rolled-up days, HOUR rows for whole hours
+// and MINUTE rows only for the edges and the not yet rolled-up tail.
+
+function numEnv(name: string, fallback: number): number {
+  const n = Number(process.env[name]);
+  return Number.isFinite(n) && n >= 0 ? n : fallback;
+}
+
+const HOUR_MS = 60 * 60_000;
+const DAY_MS = 24 * HOUR_MS;
+
+// 0 disables the rollup worker (ingest still writes MINUTE rows)
+const ROLLUP_INTERVAL_MS = () => numEnv("TRAFFIC_ROLLUP_INTERVAL_MS", 5 * 60_000);
+// an hour is rolled up this long after it ended (ingest of its last polls)
+const ROLLUP_GRACE_MS = () => numEnv("TRAFFIC_ROLLUP_GRACE_MS", 5 * 60_000);
+const MINUTE_RETENTION_MS = () => numEnv("TRAFFIC_MINUTE_RETENTION_MS", 2 * DAY_MS);
+const HOUR_RETENTION_MS = () => numEnv("TRAFFIC_HOUR_RETENTION_MS", 90 * DAY_MS);
+// cursors of keys that left their node
+const CURSOR_RETENTION_MS = 7 * DAY_MS;
+// per rollup run, so a long outage catches up in steps
+const MAX_ROLLUP_HOURS = 48;
+const MAX_ROLLUP_DAYS = 7;
+const PRUNE_BATCH = 5_000;
+const PRUNE_MAX_BATCHES = 20;
+
+export function trafficAccountingEnabled(): boolean {
+  const v = (process.env.TRAFFIC_ACCOUNTING ?? "1").trim().toLowerCase();
+  return v !== "0" && v !== "false";
+}
+
+type Resolution = "MINUTE" | "HOUR" | "DAY";
+
+const stats = {
+  ingests: 0,
+  ingestRows: 0,
+  rxBytes: 0,
+  txBytes: 0,
+  staleSamples: 0,
+  ingestErrors: 0,
+  rollupRuns: 0,
+  hourRows: 0,
+  dayRows: 0,
+  prunedRows: 0,
+  rollupErrors: 0,
+  lastRollupMs: 0,
+};
+
+let timer: NodeJS.Timeout | null = null;
+let running = false;
+
+const floorTo = (ms: number, step: number) => Math.floor(ms / step) * step;
+const ceilTo = (ms: number, step: number) => Math.ceil(ms / step) * step;
+
+type Delta = { publicKey: string; rx: bigint; tx: bigint; drx: bigint; dtx: bigint };
+
+/** Adds the transfer since the previous sample of each peer on the node to its MINUTE row. */
+export async function ingestNodeTraffic(
+  prisma: PrismaClient,
+  nodeId: string,
+  sampledAt: number,
+  peers: Map<string, PeerStats>
+) {
+  if (!trafficAccountingEnabled() || peers.size === 0) return;
+  const at = new Date(sampledAt);
+  const bucket = new Date(floorTo(sampledAt, 60_000));
+
+  const rows = await prisma.$transaction(async (tx) => {
+    await tx.$executeRaw`SELECT pg_advisory_xact_lock(hashtext(${`peer-traffic:${nodeId}`}))`;
+
+    const cursors = await tx.peerTrafficCursor.findMany({
+      where: { nodeId, publicKey: { in: [...peers.keys()] } },
+    });
+    const prev = new Map(cursors.map((c) => [c.publicKey, c]));
+
+    const changed: Delta[] = [];
+    for (const [publicKey, s] of peers) {
+      const c = prev.get(publicKey);
+      // another replica already stored a newer sample
+      if (c && c.sampledAt >= at) {
+        stats.staleSamples++;
+        continue;
+      }
+      const rx = BigInt(s.rxBytes);
+      const txb = BigInt(s.txBytes);
+      if (c && c.rxBytes === rx && c.txBytes === txb) continue;
+      changed.push({
+        publicKey,
+        rx,
+        tx: txb,
+        drx: !c ? 0n : rx >= c.rxBytes ? rx - c.rxBytes : rx,
+        dtx: !c ? 0n : txb >= c.txBytes ? txb - c.txBytes : txb,
+      });
+    }
+    if (changed.length === 0) return [];
+
+    await tx.$executeRaw`
+      INSERT INTO "PeerTrafficCursor" ("nodeId", "publicKey", "rxBytes", "txBytes", "sampledAt")
+      SELECT ${nodeId}, s.k, s.rx::bigint, s.tx::bigint, ${at}
+      FROM unnest(${changed.map((d) => d.publicKey)}::text[],
+                  ${changed.map((d) => String(d.rx))}::text[],
+                  ${changed.map((d) => String(d.tx))}::text[]) AS s(k, rx, tx)
+      ON CONFLICT ("nodeId", "publicKey") DO UPDATE SET
+        "rxBytes" = EXCLUDED."rxBytes", "txBytes" = EXCLUDED."txBytes", "sampledAt" = EXCLUDED."sampledAt"
+    `;
+
+    const moved = changed.filter((d) => d.drx > 0n || d.dtx > 0n);
+    if (moved.length === 0) return [];
+
+    // keys on the node without a Peer row (manual peers) are not accounted
+    const owners = await tx.peer.findMany({
+      where: { nodeId, publicKey: { in: moved.map((d) => d.publicKey) } },
+      select: { id: true, userId: true, deviceId: true, publicKey: true },
+    });
+    const byKey = new Map(owners.map((p) => [p.publicKey, p]));
+    const out = moved.flatMap((d) => {
+      const p = byKey.get(d.publicKey);
+      return p ? [{ ...p, drx: d.drx, dtx: d.dtx }] : [];
+    });
+    if (out.length === 0) return [];
+
+    await tx.$executeRaw`
+      INSERT INTO "PeerTraffic" ("peerId", "resolution", "bucket", "userId", "deviceId", "nodeId", "rxBytes", "txBytes")
+      SELECT s.p, 'MINUTE'::"TrafficResolution", ${bucket}, s.u, s.d, ${nodeId}, s.rx::bigint, s.tx::bigint
+      FROM unnest(${out.map((r) => r.id)}::text[],
+                  ${out.map((r) => r.userId)}::text[],
+                  ${out.map((r) => r.deviceId)}::text[],
+                  ${out.map((r) => String(r.drx))}::text[],
+                  ${out.map((r) => String(r.dtx))}::text[]) AS s(p, u, d, rx, tx)
+      ON CONFLICT ("peerId", "resolution", "bucket") DO UPDATE SET
+        "rxBytes" = "PeerTraffic"."rxBytes" + EXCLUDED."rxBytes",
+        "txBytes" = "PeerTraffic"."txBytes" + EXCLUDED."txBytes"
+    `;
+    return out;
+  });
+
+  stats.ingests++;
+  stats.ingestRows += rows.length;
+  for (const r of rows) {
+    stats.rxBytes += Number(r.drx);
+    stats.txBytes += Number(r.dtx);
+  }
+}
+
+// called by the poller; accounting must never fail the node poll
+export function recordNodeTraffic(
+  prisma: PrismaClient,
+  nodeId: string,
+  sampledAt: number,
+  peers: Map<string, PeerStats>,
+  logger?: any
+) {
+  return ingestNodeTraffic(prisma, nodeId, sampledAt, peers).catch((err) => {
+    stats.ingestErrors++;
+    logger?.warn?.({ err, nodeId }, "traffic ingest failed");
+  });
+}
+
+async function readWatermarks(db: PrismaClient | Prisma.TransactionClient) {
+  const rows = await db.trafficRollup.findMany();
+  const out: Partial<Record<Resolution, Date>> = {};
+  for (const r of rows) out[r.resolution as Resolution] = r.through;
+  return out;
+}
+
+// folds `from` rows in [watermark, target) into `to` buckets; returns the new watermark
+async function rollupLevel(
+  tx: Prisma.TransactionClient,
+  from: Resolution,
+  to: "HOUR" | "DAY",
+  target: number,
+  maxSpanMs: number
+) {
+  const unit = to === "HOUR" ? "hour" : "day";
+  const step = to === "HOUR" ? HOUR_MS : DAY_MS;
+
+  let through = (await readWatermarks(tx))[to]?.getTime();
+  if (through === undefined) {
+    const first = await tx.peerTraffic.aggregate({ where: { resolution: from }, _min: { bucket: true } });
+    through = first._min.bucket ? floorTo(first._min.bucket.getTime(), step) : target;
+  }
+  if (through >= target) return { through, rows: 0 };
+
+  const end = Math.min(target, through + maxSpanMs);
+  // replaces whole buckets, so a re-run after a crash gives the same rows
+  const rows = await tx.$executeRaw`
+    INSERT INTO "PeerTraffic" ("peerId", "resolution", "bucket", "userId", "deviceId", "nodeId", "rxBytes", "txBytes")
+    SELECT "peerId", ${to}::"TrafficResolution", date_trunc(${unit}, "bucket"),
+           max("userId"), max("deviceId"), max("nodeId"), sum("rxBytes")::bigint, sum("txBytes")::bigint
+    FROM "PeerTraffic"
+    WHERE "resolution" = ${from}::"TrafficResolution" AND "bucket" >= ${new Date(through)} AND "bucket" < ${new Date(end)}
+    GROUP BY 1, 3
+    ON CONFLICT ("peerId", "resolution", "bucket") DO UPDATE SET
+      "userId" = EXCLUDED."userId", "deviceId" = EXCLUDED."deviceId", "nodeId" = EXCLUDED."nodeId",
+      "rxBytes" = EXCLUDED."rxBytes", "txBytes" = EXCLUDED."txBytes"
+  `;
+  await tx.trafficRollup.upsert({
+    where: { resolution: to },
+    update: { through: new Date(end) },
+    create: { resolution: to, through: new Date(end) },
+  });
+  return { through: end, rows };
+}
+
+async function pruneLevel(prisma: PrismaClient, resolution: Resolution, before: Date) {
+  let total = 0;
+  for (let i = 0; i < PRUNE_MAX_BATCHES; i++) {
+    const n = await prisma.$executeRaw`
+      DELETE FROM "PeerTraffic"
+      WHERE ("peerId", "resolution", "bucket") IN (
+        SELECT "peerId", "resolution", "bucket" FROM "PeerTraffic"
+        WHERE "resolution" = ${resolution}::"TrafficResolution" AND "bucket" < ${before}
+        LIMIT ${PRUNE_BATCH}
+        FOR UPDATE SKIP LOCKED
+      )`;
+    total += n;
+    if (n < PRUNE_BATCH) break;
+  }
+  return total;
+}
+
+export async function rollupTraffic(prisma: PrismaClient) {
+  const startedAt = performance.now();
+  const now = Date.now();
+
+  const rolled = await prisma.$transaction(
+    async (tx) => {
+      // one replica rolls up at a time; the others skip this tick
+      const [lock] = await tx.$queryRaw<{ ok: boolean }[]>`
+        SELECT pg_try_advisory_xact_lock(hashtext('peer-traffic-rollup')) AS "ok"`;
+      if (!lock?.ok) return null;
+
+      const hours = await rollupLevel(tx, "MINUTE", "HOUR", floorTo(now - ROLLUP_GRACE_MS(), HOUR_MS), MAX_ROLLUP_HOURS * HOUR_MS);
+      // a day is final once all of its hours are
+      const days = await rollupLevel(tx, "HOUR", "DAY", floorTo(hours.through, DAY_MS), MAX_ROLLUP_DAYS * DAY_MS);
+      return { hours, days };
+    },
+    { timeout: 120_000 }
+  );
+  if (!rolled) return null;
+
+  // only rows that are already part of the next level
+  const minuteBefore = Math.min(rolled.hours.through, now - MINUTE_RETENTION_MS());
+  const hourBefore = Math.min(rolled.days.through, now - HOUR_RETENTION_MS());
+  const pruned =
+    (await pruneLevel(prisma, "MINUTE", new Date(minuteBefore))) +
+    (await pruneLevel(prisma, "HOUR", new Date(hourBefore)));
+  await prisma.peerTrafficCursor.deleteMany({ where: { sampledAt: { lt: new Date(now - CURSOR_RETENTION_MS) } } });
+
+  stats.rollupRuns++;
+  stats.hourRows += rolled.hours.rows;
+  stats.dayRows += rolled.days.rows;
+  stats.prunedRows += pruned;
+  stats.lastRollupMs = Math.round(performance.now() - startedAt);
+  return { hourRows: rolled.hours.rows, dayRows: rolled.days.rows, pruned };
+}
+
+export type UsageScope = { userId: string; deviceId?: string } | { nodeId: string };
+export type UsageStep = "hour" | "day";
+
+type UsageRow = { bucket: Date; key: string; rxBytes: bigint; txBytes: bigint };
+
+/**
+ * Transfer of a user, a device or a node in [from, to), as a series per `step`
+ * plus totals per device (user scope) or per user (node scope).
+ */
+export async function trafficUsage(
+  prisma: PrismaClient,
+  scope: UsageScope,
+  range: { from: Date; to: Date; step: UsageStep }
+) {
+  const from = floorTo(range.from.getTime(), 60_000);
+  const to = floorTo(range.to.getTime(), 60_000);
+  const wm = await readWatermarks(prisma);
+  const hourThrough = wm.HOUR?.getTime() ?? 0;
+  const dayThrough = wm.DAY?.getTime() ?? 0;
+
+  // nested ranges: [dayFrom, dayTo) within [hourFrom, hourTo) within [from, to)
+  const hourFrom = ceilTo(from, HOUR_MS);
+  const hourTo = Math.max(hourFrom, Math.min(floorTo(to, HOUR_MS), hourThrough));
+  const dayFrom = ceilTo(from, DAY_MS);
+  // hourly series cannot use day rows
+  const dayTo = range.step === "day" ? Math.max(dayFrom, Math.min(floorTo(to, DAY_MS), dayThrough)) : dayFrom;
+  const d = (ms: number) => new Date(ms);
+
+  const where =
+    "nodeId" in scope
+      ? Prisma.sql`"nodeId" = ${scope.nodeId}`
+      : scope.deviceId
+        ? Prisma.sql`"userId" = ${scope.userId} AND "deviceId" = ${scope.deviceId}`
+        : Prisma.sql`"userId" = ${scope.userId}`;
+  const key = "nodeId" in scope ? Prisma.raw(`"userId"`) : Prisma.raw(`"deviceId"`);
+
+  const rows = await prisma.$queryRaw<UsageRow[]>`
+    SELECT date_trunc(${range.step}, "bucket") AS "bucket", ${key} AS "key",
+           sum("rxBytes")::bigint AS "rxBytes", sum("txBytes")::bigint AS "txBytes"
+    FROM "PeerTraffic"
+    WHERE ${where} AND (
+      ("resolution" = 'DAY' AND "bucket" >= ${d(dayFrom)} AND "bucket" < ${d(dayTo)})
+      OR ("resolution" = 'HOUR' AND "bucket" >= ${d(hourFrom)} AND "bucket" < ${d(hourTo)}
+          AND NOT ("bucket" >= ${d(dayFrom)} AND "bucket" < ${d(dayTo)}))
+      OR ("resolution" = 'MINUTE' AND "bucket" >= ${d(from)} AND "bucket" < ${d(to)}
+          AND NOT ("bucket" >= ${d(hourFrom)} AND "bucket" < ${d(hourTo)}))
+    )
+    GROUP BY 1, 2
+    ORDER BY 1
+  `;
+
+  const series = new Map<number, { bucket: Date; rxBytes: number; txBytes: number }>();
+  const byKey = new Map<string, { rxBytes: number; txBytes: number }>();
+  const total = { rxBytes: 0, txBytes: 0 };
+  for (const r of rows) {
+    const rx = Number(r.rxBytes);
+    const tx = Number(r.txBytes);
+    const t = r.bucket.getTime();
+    const s = series.get(t) ?? { bucket: r.bucket, rxBytes: 0, txBytes: 0 };
+    s.rxBytes += rx;
+    s.txBytes += tx;
+    series.set(t, s);
+    const k = byKey.get(r.key) ?? { rxBytes: 0, txBytes: 0 };
+    k.rxBytes += rx;
+    k.txBytes += tx;
+    byKey.set(r.key, k);
+    total.rxBytes += rx;
+    total.txBytes += tx;
+  }
+
+  const breakdown = [...byKey.entries()]
+    .map(([id, v]) => ({ id, ...v }))
+    .sort((a, b) => b.rxBytes + b.txBytes - (a.rxBytes + a.txBytes));
+
+  return {
+    from: d(from),
+    to: d(to),
+    step: range.step,
+    // buckets after this are still read from minute rows
+    rolledUpThrough: hourThrough ? d(hourThrough) : null,
+    total,
+    series: [...series.values()],
+    breakdown,
+  };
+}
+
+export function startTrafficRollup(prisma: PrismaClient, logger?: any) {
+  const interval = ROLLUP_INTERVAL_MS();
+  if (timer || interval === 0 || !trafficAccountingEnabled()) return;
+
+  const tick = () => {
+    if (running) return;
+    running = true;
+    rollupTraffic(prisma)
+      .then((r) => {
+        if (r && (r.hourRows || r.dayRows || r.pruned)) logger?.info?.(r, "traffic rolled up");
+      })
+      .catch((err) => {
+        stats.rollupErrors++;
+        logger?.warn?.({ err }, "traffic rollup failed");
+      })
+      .finally(() => {
+        running = false;
+      });
+  };
+  timer = setInterval(tick, interval);
+  timer.unref();
+}
+
+export function stopTrafficRollup() {
+  if (!timer) return;
+  clearInterval(timer);
+  timer = null;
+}
+
+export function trafficStats() {
+  return { ...stats };
+}
@@ -1,7 +1,11 @@
 import {  } from "@prisma/client";
 import type { PrismaClient } from "@prisma/client";
 import { z } from "zod";
-import { allocateAllowedIp } from "./ipAllocator";
+import { invalidatePeerConfigs } from "./config-cache";
+import { adjustActiveDevices } from "./entitlements";
+import { allocateAllowedIp, markAllowedIpUsed, releaseAllowedIp } from "./ipAllocator";
+import { getCachedNode } from "./node-cache";
+import { NodePlacementError, nodePoolRange, pickNodeForNewPeer } from "./node-registry";
 import { WG_PUBLIC_KEY_RE, normalizePublicKey } from "./wgPublicKey";
 import { randomUUID } from "crypto";
 
@@ -11,29 +15,6 @@ function parseSshOpts(raw: string | undefined): string[] {
 }
 
 
-const must = (v: string | undefined, name: string): string => {
-  if (!v) throw new Error(`${name} is required`);
-  return v;
-};
-
-const Env = z.object({
-  WG_NODE_ID: z.string().default("wg-node-1"),
-  WG_POOL_START: z.string().default("10.8.0.2"),
-  WG_POOL_END: z.string().default("10.8.0.254"),
-
-  // node fields (если у тебя в модели иначе - tsc покажет, поправим)
-  WG_ENDPOINT_HOST: z.string().optional(),
-  WG_PORT: z.coerce.number().default(51820),
-  WG_NODE_SSH_HOST: z.string().optional(),
-  WG_NODE_SSH_USER: z.string().optional(),
-  WG_INTERFACE: z.string().default("wg0"),
-  WG_SERVER_PUBLIC_KEY: z.string().optional(),
-}).passthrough();
-
-function getEnv() {
-  return Env.parse(process.env);
-}
-
 export const ProvisionInputSchema = z.object({ publicKey: z.string() });
 
 
@@ -55,7 +36,6 @@ export async function provision(
   prisma: PrismaClient,
   args: { deviceId: string; publicKey: string }
 ): Promise<ProvisionResult> {
-  const env = getEnv();
   const publicKey = PublicKeySchema.parse(args.publicKey);
 
   // deviceId может быть как internal id, так и внешний deviceId — берём по findFirst (совместимо)
@@ -68,45 +48,38 @@ export async function provision(
     throw e;
   }
 
-  // гарантируем 1 каноничный nodeId через upsert
-  const node = await prisma.node.upsert({
-    where: { id: env.WG_NODE_ID },
-    update: {
-      endpointHost: env.WG_ENDPOINT_HOST ?? undefined,
-      wgPort: env.WG_PORT,
-      sshHost: env.WG_NODE_SSH_HOST ?? undefined,
-      sshUser: env.WG_NODE_SSH_USER ?? undefined,
-      wgInterface: env.WG_INTERFACE,
-      serverPublicKey: must(env.WG_SERVER_PUBLIC_KEY, "WG_SERVER_PUBLIC_KEY"),
-    },
-    create: {
-      id: env.WG_NODE_ID,
-      name: env.WG_NODE_ID,
-      endpointHost: env.WG_ENDPOINT_HOST ?? "127.0.0.1",
-      wgPort: env.WG_PORT,
-      sshHost: env.WG_NODE_SSH_HOST ?? "127.0.0.1",
-      sshUser: env.WG_NODE_SSH_USER ?? "root",
-      wgInterface: env.WG_INTERFACE,
-      serverPublicKey: must(env.WG_SERVER_PUBLIC_KEY, "WG_SERVER_PUBLIC_KEY"),
-    },
-  });
-
-  // ключевой фикс: ищем peer по (nodeId, publicKey) без фильтра revokedAt
+  // ключевой фикс: ищем peer по publicKey без фильтра revokedAt (на любой ноде; активный — первым)
   const existing = await prisma.peer.findFirst({
-    where: { nodeId: node.id, publicKey },
+    where: { publicKey },
+    orderBy: [{ revokedAt: { sort: "asc", nulls: "first" } }, { createdAt: "desc" }],
   });
 
   if (existing) {
+    const node = await getCachedNode(prisma, existing.nodeId);
+    if (!node) {
+      const e: any = new Error("NODE_NOT_FOUND");
+      e.status = 500;
+      throw e;
+    }
+
     if (existing.deviceId !== device.id) {
       const e: any = new Error("PUBLIC_KEY_IN_USE");
       e.status = 409;
       throw e;
     }
 
-    const updated = await prisma.peer.update({
-      where: { id: existing.id },
-      data: { revokedAt: null, userId: device.userId },
+    const updated = await prisma.$transaction(async (tx) => {
+      const reactivated = await tx.peer.updateMany({
+        where: { id: existing.id, revokedAt: { not: null } },
+        data: { revokedAt: null, userId: device.userId },
+      });
+      if (reactivated.count > 0) await adjustActiveDevices(tx, device.userId, 1);
+      return tx.peer.update({
+        where: { id: existing.id },
+        data: { userId: device.userId },
+      });
     });
+    markAllowedIpUsed(node.id, updated.allowedIp);
 
     return {
       status: 200,
@@ -126,21 +99,39 @@ export async function provision(
     };
   }
 
-  const allowedIp = await allocateAllowedIp(prisma, {
-    nodeId: node.id,
-    start: env.WG_POOL_START,
-    end: env.WG_POOL_END,
-  });
+  let node;
+  try {
+    node = await pickNodeForNewPeer(prisma);
+  } catch (err) {
+    if (err instanceof NodePlacementError) {
+      const e: any = new Error(err.code);
+      e.status = 503;
+      throw e;
+    }
+    throw err;
+  }
 
-  const created = await prisma.peer.create({
-    data: {
-      nodeId: node.id,
-      deviceId: device.id,
-      userId: device.userId,
-      publicKey,
-      allowedIp,
-    },
-  });
+  const allowedIp = await allocateAllowedIp(prisma, { nodeId: node.id, ...nodePoolRange(node) });
+
+  let created;
+  try {
+    created = await prisma.$transaction(async (tx) => {
+      const peer = await tx.peer.create({
+        data: {
+          nodeId: node.id,
+          deviceId: device.id,
+          userId: device.userId,
+          publicKey,
+          allowedIp,
+        },
+      });
+      await adjustActiveDevices(tx, device.userId, 1);
+      return peer;
+    });
+  } catch (err) {
+    releaseAllowedIp(node.id, allowedIp);
+    throw err;
+  }
 
   return {
     status: 201,
@@ -164,8 +155,6 @@ export async function revoke(
   prisma: PrismaClient,
   args: { deviceId: string }
 ): Promise<{ status: number; revoked: boolean }> {
-  const env = getEnv();
-
   const device = await prisma.device.findFirst({
     where: { OR: [{ id: args.deviceId }, { deviceId: args.deviceId }] },
   });
@@ -176,16 +165,21 @@ export async function revoke(
   }
 
   const active = await prisma.peer.findFirst({
-    where: { nodeId: env.WG_NODE_ID, deviceId: device.id, revokedAt: null },
+    where: { deviceId: device.id, revokedAt: null },
     orderBy: { createdAt: "desc" as any },
   });
 
   if (!active) return { status: 200, revoked: false };
 
-  await prisma.peer.update({
-    where: { id: active.id },
-    data: { revokedAt: new Date() },
+  await prisma.$transaction(async (tx) => {
+    const revoked = await tx.peer.updateMany({
+      where: { id: active.id, revokedAt: null },
+      data: { revokedAt: new Date() },
+    });
+    if (revoked.count > 0) await adjustActiveDevices(tx, active.userId, -1);
   });
+  releaseAllowedIp(active.nodeId, active.allowedIp);
+  invalidatePeerConfigs(active.id);
 
   return { status: 200, revoked: true };
 }
@@ -0,0 +1,185 @@
+import {
+  assertNodeAvailable,
+  isTransportError,
+  nodeBreakerKey,
+  NodeUnavailableError,
+} from "./node-breaker";
+import { wgApplyPeerOps, type WgNodeRef, type WgPeerOp } from "./wg-node";
+
+// Coalescing writer: peer add/remove calls for the same node that arrive within
+// a short window are applied with a single `wg set` (see wgApplyPeerOps),
+// then every caller gets its own result.
+
+function numEnv(name: string, fallback: number): number {
+  const n = Number(process.env[name]);
+  return Number.isFinite(n) && n >= 0 ? n : fallback;
+}
+
+const WINDOW_MS = () => numEnv("WG_BATCH_WINDOW_MS", 10);
+const MAX_OPS = () => Math.max(1, numEnv("WG_BATCH_MAX_OPS", 64));
+// ops waiting for a node beyond this are shed with NODE_OVERLOADED
+const MAX_QUEUE = () => Math.max(1, numEnv("WG_BATCH_MAX_QUEUE", 1024));
+
+type PendingOp = {
+  op: WgPeerOp;
+  resolve: () => void;
+  reject: (err: unknown) => void;
+};
+
+export class WgPeerOpError extends Error {
+  code: string;
+  publicKey: string;
+
+  constructor(code: string, publicKey: string) {
+    super(`${code}: ${publicKey}`);
+    this.name = "WgPeerOpError";
+    this.code = code;
+    this.publicKey = publicKey;
+  }
+}
+
+const stats = { batches: 0, ops: 0, failedOps: 0, splits: 0, maxBatchSize: 0, shedOps: 0 };
+
+class NodeBatcher {
+  private queue: PendingOp[] = [];
+  private timer: NodeJS.Timeout | null = null;
+  private flushing = false;
+
+  private readonly key: string;
+
+  constructor(private readonly node: WgNodeRef) {
+    this.key = nodeBreakerKey(node);
+  }
+
+  enqueue(op: WgPeerOp): Promise<void> {
+    try {
+      assertNodeAvailable(this.key);
+      if (this.queue.length >= MAX_QUEUE()) throw new NodeUnavailableError("NODE_OVERLOADED", this.key);
+    } catch (err) {
+      stats.shedOps++;
+      return Promise.reject(err);
+    }
+
+    return new Promise<void>((resolve, reject) => {
+      this.queue.push({ op, resolve, reject });
+      this.schedule();
+    });
+  }
+
+  private schedule() {
+    if (this.flushing || this.queue.length === 0) return;
+    if (this.queue.length >= MAX_OPS()) {
+      if (this.timer) clearTimeout(this.timer);
+      this.timer = null;
+      void this.flush();
+      return;
+    }
+    if (!this.timer) {
+      this.timer = setTimeout(() => {
+        this.timer = null;
+        void this.flush();
+      }, WINDOW_MS());
+    }
+  }
+
+  // One key per batch: a later op on the same key waits for the next batch,
+  // so add -> remove of the same peer keeps its order.
+  private takeBatch(): PendingOp[] {
+    const batch: PendingOp[] = [];
+    const keys = new Set<string>();
+    const max = MAX_OPS();
+
+    let i = 0;
+    while (i < this.queue.length && batch.length < max) {
+      const item = this.queue[i];
+      if (keys.has(item.op.publicKey)) break;
+      keys.add(item.op.publicKey);
+      batch.push(item);
+      i++;
+    }
+    this.queue.splice(0, i);
+    return batch;
+  }
+
+  private async flush() {
+    if (this.flushing) return;
+    this.flushing = true;
+    try {
+      while (this.queue.length > 0) {
+        const batch = this.takeBatch();
+        stats.batches++;
+        stats.ops += batch.length;
+        stats.maxBatchSize = Math.max(stats.maxBatchSize, batch.length);
+        await this.apply(batch);
+      }
+    } finally {
+      this.flushing = false;
+      this.schedule();
+    }
+  }
+
+  private async apply(batch: PendingOp[]): Promise<void> {
+    let applied: Map<string, string[]>;
+    try {
+      applied = await wgApplyPeerOps({ node: this.node, ops: batch.map((b) => b.op) });
+    } catch (err) {
+      // node-wide failures (connection, timeout, open breaker): splitting would only repeat them
+      if (batch.length === 1 || isTransportError(err)) {
+        stats.failedOps += batch.length;
+        for (const b of batch) b.reject(err);
+        return;
+      }
+      // a bad clause fails the whole `wg set`; bisect to find it
+      stats.splits++;
+      const mid = Math.ceil(batch.length / 2);
+      await this.apply(batch.slice(0, mid));
+      await this.apply(batch.slice(mid));
+      return;
+    }
+
+    for (const b of batch) {
+      const ips = applied.get(b.op.publicKey);
+      if (b.op.kind === "add" && !ips?.includes(`${b.op.allowedIp}/32`)) {
+        stats.failedOps++;
+        b.reject(new WgPeerOpError("WG_PEER_NOT_APPLIED", b.op.publicKey));
+      } else if (b.op.kind === "remove" && ips) {
+        stats.failedOps++;
+        b.reject(new WgPeerOpError("WG_PEER_STILL_PRESENT", b.op.publicKey));
+      } else {
+        b.resolve();
+      }
+    }
+  }
+}
+
+const batchers = new Map<string, NodeBatcher>();
+
+function getBatcher(node: WgNodeRef): NodeBatcher {
+  const key = `${node.sshUser}@${node.sshHost}/${node.wgInterface}`;
+  let batcher = batchers.get(key);
+  if (!batcher) {
+    batcher = new NodeBatcher({
+      sshHost: node.sshHost,
+      sshUser: node.sshUser,
+      wgInterface: node.wgInterface,
+    });
+    batchers.set(key, batcher);
+  }
+  return batcher;
+}
+
+export function wgAddPeerBatched(params: { publicKey: string; allowedIp: string; node: WgNodeRef }) {
+  return getBatcher(params.node).enqueue({
+    kind: "add",
+    publicKey: params.publicKey,
+    allowedIp: params.allowedIp,
+  });
+}
+
+export function wgRemovePeerBatched(params: { publicKey: string; node: WgNodeRef }) {
+  return getBatcher(params.node).enqueue({ kind: "remove", publicKey: params.publicKey });
+}
+
+export function wgBatchStats() {
+  return { ...stats };
+}
@@ -1,20 +1,23 @@
-import nacl from "tweetnacl";
+import { generateKeyPairSync, type KeyObject } from "node:crypto";
 
 /**
  * WireGuard keys are Curve25519:
  * - privateKey: 32 random bytes (base64)
  * - publicKey:  scalarMultBase(privateKey) (base64)
  *
- * This implementation avoids relying on `wg` binary inside container.
+ * Node's native X25519 (OpenSSL) is used; this avoids relying on `wg` binary inside container.
+ * Request paths should take keys from the pre-generated pool (keypair-pool.ts).
  */
-export function generateWgKeypair(): { privateKey: string; publicKey: string } {
-  const priv = nacl.randomBytes(32);
-  const pub = nacl.scalarMult.base(priv);
-
-  const privateKey = Buffer.from(priv).toString("base64");
-  const publicKey = Buffer.from(pub).toString("base64");
+export function keypairFromKeyObject(privateKey: KeyObject): { privateKey: string; publicKey: string } {
+  const jwk = privateKey.export({ format: "jwk" });
+  return {
+    privateKey: Buffer.from(String(jwk.d), "base64url").toString("base64"),
+    publicKey: Buffer.from(String(jwk.x), "base64url").toString("base64"),
+  };
+}
 
-  return { privateKey, publicKey };
+export function generateWgKeypair(): { privateKey: string; publicKey: string } {
+  return keypairFromKeyObject(generateKeyPairSync("x25519").privateKey);
 }
 
 /**
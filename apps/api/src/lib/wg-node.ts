@@ -1,15 +1,20 @@
-import { execFile } from "node:child_process";
-import { promisify } from "node:util";
 import { env } from "../env";
-
-const execFileAsync = promisify(execFile);
+import { sshCommandDuration } from "./metrics";
+import { nodeBreakerKey, withNodeBreaker } from "./node-breaker";
+import { sshPoolExec } from "./ssh-pool";
 
 type SshExecOpts = {
   host: string;
   user: string;
   opts?: string; // extra ssh options as string, e.g. "-i /path/to/key"
+  command: string; // metrics label
 };
 
+function sshTimeoutMs() {
+  const n = Number(process.env.WG_NODE_SSH_TIMEOUT_MS);
+  return Number.isFinite(n) && n > 0 ? n : 30_000;
+}
+
 async function sshExec(cmd: string, ssh: SshExecOpts): Promise<{ stdout: string; stderr: string }> {
   const args: string[] = [];
 
@@ -28,10 +33,12 @@ async function sshExec(cmd: string, ssh: SshExecOpts): Promise<{ stdout: string;
     args.push(...ssh.opts.split(" ").filter(Boolean));
   }
 
-  args.push(`${ssh.user}@${ssh.host}`, cmd);
-
-  const { stdout, stderr } = await execFileAsync("ssh", args, { timeout: 30_000 });
-  return { stdout: String(stdout ?? ""), stderr: String(stderr ?? "") };
+  // unreachable/overloaded node fails fast with NodeUnavailableError (see node-breaker.ts)
+  return withNodeBreaker(nodeBreakerKey({ sshHost: ssh.host, sshUser: ssh.user }), () =>
+    sshCommandDuration.time({ node: ssh.host, command: ssh.command }, () =>
+      sshPoolExec({ host: ssh.host, user: ssh.user, args }, cmd, { timeoutMs: sshTimeoutMs() })
+    )
+  );
 }
 
 export async function wgAddPeer(params: {
@@ -51,6 +58,7 @@ export async function wgAddPeer(params: {
     host: node.sshHost,
     user: node.sshUser,
     opts: env.WG_NODE_SSH_OPTS,
+    command: "wgAddPeer",
   });
 }
 
@@ -70,5 +78,73 @@ export async function wgRemovePeer(params: {
     host: node.sshHost,
     user: node.sshUser,
     opts: env.WG_NODE_SSH_OPTS,
+    command: "wgRemovePeer",
+  });
+}
+
+export type WgNodeRef = { sshHost: string; sshUser: string; wgInterface: string };
+
+export type WgPeerOp =
+  | { kind: "add"; publicKey: string; allowedIp: string }
+  | { kind: "remove"; publicKey: string };
+
+function peerClause(op: WgPeerOp) {
+  return op.kind === "add"
+    ? `peer ${op.publicKey} allowed-ips ${op.allowedIp}/32`
+    : `peer ${op.publicKey} remove`;
+}
+
+// "<publicKey>\t10.8.0.2/32 10.8.0.3/32" -> Map(publicKey -> ["10.8.0.2/32", ...])
+export function parseWgAllowedIps(text: string): Map<string, string[]> {
+  const out = new Map<string, string[]>();
+  for (const line of text.split("\n")) {
+    const [publicKey, rest] = line.trim().split("\t");
+    if (!publicKey) continue;
+    const ips = (rest ?? "").split(/\s+/).filter((x) => x && x !== "(none)");
+    out.set(publicKey, ips);
+  }
+  return out;
+}
+
+/**
+ * Applies several peer changes in one remote invocation (one `wg set` with
+ * multiple `peer` clauses) and reads back allowed-ips for the touched keys only,
+ * so callers can check each op individually.
+ */
+export async function wgApplyPeerOps(params: { node: WgNodeRef; ops: WgPeerOp[] }) {
+  const { node, ops } = params;
+  if (ops.length === 0) return new Map<string, string[]>();
+
+  const patterns = ops.map((op) => `-e '${op.publicKey}'`).join(" ");
+  const cmd = [
+    "set -euo pipefail;",
+    `sudo -n wg set ${node.wgInterface} ${ops.map(peerClause).join(" ")};`,
+    `{ sudo -n wg show ${node.wgInterface} allowed-ips | grep -F ${patterns} || true; };`,
+  ].join(" ");
+
+  const { stdout } = await sshExec(cmd, {
+    host: node.sshHost,
+    user: node.sshUser,
+    opts: env.WG_NODE_SSH_OPTS,
+    // batches of one kind are reported as the single-peer command they replace
+    command: ops.every((op) => op.kind === "add")
+      ? "wgAddPeer"
+      : ops.every((op) => op.kind === "remove")
+        ? "wgRemovePeer"
+        : "wgApplyPeerOps",
+  });
+
+  return parseWgAllowedIps(stdout);
+}
+
+// Full `wg show <iface> dump` (interface line + one tab-separated line per peer).
+export async function wgShowDump(params: { node: WgNodeRef }) {
+  const { node } = params;
+  const { stdout } = await sshExec(`sudo -n wg show ${node.wgInterface} dump`, {
+    host: node.sshHost,
+    user: node.sshUser,
+    opts: env.WG_NODE_SSH_OPTS,
+    command: "wgShowDump",
   });
+  return stdout;
 }
@@ -0,0 +1,137 @@
+import type { PrismaClient } from "@prisma/client";
+import { getCachedNodes } from "./node-cache";
+import { recordNodeTraffic } from "./traffic";
+import { wgShowDump, type WgNodeRef } from "./wg-node";
+
+// Background poller: runs `wg show <iface> dump` on every enabled node and keeps
+// the last snapshot in memory, so status/dashboards never hit SSH on the request path.
+// Each good snapshot also feeds traffic accounting (lib/traffic.ts).
+
+export type PeerStats = {
+  endpoint: string | null;
+  allowedIps: string;
+  latestHandshake: number; // unix seconds, 0 = never
+  rxBytes: number;
+  txBytes: number;
+};
+
+export type NodeSnapshot = {
+  nodeId: string;
+  polledAt: number;
+  pollMs: number;
+  peers: Map<string, PeerStats>; // by publicKey
+  error: string | null;
+  errorAt: number | null;
+};
+
+// WireGuard re-handshakes every 2 minutes while traffic flows
+export const HANDSHAKE_ONLINE_SEC = 180;
+
+function numEnv(name: string, fallback: number): number {
+  const n = Number(process.env[name]);
+  return Number.isFinite(n) && n >= 0 ? n : fallback;
+}
+
+const POLL_MS = () => numEnv("WG_STATS_POLL_MS", 30_000);
+
+// peer line: public-key, preshared-key, endpoint, allowed-ips, latest-handshake,
+// transfer-rx, transfer-tx, persistent-keepalive (first line is the interface itself)
+export function parseWgDumpStats(text: string): Map<string, PeerStats> {
+  const peers = new Map<string, PeerStats>();
+  const lines = text.split("\n");
+
+  for (let i = 1; i < lines.length; i++) {
+    const cols = lines[i].trim().split("\t");
+    if (cols.length < 7 || !cols[0]) continue;
+    peers.set(cols[0], {
+      endpoint: cols[2] && cols[2] !== "(none)" ? cols[2] : null,
+      allowedIps: cols[3] === "(none)" ? "" : cols[3],
+      latestHandshake: Number(cols[4]) || 0,
+      rxBytes: Number(cols[5]) || 0,
+      txBytes: Number(cols[6]) || 0,
+    });
+  }
+  return peers;
+}
+
+const snapshots = new Map<string, NodeSnapshot>();
+let timer: NodeJS.Timeout | null = null;
+let polling = false;
+
+async function pollNode(prisma: PrismaClient, node: WgNodeRef & { id: string }, logger?: any) {
+  const startedAt = Date.now();
+  const prev = snapshots.get(node.id);
+  let polled: NodeSnapshot;
+  try {
+    const dump = await wgShowDump({ node });
+    polled = {
+      nodeId: node.id,
+      polledAt: Date.now(),
+      pollMs: Date.now() - startedAt,
+      peers: parseWgDumpStats(dump),
+      error: null,
+      errorAt: null,
+    };
+    snapshots.set(node.id, polled);
+  } catch (e: any) {
+    // keep the last good peers, report the failure next to them
+    snapshots.set(node.id, {
+      nodeId: node.id,
+      polledAt: prev?.polledAt ?? 0,
+      pollMs: Date.now() - startedAt,
+      peers: prev?.peers ?? new Map(),
+      error: String(e?.stderr || e?.message || e).trim(),
+      errorAt: Date.now(),
+    });
+    return;
+  }
+  await recordNodeTraffic(prisma, node.id, polled.polledAt, polled.peers, logger);
+}
+
+export async function pollAllNodes(prisma: PrismaClient, logger?: any) {
+  if (polling) return;
+  polling = true;
+  try {
+    const nodes = (await getCachedNodes(prisma)).filter((n) => n.enabled);
+    for (const id of snapshots.keys()) {
+      if (!nodes.some((n) => n.id === id)) snapshots.delete(id);
+    }
+    await Promise.all(nodes.map((node) => pollNode(prisma, node, logger)));
+  } finally {
+    polling = false;
+  }
+}
+
+export function startWgStatsPoller(prisma: PrismaClient, logger?: any) {
+  const interval = POLL_MS();
+  if (timer || interval === 0) return;
+
+  const tick = () => {
+    pollAllNodes(prisma, logger).catch((err) => logger?.warn?.({ err }, "wg stats poll failed"));
+  };
+  tick();
+  timer = setInterval(tick, interval);
+  timer.unref();
+}
+
+export function stopWgStatsPoller() {
+  if (!timer) return;
+  clearInterval(timer);
+  timer = null;
+}
+
+export function getNodeSnapshot(nodeId: string): NodeSnapshot | null {
+  return snapshots.get(nodeId) ?? null;
+}
+
+export function listNodeSnapshots(): NodeSnapshot[] {
+  return [...snapshots.values()];
+}
+
+export function getPeerStats(nodeId: string, publicKey: string): PeerStats | null {
+  return snapshots.get(nodeId)?.peers.get(publicKey) ?? null;
+}
+
+export function isPeerOnline(stats: PeerStats | null, nowSec = Math.floor(Date.now() / 1000)) {
+  return Boolean(stats && stats.latestHandshake > 0 && nowSec - stats.latestHandshake <= HANDSHAKE_ONLINE_SEC);
+}
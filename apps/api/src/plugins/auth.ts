@@ -1,7 +1,8 @@
 import fp from "fastify-plugin";
+import { verifyJwtCached } from "../lib/jwt-cache";
 
 export default fp(async (app) => {
-  app.decorate("requireAuth", async (req: any) => {
-    await req.jwtVerify();
+  app.decorate("requireAuth", async (req: any, reply: any) => {
+    if (!(await verifyJwtCached(req, reply))) return reply;
   });
 });
@@ -1,5 +1,6 @@
 import fp from "fastify-plugin";
 import { PrismaClient } from "@prisma/client";
+import { instrumentPrisma } from "../lib/metrics";
 
 declare module "fastify" {
   interface FastifyInstance {
@@ -9,6 +10,7 @@ declare module "fastify" {
 
 export default fp(async (fastify) => {
   const prisma = new PrismaClient();
+  instrumentPrisma(prisma);
   await prisma.$connect();
 
   fastify.decorate("prisma", prisma);
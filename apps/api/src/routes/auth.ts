@@ -1,8 +1,9 @@
 import { AuthConsumeSchema, AuthRequestSchema } from "@cloudgate/shared/src/schemas";
 import { prisma } from "../lib/prisma";
-import { genToken, sha256 } from "../lib/tokens";
+import { claimMagicToken, genToken, sha256 } from "../lib/tokens";
 import { sendMagicLink } from "../lib/mail";
 import { env } from "../env";
+import { requestToken, revokeJwt } from "../lib/jwt-cache";
 
 export async function registerAuthRoutes(app: any) {
   app.post("/auth/request", async (req: any, reply: any) => {
@@ -33,15 +34,11 @@ export async function registerAuthRoutes(app: any) {
     const body = AuthConsumeSchema.parse(req.body);
     const tokenHash = sha256(body.token);
 
-    const mt = await prisma.magicToken.findUnique({ where: { tokenHash } });
-    if (!mt) return reply.code(400).send({ ok: false, error: "invalid_token" });
-    if (mt.usedAt) return reply.code(400).send({ ok: false, error: "token_used" });
-    if (mt.expiresAt.getTime() < Date.now()) return reply.code(400).send({ ok: false, error: "token_expired" });
-
-    await prisma.magicToken.update({
-      where: { tokenHash },
-      data: { usedAt: new Date() },
-    });
+    // one conditional UPDATE: a link opened twice at once logs in only once
+    const mt = await claimMagicToken(prisma, tokenHash);
+    if (mt === "not_found") return reply.code(400).send({ ok: false, error: "invalid_token" });
+    if (mt === "used") return reply.code(400).send({ ok: false, error: "token_used" });
+    if (mt === "expired") return reply.code(400).send({ ok: false, error: "token_expired" });
 
     const user = await prisma.user.upsert({
       where: { email: mt.email },
@@ -66,7 +63,18 @@ export async function registerAuthRoutes(app: any) {
     return reply.send({ ok: true, user: (req as any).user?.user ?? (req as any).user });
   });
 
-  app.post("/auth/logout", async (_req: any, reply: any) => {
+  app.post("/auth/logout", async (req: any, reply: any) => {
+    // the session JWT stays valid until exp; deny it here so cached verifications die too
+    // only a token that verifies is denied; malformed or forged ones just get the cookie cleared
+    const token = requestToken(req);
+    if (token) {
+      try {
+        const payload = await req.jwtVerify();
+        revokeJwt(token, payload ?? req.user);
+      } catch {
+        // not a valid session: nothing to revoke
+      }
+    }
     reply.clearCookie("cg_session", { path: "/" });
     return reply.send({ ok: true });
   });
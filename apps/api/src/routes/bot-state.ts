@@ -0,0 +1,75 @@
+import type { FastifyInstance } from "fastify";
+import { z } from "zod";
+import { prisma } from "../lib/prisma";
+
+// Conversation state of the Telegram bot (support flow), shared by all bot
+// replicas. Keys are opaque to the API; expired rows are invisible here and
+// are deleted by the sweeper in lib/bot-state.ts.
+
+const MAX_TTL_MS = 7 * 24 * 60 * 60_000;
+
+const KeySchema = z.string().min(1).max(200);
+
+const PutSchema = z.object({
+  value: z.string().max(4_096),
+  ttlMs: z.number().int().min(1_000).max(MAX_TTL_MS),
+});
+
+// These keys decide where support replies go, so the routes fail closed:
+// without BOT_STATE_TOKEN they answer 503, with it the bearer token is required.
+function checkAuth(req: any, reply: any) {
+  const token = process.env.BOT_STATE_TOKEN;
+  if (!token) {
+    reply.code(503).send({ error: "bot_state_disabled" });
+    return false;
+  }
+  if (req.headers.authorization !== `Bearer ${token}`) {
+    reply.code(401).send({ error: "UNAUTHORIZED" });
+    return false;
+  }
+  return true;
+}
+
+export async function registerBotStateRoutes(app: FastifyInstance) {
+  // GET /v1/bot/state/:key
+  app.get("/v1/bot/state/:key", async (req: any, reply) => {
+    if (!checkAuth(req, reply)) return reply;
+    const key = KeySchema.parse((req.params as any).key);
+
+    const row = await prisma.botConversationState.findFirst({
+      where: { key, expiresAt: { gt: new Date() } },
+      select: { value: true, expiresAt: true },
+    });
+    if (!row) return reply.code(404).send({ error: "state_not_found" });
+    return row;
+  });
+
+  // PUT /v1/bot/state/:key
+  app.put("/v1/bot/state/:key", async (req: any, reply) => {
+    if (!checkAuth(req, reply)) return reply;
+    const key = KeySchema.parse((req.params as any).key);
+    const body = PutSchema.parse(req.body);
+
+    const expiresAt = new Date(Date.now() + body.ttlMs);
+    await prisma.botConversationState.upsert({
+      where: { key },
+      update: { value: body.value, expiresAt },
+      create: { key, value: body.value, expiresAt },
+    });
+    return { ok: true, expiresAt };
+  });
+
+  // DELETE /v1/bot/state/:key — returns the value it removed, so get + delete is one atomic "take"
+  app.delete("/v1/bot/state/:key", async (req: any, reply) => {
+    if (!checkAuth(req, reply)) return reply;
+    const key = KeySchema.parse((req.params as any).key);
+
+    const rows = await prisma.$queryRaw<{ value: string; expiresAt: Date }[]>`
+      DELETE FROM "BotConversationState" WHERE "key" = ${key}
+      RETURNING "value", "expiresAt"
+    `;
+    const row = rows[0];
+    if (!row || row.expiresAt <= new Date()) return reply.code(404).send({ error: "state_not_found" });
+    return { value: row.value };
+  });
+}
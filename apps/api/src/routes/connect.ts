@@ -8,6 +8,9 @@ import {
   revokeDevicePeer,
 } from "../lib/device-flow";
 import { normalizePublicKey, WG_PUBLIC_KEY_RE } from "../lib/wg-keys";
+import { getPeerStats, isPeerOnline } from "../lib/wg-stats";
+import { findLatestTokenJob } from "../lib/provision-queue";
+import { claimConnectToken, releaseConnectToken } from "../lib/tokens";
 
 const TokenParamSchema = z.object({
   token: z.string().min(1),
@@ -18,6 +21,7 @@ const ConnectProvisionSchema = z.object({
     .string()
     .transform((value) => normalizePublicKey(value))
     .refine((value) => WG_PUBLIC_KEY_RE.test(value), { message: "invalid_wireguard_public_key" }),
+  async: z.boolean().optional(),
 });
 
 function replyWithDeviceFlowError(reply: any, error: unknown) {
@@ -33,10 +37,12 @@ async function getConnectTokenOrThrow(token: string) {
   return record;
 }
 
-function assertProvisionableToken(record: { expiresAt: Date; usedAt: Date | null }) {
-  const now = new Date();
-  if (record.expiresAt <= now) throw new DeviceFlowError(410, "connect_token_expired");
-  if (record.usedAt) throw new DeviceFlowError(409, "connect_token_used");
+async function claimTokenOrThrow(token: string) {
+  const claimed = await claimConnectToken(prisma, token);
+  if (claimed === "not_found") throw new DeviceFlowError(404, "connect_token_not_found");
+  if (claimed === "expired") throw new DeviceFlowError(410, "connect_token_expired");
+  if (claimed === "used") throw new DeviceFlowError(409, "connect_token_used");
+  return claimed;
 }
 
 async function ensureTokenDevice(record: { userId: string; deviceId: string }) {
@@ -66,22 +72,26 @@ export async function registerConnectRoutes(app: FastifyInstance) {
     const body = ConnectProvisionSchema.parse(req.body ?? {});
 
     try {
-      const connectToken = await getConnectTokenOrThrow(token);
-      assertProvisionableToken(connectToken);
-
-      const device = await ensureTokenDevice(connectToken);
-      const result = await provisionDevicePeer(prisma, {
-        deviceIdentifier: device.id,
-        publicKey: body.publicKey,
-        logger: req.log,
-      });
-
-      await prisma.connectToken.update({
-        where: { token },
-        data: { usedAt: new Date() },
-      });
+      // claimed (usedAt set) up front; released again if provisioning fails
+      const connectToken = await claimTokenOrThrow(token);
+
+      let result;
+      try {
+        const device = await ensureTokenDevice(connectToken);
+        result = await provisionDevicePeer(prisma, {
+          deviceIdentifier: device.id,
+          publicKey: body.publicKey,
+          logger: req.log,
+          async: body.async,
+          connectToken: token,
+        });
+      } catch (error) {
+        await releaseConnectToken(prisma, token, connectToken.usedAt);
+        throw error;
+      }
 
       return reply.code(result.statusCode).send({
+        jobId: result.jobId,
         peerId: result.peerId,
         allowedIp: result.allowedIp,
         dns: result.dns,
@@ -116,9 +126,21 @@ export async function registerConnectRoutes(app: FastifyInstance) {
         })
       : null;
 
+    const job = await findLatestTokenJob(prisma, token);
+    const jobPending = job?.status === "QUEUED" || job?.status === "RUNNING";
+
     const now = new Date();
     const status =
-      connectToken.expiresAt <= now ? "expired" : connectToken.usedAt ? "used" : "ready";
+      connectToken.expiresAt <= now
+        ? "expired"
+        : jobPending
+          ? "provisioning"
+          : connectToken.usedAt
+            ? "used"
+            : "ready";
+
+    // from the node poller cache, may lag by one poll interval
+    const peerStats = activePeer ? getPeerStats(activePeer.nodeId, activePeer.publicKey) : null;
 
     return reply.code(200).send({
       token: {
@@ -130,12 +152,28 @@ export async function registerConnectRoutes(app: FastifyInstance) {
         userId: connectToken.userId,
         deviceId: connectToken.deviceId,
       },
+      job: job
+        ? {
+            id: job.id,
+            status: job.status,
+            attempts: job.attempts,
+            lastError: job.lastError,
+            createdAt: job.createdAt,
+            finishedAt: job.finishedAt,
+          }
+        : null,
       hasActivePeer: Boolean(activePeer),
       activePeer: activePeer
         ? {
             id: activePeer.id,
             allowedIp: activePeer.allowedIp,
             createdAt: activePeer.createdAt,
+            online: isPeerOnline(peerStats),
+            latestHandshake: peerStats?.latestHandshake
+              ? new Date(peerStats.latestHandshake * 1000)
+              : null,
+            rxBytes: peerStats?.rxBytes ?? null,
+            txBytes: peerStats?.txBytes ?? null,
           }
         : null,
     });
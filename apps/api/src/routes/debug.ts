@@ -0,0 +1,44 @@
+import type { FastifyInstance } from "fastify";
+import { configCacheStats } from "../lib/config-cache";
+import { botStateSweeperStats } from "../lib/bot-state";
+import { bulkProvisionStats } from "../lib/device-bulk";
+import { getPeerSlotStats } from "../lib/device-flow";
+import { entitlementCacheStats } from "../lib/entitlements";
+import { ipPoolStats } from "../lib/ipAllocator";
+import { jwtCacheStats } from "../lib/jwt-cache";
+import { keypairPoolStats } from "../lib/keypair-pool";
+import { nodeBreakerStats } from "../lib/node-breaker";
+import { nodeCacheStats } from "../lib/node-cache";
+import { paymentInboxStats } from "../lib/payment-inbox";
+import { provisionQueueStats } from "../lib/provision-queue";
+import { queryStats } from "../lib/query-stats";
+import { sshPoolStats } from "../lib/ssh-pool";
+import { subscriptionExpiryStats } from "../lib/subscription-expiry";
+import { tokenSweeperStats } from "../lib/token-sweeper";
+import { trafficStats } from "../lib/traffic";
+import { wgBatchStats } from "../lib/wg-batch";
+
+// Internal counters for load tests (tools/loadtest). Registered only with API_DEBUG_STATS=1.
+export async function registerDebugRoutes(app: FastifyInstance) {
+  // GET /v1/debug/stats
+  app.get("/v1/debug/stats", async () => ({
+    peerSlots: getPeerSlotStats(),
+    bulkProvision: bulkProvisionStats(),
+    ipPools: ipPoolStats(),
+    wgBatch: wgBatchStats(),
+    ssh: sshPoolStats(),
+    nodeBreakers: nodeBreakerStats(),
+    nodeCache: nodeCacheStats(),
+    provisionQueue: provisionQueueStats(),
+    paymentInbox: paymentInboxStats(),
+    prismaQueries: queryStats(),
+    entitlements: entitlementCacheStats(),
+    jwtCache: jwtCacheStats(),
+    configCache: configCacheStats(),
+    keypairPool: keypairPoolStats(),
+    tokenSweeper: tokenSweeperStats(),
+    botStateSweeper: botStateSweeperStats(),
+    subscriptionExpiry: subscriptionExpiryStats(),
+    traffic: trafficStats(),
+  }));
+}
@@ -1,5 +1,6 @@
 import type { FastifyInstance } from "fastify";
 import { randomUUID } from "node:crypto";
+import { Readable } from "node:stream";
 import { z } from "zod";
 import { prisma } from "../lib/prisma";
 import {
@@ -8,6 +9,7 @@ import {
   provisionDevicePeer,
   revokeDevicePeer,
 } from "../lib/device-flow";
+import { BULK_MAX_DEVICES, bulkProvisionDevices, type BulkDeviceLine } from "../lib/device-bulk";
 import { normalizePublicKey, WG_PUBLIC_KEY_RE } from "../lib/wg-keys";
 
 const CreateDeviceSchema = z.object({
@@ -16,14 +18,48 @@ const CreateDeviceSchema = z.object({
   name: z.string().min(1),
 });
 
+const PublicKeySchema = z
+  .string()
+  .transform((value) => normalizePublicKey(value))
+  .refine((value) => WG_PUBLIC_KEY_RE.test(value), { message: "invalid_wireguard_public_key" });
+
 const ProvisionSchema = z.object({
-  publicKey: z
-    .string()
-    .transform((value) => normalizePublicKey(value))
-    .refine((value) => WG_PUBLIC_KEY_RE.test(value), { message: "invalid_wireguard_public_key" })
-    .optional(),
+  publicKey: PublicKeySchema.optional(),
+  // 202 + jobId instead of waiting for the node; default from PROVISION_ASYNC
+  async: z.boolean().optional(),
+});
+
+const BulkProvisionSchema = z.object({
+  userId: z.string().min(1),
+  devices: z
+    .array(
+      z.object({
+        platform: z.string().min(1),
+        name: z.string().min(1),
+        publicKey: PublicKeySchema.optional(),
+      })
+    )
+    .min(1)
+    .max(BULK_MAX_DEVICES()),
 });
 
+// one JSON object per line; the last line summarizes (or reports an aborted run)
+async function* ndjsonLines(lines: AsyncIterable<BulkDeviceLine>, log: any) {
+  const summary = { total: 0, ok: 0, failed: 0 };
+  try {
+    for await (const line of lines) {
+      summary.total++;
+      if (line.error) summary.failed++;
+      else summary.ok++;
+      yield `${JSON.stringify(line)}\n`;
+    }
+    yield `${JSON.stringify({ done: true, ...summary })}\n`;
+  } catch (err) {
+    log?.error?.({ err }, "bulk provision aborted");
+    yield `${JSON.stringify({ done: false, error: "INTERNAL_SERVER_ERROR", ...summary })}\n`;
+  }
+}
+
 function replyWithDeviceFlowError(reply: any, error: unknown) {
   if (error instanceof DeviceFlowError) {
     return reply.code(error.statusCode).send({ error: error.code });
@@ -59,6 +95,19 @@ export async function registerDeviceRoutes(app: FastifyInstance) {
     return reply.code(201).send({ id: created.id, deviceId: created.deviceId, existing: false });
   });
 
+  // POST /v1/devices/bulk (NDJSON: one line per device, in completion order, then a summary line)
+  app.post("/v1/devices/bulk", { bodyLimit: 8 * 1024 * 1024 }, async (req: any, reply) => {
+    const body = BulkProvisionSchema.parse(req.body);
+
+    const lines = bulkProvisionDevices(prisma, {
+      userId: body.userId,
+      devices: body.devices,
+      logger: req.log,
+    });
+
+    return reply.type("application/x-ndjson").send(Readable.from(ndjsonLines(lines, req.log)));
+  });
+
   // GET /v1/devices/by-device-id/:deviceId
   app.get("/v1/devices/by-device-id/:deviceId", async (req: any, reply) => {
     const deviceId = z.string().min(1).parse((req.params as any).deviceId);
@@ -94,10 +143,12 @@ export async function registerDeviceRoutes(app: FastifyInstance) {
         deviceIdentifier: id,
         publicKey: body.publicKey,
         logger: req.log,
+        async: body.async,
       });
 
       return reply.code(result.statusCode).send({
         existing: result.existing,
+        jobId: result.jobId,
         peerId: result.peerId,
         allowedIp: result.allowedIp,
         nodeId: result.nodeId,
@@ -0,0 +1,28 @@
+import type { FastifyInstance } from "fastify";
+import { z } from "zod";
+import { prisma } from "../lib/prisma";
+import { getProvisionJob } from "../lib/provision-queue";
+
+export async function registerJobRoutes(app: FastifyInstance) {
+  // GET /v1/jobs/:id
+  app.get("/v1/jobs/:id", async (req: any, reply) => {
+    const id = z.string().min(1).parse((req.params as any).id);
+
+    const job = await getProvisionJob(prisma, id);
+    if (!job) return reply.code(404).send({ error: "job_not_found" });
+
+    return {
+      id: job.id,
+      status: job.status,
+      peerId: job.peerId,
+      nodeId: job.nodeId,
+      deviceId: job.deviceId,
+      attempts: job.attempts,
+      maxAttempts: job.maxAttempts,
+      lastError: job.lastError,
+      runAfter: job.runAfter,
+      createdAt: job.createdAt,
+      finishedAt: job.finishedAt,
+    };
+  });
+}
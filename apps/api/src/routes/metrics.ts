@@ -0,0 +1,151 @@
+import type { FastifyInstance } from "fastify";
+import { getPeerSlotStats } from "../lib/device-flow";
+import { ipPoolStats } from "../lib/ipAllocator";
+import { keypairPoolStats } from "../lib/keypair-pool";
+import { registerCollector, renderMetrics } from "../lib/metrics";
+import { nodeBreakerStats } from "../lib/node-breaker";
+import { getCachedNodes } from "../lib/node-cache";
+import { requireOpsToken } from "../lib/ops-auth";
+import { nodeLoad } from "../lib/node-registry";
+import { prisma } from "../lib/prisma";
+import { paymentInboxStats } from "../lib/payment-inbox";
+import { provisionQueueStats } from "../lib/provision-queue";
+import { subscriptionExpiryStats } from "../lib/subscription-expiry";
+import { tokenSweeperStats } from "../lib/token-sweeper";
+import { trafficStats } from "../lib/traffic";
+import { wgBatchStats } from "../lib/wg-batch";
+
+const BREAKER_STATE = { closed: 0, "half-open": 1, open: 2 } as const;
+
+let collectorsRegistered = false;
+
+function registerCollectors() {
+  if (collectorsRegistered) return;
+  collectorsRegistered = true;
+
+  const counter = (name: string, help: string, read: () => number) =>
+    registerCollector({ name, help, type: "counter", collect: () => [{ value: read() }] });
+
+  counter("peer_slot_reservations_total", "Peer slots reserved", () => getPeerSlotStats().reservations);
+  counter("peer_slot_retries_total", "reservePeerSlot retries after address/key conflicts", () => getPeerSlotStats().retries);
+  counter("peer_slot_failures_total", "reservePeerSlot calls that ran out of retries", () => getPeerSlotStats().failures);
+  counter("ip_pool_allocations_total", "Addresses taken from in-memory pools", () => ipPoolStats().allocations);
+  counter("ip_pool_releases_total", "Addresses returned to in-memory pools", () => ipPoolStats().releases);
+  counter("ip_pool_drift_marks_total", "Addresses found taken in the DB but free in the pool", () => ipPoolStats().driftMarks);
+  counter("wg_batch_batches_total", "Batched `wg set` invocations", () => wgBatchStats().batches);
+  counter("wg_batch_ops_total", "Peer ops applied through the batcher", () => wgBatchStats().ops);
+  counter("wg_batch_failed_ops_total", "Peer ops rejected by the batcher", () => wgBatchStats().failedOps);
+  counter("wg_batch_shed_ops_total", "Peer ops shed (breaker open / queue full)", () => wgBatchStats().shedOps);
+  counter("provision_jobs_done_total", "Provision jobs completed by this worker", () => provisionQueueStats().done);
+  counter("provision_jobs_failed_total", "Provision jobs failed by this worker", () => provisionQueueStats().failed);
+  counter("provision_jobs_retried_total", "Provision jobs rescheduled by this worker", () => provisionQueueStats().retried);
+
+  counter("wg_keypool_taken_total", "Server-side keypairs handed out", () => keypairPoolStats().taken);
+  counter("wg_keypool_fallbacks_total", "Keypairs generated on the request path (pool empty)", () => keypairPoolStats().fallbacks);
+  counter("payment_callbacks_received_total", "Verified payment callbacks stored in the inbox", () => paymentInboxStats().received);
+  counter("payment_callbacks_duplicate_total", "Payment callbacks dropped as provider retries", () => paymentInboxStats().duplicates);
+  counter("payment_callbacks_paid_total", "Payment callbacks that marked a payment PAID", () => paymentInboxStats().paid);
+  counter("payment_callbacks_rejected_total", "Payment callbacks for unknown invoices or wrong amounts", () => paymentInboxStats().rejected);
+  counter("payment_callbacks_failed_total", "Payment callbacks given up after retries", () => paymentInboxStats().failed);
+  counter("token_sweep_connect_deleted_total", "Expired or used connect tokens deleted", () => tokenSweeperStats().connectDeleted);
+  counter("token_sweep_magic_deleted_total", "Expired or used magic-link tokens deleted", () => tokenSweeperStats().magicDeleted);
+  counter("subscription_expiry_subscriptions_total", "Subscriptions marked EXPIRED by the sweeper", () => subscriptionExpiryStats().subscriptionsExpired);
+  counter("subscription_expiry_peers_revoked_total", "Peers revoked because their subscription expired", () => subscriptionExpiryStats().peersRevoked);
+  counter("subscription_expiry_node_calls_total", "Batched peer removals sent to nodes by the sweeper", () => subscriptionExpiryStats().nodeCalls);
+  counter("subscription_expiry_node_failures_total", "Batched peer removals that failed (left to reconcile-wg)", () => subscriptionExpiryStats().nodeFailures);
+  counter("subscription_expiry_dry_run_subscriptions_total", "Subscriptions a dry run would have expired", () => subscriptionExpiryStats().dryRunSubscriptions);
+  counter("traffic_ingest_rows_total", "Per-peer minute deltas written by traffic accounting", () => trafficStats().ingestRows);
+  counter("traffic_ingest_errors_total", "Node samples that could not be accounted", () => trafficStats().ingestErrors);
+  counter("traffic_rollup_rows_total", "Hour and day traffic rows written by rollups", () => trafficStats().hourRows + trafficStats().dayRows);
+  counter("traffic_pruned_rows_total", "Rolled-up traffic rows deleted after retention", () => trafficStats().prunedRows);
+
+  registerCollector({
+    name: "traffic_accounted_bytes_total",
+    help: "Peer transfer accounted from node samples",
+    type: "counter",
+    collect: () => {
+      const s = trafficStats();
+      return [
+        { labels: { direction: "rx" }, value: s.rxBytes },
+        { labels: { direction: "tx" }, value: s.txBytes },
+      ];
+    },
+  });
+
+  registerCollector({
+    name: "wg_keypool_depth",
+    help: "Pre-generated keypairs ready in the pool",
+    type: "gauge",
+    collect: () => [{ value: keypairPoolStats().depth }],
+  });
+
+  registerCollector({
+    name: "provision_jobs_running",
+    help: "Provision jobs running in this worker",
+    type: "gauge",
+    collect: () => [{ value: provisionQueueStats().running }],
+  });
+
+  registerCollector({
+    name: "wg_node_breaker_state",
+    help: "Node circuit breaker state (0 closed, 1 half-open, 2 open)",
+    type: "gauge",
+    collect: () => nodeBreakerStats().map((b) => ({ labels: { node: b.key }, value: BREAKER_STATE[b.state] })),
+  });
+
+  registerCollector({
+    name: "wg_active_peers",
+    help: "Active (not revoked) peers per node",
+    type: "gauge",
+    collect: async () => {
+      const rows = await prisma.peer.groupBy({
+        by: ["nodeId"],
+        where: { revokedAt: null },
+        _count: { _all: true },
+      });
+      return rows.map((r) => ({ labels: { node: r.nodeId }, value: r._count._all }));
+    },
+  });
+
+  // one scrape builds the pool loads once, the three gauges share it
+  let poolLoads: Promise<Awaited<ReturnType<typeof nodeLoad>>[]> | null = null;
+  const loads = () => {
+    if (!poolLoads) {
+      poolLoads = getCachedNodes(prisma)
+        .then((nodes) => Promise.all(nodes.filter((n) => n.enabled).map((n) => nodeLoad(prisma, n))))
+        .finally(() => setTimeout(() => (poolLoads = null), 1_000).unref());
+    }
+    return poolLoads;
+  };
+
+  registerCollector({
+    name: "ip_pool_limit",
+    help: "Usable addresses per node: min(pool size, capacity)",
+    type: "gauge",
+    collect: async () => (await loads()).map((l) => ({ labels: { node: l.node.id }, value: l.limit })),
+  });
+  registerCollector({
+    name: "ip_pool_used",
+    help: "Addresses in use per node",
+    type: "gauge",
+    collect: async () => (await loads()).map((l) => ({ labels: { node: l.node.id }, value: l.used })),
+  });
+  registerCollector({
+    name: "ip_pool_utilization_ratio",
+    help: "Used share of usable addresses per node",
+    type: "gauge",
+    collect: async () =>
+      (await loads()).map((l) => ({ labels: { node: l.node.id }, value: l.limit ? l.used / l.limit : 1 })),
+  });
+}
+
+export async function registerMetricsRoutes(app: FastifyInstance) {
+  registerCollectors();
+
+  // GET /metrics (Prometheus text format); METRICS_TOKEN bearer required
+  app.get("/metrics", { preHandler: requireOpsToken }, async (_req, reply) => {
+    return reply
+      .header("content-type", "text/plain; version=0.0.4; charset=utf-8")
+      .send(await renderMetrics());
+  });
+}
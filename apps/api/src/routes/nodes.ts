@@ -0,0 +1,61 @@
+import type { FastifyInstance } from "fastify";
+import { z } from "zod";
+import { requireOpsToken } from "../lib/ops-auth";
+import { getNodeSnapshot, isPeerOnline, listNodeSnapshots } from "../lib/wg-stats";
+
+// Node state served from the poller cache (lib/wg-stats.ts); no SSH on the request path.
+// Ops data (peer keys, traffic, client endpoints): METRICS_TOKEN bearer, like /metrics.
+export async function registerNodeRoutes(app: FastifyInstance) {
+  // GET /v1/nodes/stats
+  app.get("/v1/nodes/stats", { preHandler: requireOpsToken }, async () => {
+    const nowSec = Math.floor(Date.now() / 1000);
+
+    const items = listNodeSnapshots().map((snap) => {
+      let online = 0;
+      let rxBytes = 0;
+      let txBytes = 0;
+      for (const p of snap.peers.values()) {
+        if (isPeerOnline(p, nowSec)) online++;
+        rxBytes += p.rxBytes;
+        txBytes += p.txBytes;
+      }
+
+      return {
+        nodeId: snap.nodeId,
+        polledAt: snap.polledAt ? new Date(snap.polledAt) : null,
+        pollMs: snap.pollMs,
+        error: snap.error,
+        errorAt: snap.errorAt ? new Date(snap.errorAt) : null,
+        peers: snap.peers.size,
+        online,
+        rxBytes,
+        txBytes,
+      };
+    });
+
+    return { items, total: items.length };
+  });
+
+  // GET /v1/nodes/:id/peers
+  app.get("/v1/nodes/:id/peers", { preHandler: requireOpsToken }, async (req: any, reply) => {
+    const id = z.string().min(1).parse((req.params as any).id);
+
+    const snap = getNodeSnapshot(id);
+    if (!snap) return reply.code(404).send({ error: "node_stats_not_found" });
+
+    const nowSec = Math.floor(Date.now() / 1000);
+    const items = [...snap.peers.entries()].map(([publicKey, p]) => ({
+      publicKey,
+      ...p,
+      online: isPeerOnline(p, nowSec),
+    }));
+
+    return {
+      nodeId: snap.nodeId,
+      polledAt: snap.polledAt ? new Date(snap.polledAt) : null,
+      error: snap.error,
+      items,
+      total: items.length,
+    };
+  });
+}
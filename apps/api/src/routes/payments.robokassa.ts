@@ -1,5 +1,15 @@
 import { FastifyPluginAsync } from "fastify";
-import { buildPaymentSigBase, buildResultSigBase, formatOutSum, hashHex, normSig, pickShpParams, RoboHashAlg } from "../lib/robokassa";
+import { applyRobokassaResult, enqueueRobokassaCallback, paymentInboxEnabled } from "../lib/payment-inbox";
+import {
+  buildPaymentSigBase,
+  buildResultSigBase,
+  formatOutSum,
+  hashHex,
+  normSig,
+  pickShpParams,
+  RoboHashAlg,
+  robokassaIsTest,
+} from "../lib/robokassa";
 
 function mustEnv(name: string): string {
   const v = process.env[name];
@@ -12,11 +22,6 @@ function alg(): RoboHashAlg {
   return v === "SHA256" ? "SHA256" : "MD5";
 }
 
-function isTest(): boolean {
-  const v = (process.env.ROBOKASSA_IS_TEST ?? "1").trim().toLowerCase();
-  return v === "1" || v === "true";
-}
-
 export const paymentsRobokassaRoutes: FastifyPluginAsync = async (fastify) => {
   fastify.post("/v1/payments/robokassa/create", async (req, reply) => {
     const body = (req.body ?? {}) as any;
@@ -33,7 +38,7 @@ export const paymentsRobokassaRoutes: FastifyPluginAsync = async (fastify) => {
 
     const merchantLogin = mustEnv("ROBOKASSA_MERCHANT_LOGIN");
     const pass1 = mustEnv("ROBOKASSA_PASSWORD1");
-    const test = isTest();
+    const test = robokassaIsTest();
 
     const outSum = formatOutSum(plan.priceKopeks, test);
     const invId = String(pay.invId);
@@ -70,7 +75,7 @@ export const paymentsRobokassaRoutes: FastifyPluginAsync = async (fastify) => {
     const outSum = String(p.OutSum ?? "");
     const invId = String(p.InvId ?? "");
     const sig = String(p.SignatureValue ?? "");
-    if (!outSum || !invId || !sig) return reply.code(400).send("bad request");
+    if (!outSum || !/^\d+$/.test(invId) || !sig) return reply.code(400).send("bad request");
 
     const pass2 = mustEnv("ROBOKASSA_PASSWORD2");
 
@@ -80,48 +85,17 @@ export const paymentsRobokassaRoutes: FastifyPluginAsync = async (fastify) => {
 
     if (normSig(expected) !== normSig(sig)) return reply.code(400).send("bad sign");
 
-    const payment = await fastify.prisma.payment.findUnique({
-      where: { invId: BigInt(invId) },
-      include: { plan: true },
-    });
-    if (!payment) return reply.code(404).send("payment_not_found");
-
-    // amount check
-    const expectedOutSum = formatOutSum(payment.amountKopeks, isTest());
-    if (String(expectedOutSum) !== String(outSum)) {
-      await fastify.prisma.payment.update({
-        where: { invId: BigInt(invId) },
-        data: { rawPayload: (p as any), outSumRaw: outSum, status: "FAILED" },
-      });
-      return reply.code(400).send("bad amount");
-    }
-
-    // idempotent: if already PAID, just OK
-    if (payment.status === "PAID") {
+    // burst mode (default): store and answer right away, the inbox worker applies it
+    if (paymentInboxEnabled()) {
+      await enqueueRobokassaCallback(fastify.prisma, { invId: BigInt(invId), outSum, payload: p });
       return reply.type("text/plain").send(`OK${invId}`);
     }
 
-    await fastify.prisma.$transaction(async (tx) => {
-      await tx.payment.update({
-        where: { invId: BigInt(invId) },
-        data: {
-          status: "PAID",
-          paidAt: new Date(),
-          rawPayload: (p as any),
-          outSumRaw: outSum,
-        },
-      });
-
-      const now = new Date();
-      const plan = payment.plan;
-      const activeUntil = new Date(now.getTime() + plan.durationDays * 24 * 60 * 60 * 1000);
-
-      await tx.subscription.upsert({
-        where: { userId: payment.userId },
-        update: { planId: plan.id, status: "ACTIVE", activeFrom: now, activeUntil, deviceLimit: plan.deviceLimit },
-        create: { userId: payment.userId, planId: plan.id, status: "ACTIVE", activeFrom: now, activeUntil, deviceLimit: plan.deviceLimit },
-      });
-    });
+    const result = await fastify.prisma.$transaction((tx) =>
+      applyRobokassaResult(tx, { invId: BigInt(invId), outSum, payload: p, isTest: robokassaIsTest() })
+    );
+    if (result === "not_found") return reply.code(404).send("payment_not_found");
+    if (result === "bad_amount") return reply.code(400).send("bad amount");
 
     return reply.type("text/plain").send(`OK${invId}`);
   });
@@ -1,4 +1,5 @@
 import { FastifyPluginAsync } from "fastify";
+import { syncEntitlementSubscription } from "../lib/entitlements";
 
 export const subscriptionsRoutes: FastifyPluginAsync = async (fastify) => {
   // MVP read: пока по query userId (позже заменим на jwt)
@@ -34,10 +35,14 @@ export const subscriptionsRoutes: FastifyPluginAsync = async (fastify) => {
     const now = new Date();
     const activeUntil = new Date(now.getTime() + plan.durationDays * 24 * 60 * 60 * 1000);
 
-    const sub = await fastify.prisma.subscription.upsert({
-      where: { userId },
-      update: { planId: plan.id, status: "ACTIVE", activeFrom: now, activeUntil, deviceLimit: plan.deviceLimit },
-      create: { userId, planId: plan.id, status: "ACTIVE", activeFrom: now, activeUntil, deviceLimit: plan.deviceLimit },
+    const sub = await fastify.prisma.$transaction(async (tx) => {
+      const s = await tx.subscription.upsert({
+        where: { userId },
+        update: { planId: plan.id, status: "ACTIVE", activeFrom: now, activeUntil, deviceLimit: plan.deviceLimit },
+        create: { userId, planId: plan.id, status: "ACTIVE", activeFrom: now, activeUntil, deviceLimit: plan.deviceLimit },
+      });
+      await syncEntitlementSubscription(tx, userId, s);
+      return s;
     });
 
     return { subscription: sub };
@@ -0,0 +1,66 @@
+import type { FastifyInstance } from "fastify";
+import { z } from "zod";
+import { requireOpsToken } from "../lib/ops-auth";
+import { prisma } from "../lib/prisma";
+import { trafficUsage } from "../lib/traffic";
+
+// Traffic usage from PeerTraffic rollups (lib/traffic.ts); raw minute rows are
+// read only for the edges of the range and the last, not yet rolled-up hour.
+
+const MAX_RANGE_MS = { hour: 31 * 24 * 60 * 60_000, day: 400 * 24 * 60 * 60_000 } as const;
+const DEFAULT_RANGE_MS = { hour: 24 * 60 * 60_000, day: 30 * 24 * 60 * 60_000 } as const;
+const NODE_TOP_USERS = 100;
+
+const UsageQuerySchema = z.object({
+  from: z.coerce.date().optional(),
+  to: z.coerce.date().optional(),
+  step: z.enum(["hour", "day"]).default("hour"),
+});
+
+function parseRange(query: unknown) {
+  const q = UsageQuerySchema.parse(query ?? {});
+  const to = q.to ?? new Date();
+  const from = q.from ?? new Date(to.getTime() - DEFAULT_RANGE_MS[q.step]);
+  if (from >= to) return { error: "invalid_range" as const };
+  if (to.getTime() - from.getTime() > MAX_RANGE_MS[q.step]) return { error: "range_too_large" as const };
+  return { from, to, step: q.step };
+}
+
+export async function registerUsageRoutes(app: FastifyInstance) {
+  // GET /v1/users/:userId/usage?from&to&step=hour|day
+  app.get("/v1/users/:userId/usage", async (req: any, reply) => {
+    const userId = z.string().min(1).parse((req.params as any).userId);
+    const range = parseRange(req.query);
+    if ("error" in range) return reply.code(400).send({ error: range.error });
+
+    const { breakdown, ...usage } = await trafficUsage(prisma, { userId }, range);
+    return { userId, ...usage, devices: breakdown.map(({ id, ...v }) => ({ deviceId: id, ...v })) };
+  });
+
+  // GET /v1/devices/:id/usage
+  app.get("/v1/devices/:id/usage", async (req: any, reply) => {
+    const id = z.string().min(1).parse((req.params as any).id);
+    const range = parseRange(req.query);
+    if ("error" in range) return reply.code(400).send({ error: range.error });
+
+    const device = await prisma.device.findUnique({ where: { id }, select: { id: true, userId: true } });
+    if (!device) return reply.code(404).send({ error: "device_not_found" });
+
+    const { breakdown: _, ...usage } = await trafficUsage(prisma, { userId: device.userId, deviceId: device.id }, range);
+    return { deviceId: device.id, userId: device.userId, ...usage };
+  });
+
+  // GET /v1/nodes/:id/usage — totals plus the top users of the node; ops data like /v1/nodes/stats
+  app.get("/v1/nodes/:id/usage", { preHandler: requireOpsToken }, async (req: any, reply) => {
+    const nodeId = z.string().min(1).parse((req.params as any).id);
+    const range = parseRange(req.query);
+    if ("error" in range) return reply.code(400).send({ error: range.error });
+
+    const { breakdown, ...usage } = await trafficUsage(prisma, { nodeId }, range);
+    return {
+      nodeId,
+      ...usage,
+      users: breakdown.slice(0, NODE_TOP_USERS).map(({ id, ...v }) => ({ userId: id, ...v })),
+    };
+  });
+}
@@ -4,9 +4,12 @@ import { ProvisionInputSchema, provisionIosPeer, revokePeer } from "../lib/vpn-p
 import { renderClientConfig } from "../lib/wg-config";
 import { prisma } from "../lib/prisma";
 import { env } from "../env";
+import { verifyJwtCached } from "../lib/jwt-cache";
+import { etagMatches, getRenderedConfig, peerConfigKey } from "../lib/config-cache";
+import { getCachedNode } from "../lib/node-cache";
 
-async function requireAuth(req: any) {
-  await req.jwtVerify();
+async function requireAuth(req: any, reply: any) {
+  if (!(await verifyJwtCached(req, reply))) return reply;
 }
 
 function getUserId(req: any): string | null {
@@ -108,9 +111,17 @@ export async function registerVpnRoutes(app: FastifyInstance) {
 
       const peerId = z.string().min(1).parse((req.params as any).peerId);
 
+      // ownership check + the fields the config depends on; the node comes from the node cache
       const peer = await prisma.peer.findFirst({
         where: { id: peerId, userId },
-        include: { node: true, device: true },
+        select: {
+          id: true,
+          publicKey: true,
+          allowedIp: true,
+          nodeId: true,
+          deviceId: true,
+          device: { select: { deviceId: true } },
+        },
       });
 
       if (!peer) return reply.code(404).send({ error: "peer_not_found" });
@@ -118,26 +129,38 @@ export async function registerVpnRoutes(app: FastifyInstance) {
       // можно запретить выдачу для revoked, но для дебага иногда полезно
       // if (peer.revokedAt) return reply.code(410).send({ error: "peer_revoked" });
 
-      const template = buildConfigTemplate({
-        addressIp: peer.allowedIp,
-        dns: env.WG_CLIENT_DNS,
-        serverPublicKey: peer.node.serverPublicKey,
-        endpointHost: peer.node.endpointHost,
-        endpointPort: peer.node.wgPort,
-      });
+      const node = await getCachedNode(prisma, peer.nodeId);
+      if (!node) return reply.code(500).send({ error: "node_not_found" });
+
+      const renderTemplate = () =>
+        buildConfigTemplate({
+          addressIp: peer.allowedIp,
+          dns: env.WG_CLIENT_DNS,
+          serverPublicKey: node.serverPublicKey,
+          endpointHost: node.endpointHost,
+          endpointPort: node.wgPort,
+        });
 
       const q = (req.query ?? {}) as any;
       const clientPrivateKey =
-        typeof q.clientPrivateKey === "string" ? q.clientPrivateKey : undefined;
-
-      const cfg = renderClientConfig({ template, clientPrivateKey });
+        typeof q.clientPrivateKey === "string" ? q.clientPrivateKey.trim() : "";
 
       const fnameBase = safeFilename(peer.device?.deviceId || peer.deviceId || "device");
       const filename = `cloudgate-${fnameBase}.conf`;
 
       reply.header("content-type", "text/plain; charset=utf-8");
       reply.header("content-disposition", `attachment; filename="${filename}"`);
-      return reply.send(cfg);
+
+      // a caller-supplied private key is never cached
+      if (clientPrivateKey) {
+        return reply.send(renderClientConfig({ template: renderTemplate(), clientPrivateKey }));
+      }
+
+      const cfg = getRenderedConfig(peerConfigKey(peer, node, env.WG_CLIENT_DNS, "template"), renderTemplate);
+      reply.header("etag", cfg.etag);
+      reply.header("cache-control", "private, no-cache");
+      if (etagMatches(req.headers["if-none-match"], cfg.etag)) return reply.code(304).send();
+      return reply.send(cfg.body);
     }
   );
 }
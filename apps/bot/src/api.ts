@@ -0,0 +1,188 @@
+import http from "node:http";
+import https from "node:https";
+
+// API client for the bot.
+// All calls go through one keep-alive agent, so a button press reuses an open
+// connection instead of paying TCP (and TLS) setup. The device id of a Telegram
+// user never changes, so it is cached after the first POST /v1/devices; the last
+// client config is cached per user until revoke (or BOT_CONFIG_CACHE_TTL_MS).
+// Provision/revoke are single-flight per Telegram user: a double tap joins the
+// call that is already running instead of sending a second one.
+
+function numEnv(name: string, fallback: number): number {
+  const n = Number(process.env[name]);
+  return Number.isFinite(n) && n >= 0 ? n : fallback;
+}
+
+const API_BASE_URL = process.env.API_BASE_URL || "http://localhost:3001";
+const API_TIMEOUT_MS = numEnv("BOT_API_TIMEOUT_MS", 30_000);
+const DEVICE_CACHE_MAX = Math.max(1, numEnv("BOT_DEVICE_CACHE_MAX", 50_000));
+const CONFIG_CACHE_MAX = Math.max(1, numEnv("BOT_CONFIG_CACHE_MAX", 10_000));
+// also bounds staleness when a peer is revoked outside the bot (admin, expiry)
+const CONFIG_CACHE_TTL_MS = numEnv("BOT_CONFIG_CACHE_TTL_MS", 10 * 60_000);
+
+const base = new URL(API_BASE_URL);
+const secure = base.protocol === "https:";
+const agentOptions = {
+  keepAlive: true,
+  maxSockets: Math.max(1, numEnv("BOT_API_MAX_SOCKETS", 32)),
+  maxFreeSockets: 8,
+};
+const agent = secure ? new https.Agent(agentOptions) : new http.Agent(agentOptions);
+const request: typeof http.request = secure ? https.request : http.request;
+
+export class ApiError extends Error {
+  status: number;
+  code: string | null;
+
+  constructor(path: string, status: number, body: string) {
+    super(`API ${path} failed: ${status} ${body}`);
+    this.name = "ApiError";
+    this.status = status;
+    let code: string | null = null;
+    try {
+      code = JSON.parse(body)?.error ?? null;
+    } catch {
+      // not JSON
+    }
+    this.code = code;
+  }
+}
+
+export async function api<T = any>(
+  path: string,
+  init?: { method?: string; body?: string; headers?: Record<string, string> }
+): Promise<T> {
+  const url = new URL(path, base);
+  const body = init?.body;
+
+  const { status, text } = await new Promise<{ status: number; text: string }>((resolve, reject) => {
+    const req = request(
+      url,
+      {
+        method: init?.method ?? "GET",
+        agent,
+        timeout: API_TIMEOUT_MS,
+        headers: {
+          "content-type": "application/json",
+          ...(body !== undefined ? { "content-length": Buffer.byteLength(body) } : {}),
+          ...init?.headers,
+        },
+      },
+      (res) => {
+        const chunks: Buffer[] = [];
+        res.on("data", (c: Buffer) => chunks.push(c));
+        res.on("end", () => resolve({ status: res.statusCode ?? 0, text: Buffer.concat(chunks).toString("utf8") }));
+        res.on("error", reject);
+      }
+    );
+    req.on("timeout", () => req.destroy(new Error(`API ${path} timed out after ${API_TIMEOUT_MS}ms`)));
+    req.on("error", reject);
+    req.end(body);
+  });
+
+  if (status < 200 || status >= 300) throw new ApiError(path, status, text);
+  return JSON.parse(text) as T;
+}
+
+// Map keeps insertion order: re-inserting on hit makes the first key the least recently used
+function lruGet<V>(map: Map<string, V>, key: string): V | undefined {
+  const v = map.get(key);
+  if (v !== undefined) {
+    map.delete(key);
+    map.set(key, v);
+  }
+  return v;
+}
+
+function lruSet<V>(map: Map<string, V>, key: string, value: V, max: number) {
+  map.delete(key);
+  map.set(key, value);
+  while (map.size > max) map.delete(map.keys().next().value as string);
+}
+
+const deviceIds = new Map<string, string>(); // tg:<id> -> Device.id
+const configs = new Map<string, { clientConfig: string; expiresAt: number }>(); // tg:<id> -> last config
+
+// bumped by revoke: a provision that started before it must not cache its config
+const generations = new Map<string, number>();
+const inFlight = new Map<string, Promise<unknown>>();
+
+function userKey(tgUserId: number) {
+  return `tg:${tgUserId}`;
+}
+
+function singleFlight<T>(key: string, fn: () => Promise<T>): Promise<T> {
+  const running = inFlight.get(key);
+  if (running) return running as Promise<T>;
+  const p = fn().finally(() => inFlight.delete(key));
+  inFlight.set(key, p);
+  return p;
+}
+
+async function ensureDevice(tgUserId: number): Promise<string> {
+  const userId = userKey(tgUserId);
+  const cached = lruGet(deviceIds, userId);
+  if (cached) return cached;
+
+  const body = { userId, platform: "IOS", name: "iphone" };
+  const dev = await api<{ id: string }>(`/v1/devices`, {
+    method: "POST",
+    body: JSON.stringify(body),
+  });
+  lruSet(deviceIds, userId, dev.id, DEVICE_CACHE_MAX);
+  return dev.id;
+}
+
+async function provision(deviceId: string) {
+  return api<{ clientConfig: string; peerId: string; nodeId: string }>(`/v1/devices/${deviceId}/provision`, {
+    method: "POST",
+    body: JSON.stringify({}),
+  });
+}
+
+async function revoke(deviceId: string) {
+  return api<{ revoked: boolean; peerId?: string; deviceId?: string; nodeId?: string }>(
+    `/v1/devices/${deviceId}/revoke`,
+    {
+      method: "POST",
+      body: JSON.stringify({}),
+    }
+  );
+}
+
+// a cached device id may point at a device that no longer exists: look it up again once
+async function withDevice<T>(tgUserId: number, fn: (deviceId: string) => Promise<T>): Promise<T> {
+  const deviceId = await ensureDevice(tgUserId);
+  try {
+    return await fn(deviceId);
+  } catch (err) {
+    if (!(err instanceof ApiError) || err.code !== "device_not_found") throw err;
+    deviceIds.delete(userKey(tgUserId));
+    return fn(await ensureDevice(tgUserId));
+  }
+}
+
+// "Получить VPN": 0 API calls with a cached config, 1 with a cached device id
+export async function getClientConfig(tgUserId: number): Promise<string> {
+  const key = userKey(tgUserId);
+  const cached = lruGet(configs, key);
+  if (cached && cached.expiresAt > Date.now()) return cached.clientConfig;
+
+  return singleFlight(`provision:${key}`, async () => {
+    const generation = generations.get(key) ?? 0;
+    const data = await withDevice(tgUserId, provision);
+    if ((generations.get(key) ?? 0) === generation) {
+      lruSet(configs, key, { clientConfig: data.clientConfig, expiresAt: Date.now() + CONFIG_CACHE_TTL_MS }, CONFIG_CACHE_MAX);
+    }
+    return data.clientConfig;
+  });
+}
+
+export async function revokeVpn(tgUserId: number) {
+  const key = userKey(tgUserId);
+  // drop first: even if revoke fails halfway the next "Получить VPN" asks the API
+  configs.delete(key);
+  lruSet(generations, key, (generations.get(key) ?? 0) + 1, CONFIG_CACHE_MAX);
+  return singleFlight(`revoke:${key}`, () => withDevice(tgUserId, revoke));
+}
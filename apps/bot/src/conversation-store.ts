@@ -0,0 +1,122 @@
+import { api, ApiError } from "./api.js";
+
+// Conversation state of the support flow ("waiting for the user's message",
+// "this admin is replying to user X"). Every entry has a TTL, so abandoned
+// conversations disappear by themselves.
+//
+// - memory (default): bounded map in this process; lost on restart, one replica only.
+// - api: rows in the API's Postgres (BotConversationState, /v1/bot/state/*),
+//   shared by all bot replicas and kept across restarts.
+
+function numEnv(name: string, fallback: number): number {
+  const n = Number(process.env[name]);
+  return Number.isFinite(n) && n >= 0 ? n : fallback;
+}
+
+export const CONVERSATION_TTL_MS = Math.max(1_000, numEnv("BOT_STATE_TTL_MS", 30 * 60_000));
+
+export interface ConversationStore {
+  get(key: string): Promise<string | null>;
+  set(key: string, value: string, ttlMs?: number): Promise<void>;
+  delete(key: string): Promise<void>;
+  /** get + delete in one step: of two concurrent takes only one gets the value */
+  take(key: string): Promise<string | null>;
+}
+
+export class MemoryConversationStore implements ConversationStore {
+  // Map keeps insertion order: set() re-inserts, so the first key is the oldest write
+  private entries = new Map<string, { value: string; expiresAt: number }>();
+  private sweeper: NodeJS.Timeout;
+
+  constructor(private readonly maxEntries = 10_000) {
+    this.sweeper = setInterval(() => this.sweep(), 60_000);
+    this.sweeper.unref();
+  }
+
+  private sweep() {
+    const now = Date.now();
+    for (const [key, e] of this.entries) if (e.expiresAt <= now) this.entries.delete(key);
+  }
+
+  async get(key: string) {
+    const e = this.entries.get(key);
+    if (!e) return null;
+    if (e.expiresAt <= Date.now()) {
+      this.entries.delete(key);
+      return null;
+    }
+    return e.value;
+  }
+
+  async set(key: string, value: string, ttlMs = CONVERSATION_TTL_MS) {
+    this.entries.delete(key);
+    this.entries.set(key, { value, expiresAt: Date.now() + ttlMs });
+    while (this.entries.size > this.maxEntries) this.entries.delete(this.entries.keys().next().value as string);
+  }
+
+  async delete(key: string) {
+    this.entries.delete(key);
+  }
+
+  async take(key: string) {
+    const value = await this.get(key);
+    this.entries.delete(key);
+    return value;
+  }
+}
+
+export class ApiConversationStore implements ConversationStore {
+  private readonly headers: Record<string, string>;
+
+  constructor(token: string) {
+    this.headers = { authorization: `Bearer ${token}` };
+  }
+
+  private path(key: string) {
+    return `/v1/bot/state/${encodeURIComponent(key)}`;
+  }
+
+  async get(key: string) {
+    try {
+      const row = await api<{ value: string }>(this.path(key), { headers: this.headers });
+      return row.value;
+    } catch (err) {
+      if (err instanceof ApiError && err.status === 404) return null;
+      throw err;
+    }
+  }
+
+  async set(key: string, value: string, ttlMs = CONVERSATION_TTL_MS) {
+    await api(this.path(key), {
+      method: "PUT",
+      body: JSON.stringify({ value, ttlMs }),
+      headers: this.headers,
+    });
+  }
+
+  async delete(key: string) {
+    await this.take(key);
+  }
+
+  async take(key: string) {
+    try {
+      const row = await api<{ value: string }>(this.path(key), { method: "DELETE", headers: this.headers });
+      return row.value;
+    } catch (err) {
+      if (err instanceof ApiError && err.status === 404) return null;
+      throw err;
+    }
+  }
+}
+
+export function createConversationStore(): ConversationStore {
+  const kind = (process.env.BOT_STATE_STORE ?? "memory").trim().toLowerCase();
+  if (kind === "api") {
+    // the API refuses /v1/bot/state without a token, fail at startup instead of on the first message
+    const token = process.env.BOT_STATE_TOKEN;
+    if (!token) throw new Error("BOT_STATE_STORE=api requires BOT_STATE_TOKEN (same value as the API)");
+    return new ApiConversationStore(token);
+  }
+  if (kind !== "memory") throw new Error(`BOT_STATE_STORE must be "memory" or "api" (got "${kind}")`);
+  return new MemoryConversationStore(Math.max(1, numEnv("BOT_STATE_MAX_ENTRIES", 10_000)));
+}
@@ -1,61 +1,18 @@
 import "dotenv/config";
 import { Bot, InlineKeyboard, InputFile } from "grammy";
+import { getClientConfig, revokeVpn } from "./api.js";
+import { createConversationStore } from "./conversation-store.js";
+import { catchErrors, runPolling, runWebhook, sequentialize } from "./runner.js";
 
 const BOT_TOKEN = process.env.BOT_TOKEN;
-const API_BASE_URL = process.env.API_BASE_URL || "http://localhost:3001";
 const SUPPORT_CHAT_ID = process.env.SUPPORT_CHAT_ID ? Number(process.env.SUPPORT_CHAT_ID) : null;
 
 if (!BOT_TOKEN) throw new Error("BOT_TOKEN is required (set BOT_TOKEN env var)");
 
-// MVP: support state in-memory (restart resets it)
-const awaitingSupportMessage = new Set<number>();
-
-async function api<T = any>(path: string, init?: RequestInit): Promise<T> {
-  const res = await fetch(`${API_BASE_URL}${path}`, {
-    ...init,
-    headers: {
-      "content-type": "application/json",
-      ...(init?.headers || {}),
-    },
-  });
-
-  if (!res.ok) {
-    const text = await res.text().catch(() => "");
-    throw new Error(`API ${path} failed: ${res.status} ${res.statusText} ${text}`);
-  }
-
-  return (await res.json()) as T;
-}
-
-async function ensureDevice(tgUserId: number) {
-  const userId = `tg:${tgUserId}`;
-  const body = { userId, platform: "IOS", name: "iphone" };
-  return api<{ id: string }>(`/v1/devices`, {
-    method: "POST",
-    body: JSON.stringify(body),
-  });
-}
-
-async function provision(deviceId: string) {
-  return api<{
-    clientConfig: string;
-    node: { id: string; endpointHost: string; wgPort: number; serverPublicKey: string };
-    peer: { id: string; allowedIp: string; publicKey: string; revokedAt: string | null };
-  }>(`/v1/devices/${deviceId}/provision`, {
-    method: "POST",
-    body: JSON.stringify({}),
-  });
-}
-
-async function revoke(deviceId: string) {
-  return api<{ revoked: boolean; peerId?: string; deviceId?: string; nodeId?: string }>(
-    `/v1/devices/${deviceId}/revoke`,
-    {
-      method: "POST",
-      body: JSON.stringify({}),
-    }
-  );
-}
+// support flow state with TTL: in-memory or shared by replicas (BOT_STATE_STORE=api)
+const conversations = createConversationStore();
+const supportMessageKey = (tgId: number) => `support_msg:${tgId}`;
+const supportReplyKey = (adminId: number) => `support_reply:${adminId}`;
 
 function mainKeyboard() {
   return new InlineKeyboard()
@@ -79,6 +36,9 @@ bot.catch((err) => {
   console.error("BOT_ERROR", err);
 });
 
+bot.use(catchErrors(bot));
+bot.use(sequentialize());
+
 bot.command("start", async (ctx) => {
   await ctx.reply(
     "Я могу выдать конфиг WireGuard (.conf) и отключить доступ.\n\nВыбирай действие:",
@@ -93,11 +53,10 @@ bot.callbackQuery("get_vpn", async (ctx) => {
 
   await ctx.reply("Ок, готовлю конфиг…");
 
-  const dev = await ensureDevice(tgId);
-  const data = await provision(dev.id);
+  const clientConfig = await getClientConfig(tgId);
 
   const filename = `cloudgate_${tgId}.conf`;
-  const input = new InputFile(Buffer.from(data.clientConfig, "utf8"), filename);
+  const input = new InputFile(Buffer.from(clientConfig, "utf8"), filename);
 
   await ctx.replyWithDocument(input, {
     caption:
@@ -111,8 +70,7 @@ bot.callbackQuery("revoke_vpn", async (ctx) => {
   const tgId = ctx.from?.id;
   if (!tgId) return;
 
-  const dev = await ensureDevice(tgId);
-  const r = await revoke(dev.id);
+  const r = await revokeVpn(tgId);
 
   if (r.revoked) {
     await ctx.reply("Отключил доступ. Если надо вернуть, нажми «Получить VPN».", {
@@ -138,7 +96,7 @@ bot.callbackQuery("support", async (ctx) => {
     return;
   }
 
-  awaitingSupportMessage.add(tgId);
+  await conversations.set(supportMessageKey(tgId), "1");
   await ctx.reply("Напиши одним сообщением, что случилось. Я передам это в поддержку.", {
     reply_markup: mainKeyboard(),
   });
@@ -151,9 +109,6 @@ function fmtUser(ctx: any) {
   return { id, u, name };
 }
 
-// кто из саппорт-чата сейчас "в режиме ответа" и кому отвечаем
-const awaitingSupportReply = new Map<number, number>();
-
 bot.callbackQuery(/^support_reply:(\d+)$/, async (ctx) => {
   await ctx.answerCallbackQuery();
   if (!SUPPORT_CHAT_ID) return;
@@ -165,7 +120,8 @@ bot.callbackQuery(/^support_reply:(\d+)$/, async (ctx) => {
   const targetId = Number(ctx.match?.[1]);
   if (!Number.isFinite(targetId) || targetId <= 0) return;
 
-  awaitingSupportReply.set(adminId, targetId);
+  // кто из саппорт-чата сейчас "в режиме ответа" и кому отвечаем
+  await conversations.set(supportReplyKey(adminId), String(targetId));
 
   await ctx.reply(
     `Ок. Напиши ответ одним сообщением (я отправлю пользователю tg:${targetId}).`,
@@ -179,8 +135,10 @@ bot.on("message", async (ctx) => {
   if (!fromId) return;
 
   // 1) Ответ саппорта в support-чате после нажатия "Ответить"
-  if (SUPPORT_CHAT_ID && chatId === SUPPORT_CHAT_ID && awaitingSupportReply.has(fromId)) {
-    const targetId = awaitingSupportReply.get(fromId)!;
+  const replyTarget =
+    SUPPORT_CHAT_ID && chatId === SUPPORT_CHAT_ID ? await conversations.get(supportReplyKey(fromId)) : null;
+  if (replyTarget) {
+    const targetId = Number(replyTarget);
 
     const txt = ctx.message?.text?.trim();
     if (!txt) {
@@ -188,7 +146,8 @@ bot.on("message", async (ctx) => {
       return;
     }
 
-    awaitingSupportReply.delete(fromId);
+    // another replica may have taken it already
+    if (!(await conversations.take(supportReplyKey(fromId)))) return;
 
     await ctx.api.sendMessage(targetId, `Ответ поддержки:
 
@@ -201,9 +160,7 @@ ${txt}`, {
   }
 
   // 2) Сообщение юзера, которое нужно передать в поддержку (любой тип: текст/фото/док)
-  if (!awaitingSupportMessage.has(fromId)) return;
-
-  awaitingSupportMessage.delete(fromId);
+  if (!(await conversations.take(supportMessageKey(fromId)))) return;
 
   if (!SUPPORT_CHAT_ID) {
     await ctx.reply("Поддержка сейчас не настроена.", { reply_markup: mainKeyboard() });
@@ -235,4 +192,9 @@ ${txt}`, {
   });
 });
 
-bot.start();
+// BOT_WEBHOOK_URL: Telegram pushes updates to us; otherwise concurrent long polling
+const webhookUrl = process.env.BOT_WEBHOOK_URL;
+(webhookUrl ? runWebhook(bot, webhookUrl) : runPolling(bot)).catch((e) => {
+  console.error(e);
+  process.exit(1);
+});
@@ -0,0 +1,147 @@
+import http from "node:http";
+import { BotError, webhookCallback, type Bot, type Context, type NextFunction } from "grammy";
+
+// Update processing for the bot.
+// bot.start() handles one update at a time, so a slow provision holds up every
+// other user. Both modes here process updates concurrently (up to
+// BOT_CONCURRENCY at once) while updates of the same chat still run in arrival
+// order through the sequentialize() middleware.
+//
+// - polling (default): getUpdates loop that dispatches updates without waiting
+//   for them; fetching pauses while BOT_CONCURRENCY updates are in flight.
+// - webhook (BOT_WEBHOOK_URL set): Telegram pushes updates to an HTTP server
+//   and opens up to BOT_WEBHOOK_MAX_CONNECTIONS parallel requests.
+
+function numEnv(name: string, fallback: number): number {
+  const n = Number(process.env[name]);
+  return Number.isFinite(n) && n >= 0 ? n : fallback;
+}
+
+const CONCURRENCY = Math.max(1, numEnv("BOT_CONCURRENCY", 64));
+
+// chat id (or user id for updates without a chat) -> tail of its update chain
+const chains = new Map<string, Promise<void>>();
+
+function orderKey(ctx: Context): string | null {
+  const chatId = ctx.chat?.id ?? ctx.from?.id;
+  return chatId === undefined ? null : String(chatId);
+}
+
+// handler errors reach bot.catch in both modes (webhookCallback would rethrow them,
+// after an onTimeout "return" as an unhandled rejection)
+export function catchErrors(bot: Bot) {
+  return async (ctx: Context, next: NextFunction) => {
+    try {
+      await next();
+    } catch (err) {
+      await bot.errorHandler(new BotError(err, ctx));
+    }
+  };
+}
+
+/** Updates of the same chat run one after another; different chats run in parallel. */
+export function sequentialize() {
+  return async (ctx: Context, next: NextFunction) => {
+    const key = orderKey(ctx);
+    if (key === null) return next();
+
+    const previous = chains.get(key) ?? Promise.resolve();
+    let release!: () => void;
+    const done = new Promise<void>((resolve) => (release = resolve));
+    const tail = previous.then(() => done);
+    chains.set(key, tail);
+
+    await previous;
+    try {
+      await next();
+    } finally {
+      release();
+      if (chains.get(key) === tail) chains.delete(key);
+    }
+  };
+}
+
+export async function runPolling(bot: Bot) {
+  await bot.init();
+  // a webhook left over from webhook mode blocks getUpdates
+  await bot.api.deleteWebhook();
+
+  const inFlight = new Set<Promise<void>>();
+  const abort = new AbortController();
+  let offset = 0;
+  let stopping = false;
+
+  const stop = () => {
+    stopping = true;
+    abort.abort();
+  };
+  process.once("SIGINT", stop);
+  process.once("SIGTERM", stop);
+
+  console.log(`bot @${bot.botInfo.username}: polling, concurrency ${CONCURRENCY}`);
+
+  while (!stopping) {
+    while (inFlight.size >= CONCURRENCY) await Promise.race(inFlight);
+
+    let updates;
+    try {
+      updates = await bot.api.getUpdates({ offset, limit: 100, timeout: 30 }, abort.signal);
+    } catch (err) {
+      if (stopping) break;
+      console.error("BOT_POLL_ERROR", err);
+      await new Promise((r) => setTimeout(r, 3_000));
+      continue;
+    }
+
+    for (const update of updates) {
+      offset = update.update_id + 1;
+      // handler errors are already in bot.catch (catchErrors); the loop never waits for a single update
+      const task: Promise<void> = bot
+        .handleUpdate(update)
+        .catch(() => {})
+        .finally(() => inFlight.delete(task));
+      inFlight.add(task);
+    }
+  }
+
+  await Promise.allSettled(inFlight);
+  // confirm what was handled, otherwise Telegram redelivers it after a restart
+  if (offset > 0) await bot.api.getUpdates({ offset, limit: 1, timeout: 0 }).catch(() => {});
+}
+
+export async function runWebhook(bot: Bot, url: string) {
+  const port = numEnv("BOT_WEBHOOK_PORT", 8080);
+  const path = new URL(url).pathname || "/";
+  const secretToken = process.env.BOT_WEBHOOK_SECRET || undefined;
+
+  // answer Telegram before its timeout and keep working: a slow provision must not cause redelivery
+  const handle = webhookCallback(bot, "http", {
+    secretToken,
+    onTimeout: "return",
+    timeoutMilliseconds: 9_000,
+  });
+
+  const server = http.createServer((req, res) => {
+    if (req.method !== "POST" || req.url?.split("?")[0] !== path) {
+      res.writeHead(404).end();
+      return;
+    }
+    handle(req, res).catch((err: unknown) => {
+      console.error("BOT_WEBHOOK_ERROR", err);
+      if (!res.headersSent) res.writeHead(500).end();
+    });
+  });
+
+  await bot.init();
+  await new Promise<void>((resolve) => server.listen(port, "0.0.0.0", resolve));
+  await bot.api.setWebhook(url, {
+    secret_token: secretToken,
+    max_connections: Math.max(1, Math.min(100, numEnv("BOT_WEBHOOK_MAX_CONNECTIONS", 40))),
+  });
+
+  console.log(`bot @${bot.botInfo.username}: webhook ${path} on :${port}`);
+
+  const stop = () => server.close();
+  process.once("SIGINT", stop);
+  process.once("SIGTERM", stop);
+}
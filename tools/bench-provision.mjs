@@ -0,0 +1,95 @@
+#!/usr/bin/env node
+
+// Repeat-provision benchmark: one device, provisioned once, then hammered with
+// POST /v1/devices/:id/provision (the "Get VPN" tap for an already-active device).
+//
+//   API_BASE=http://localhost:3001 BENCH_REQUESTS=2000 BENCH_CONCURRENCY=20 node tools/bench-provision.mjs
+//
+// Run it before/after a change against the same DB to compare p50/p99.
+
+const API_BASE = process.env.API_BASE ?? "http://localhost:3001";
+const REQUESTS = Number.parseInt(process.env.BENCH_REQUESTS ?? "2000", 10);
+const CONCURRENCY = Number.parseInt(process.env.BENCH_CONCURRENCY ?? "20", 10);
+const WARMUP = Number.parseInt(process.env.BENCH_WARMUP ?? "50", 10);
+const USER_ID = process.env.BENCH_USER_ID ?? `tg:bench:${Date.now()}`;
+
+function fail(message) {
+  console.error(`FAIL bench-provision: ${message}`);
+  process.exit(1);
+}
+
+async function post(path, body) {
+  const res = await fetch(`${API_BASE}${path}`, {
+    method: "POST",
+    headers: { "content-type": "application/json" },
+    body: JSON.stringify(body ?? {}),
+  });
+  const text = await res.text();
+  let json = null;
+  try {
+    json = text ? JSON.parse(text) : null;
+  } catch {
+    // keep raw text for diagnostics
+  }
+  return { status: res.status, json, text };
+}
+
+function percentile(sorted, p) {
+  if (sorted.length === 0) return 0;
+  const i = Math.min(sorted.length - 1, Math.ceil((p / 100) * sorted.length) - 1);
+  return sorted[Math.max(0, i)];
+}
+
+async function runRequests(total, concurrency, fn) {
+  const latencies = [];
+  let errors = 0;
+  let next = 0;
+
+  const workers = Array.from({ length: Math.min(concurrency, total) }, async () => {
+    while (next < total) {
+      next++;
+      const t0 = performance.now();
+      const ok = await fn().catch(() => false);
+      latencies.push(performance.now() - t0);
+      if (!ok) errors++;
+    }
+  });
+
+  const startedAt = performance.now();
+  await Promise.all(workers);
+  return { latencies, errors, elapsedMs: performance.now() - startedAt };
+}
+
+async function main() {
+  const created = await post("/v1/devices", { userId: USER_ID, platform: "IOS", name: "bench" });
+  if (created.status !== 200 && created.status !== 201) fail(`create device: ${created.status} ${created.text}`);
+  const deviceId = created.json.id;
+
+  const first = await post(`/v1/devices/${deviceId}/provision`, {});
+  if (first.status !== 200 && first.status !== 201) fail(`first provision: ${first.status} ${first.text}`);
+
+  const provisionOnce = async () => {
+    const r = await post(`/v1/devices/${deviceId}/provision`, {});
+    return r.status === 200 && r.json?.existing === true;
+  };
+
+  await runRequests(WARMUP, CONCURRENCY, provisionOnce);
+  const { latencies, errors, elapsedMs } = await runRequests(REQUESTS, CONCURRENCY, provisionOnce);
+
+  const sorted = [...latencies].sort((a, b) => a - b);
+  const mean = sorted.reduce((s, x) => s + x, 0) / Math.max(1, sorted.length);
+  const fmt = (x) => `${x.toFixed(2)}ms`;
+
+  console.log(`repeat provision: ${REQUESTS} requests, concurrency ${CONCURRENCY}, device ${deviceId}`);
+  console.log(`throughput: ${(REQUESTS / (elapsedMs / 1000)).toFixed(1)} req/s`);
+  console.log(
+    `latency: p50=${fmt(percentile(sorted, 50))} p95=${fmt(percentile(sorted, 95))} ` +
+      `p99=${fmt(percentile(sorted, 99))} mean=${fmt(mean)} max=${fmt(sorted[sorted.length - 1] ?? 0)}`
+  );
+  console.log(`errors: ${errors}`);
+
+  await post(`/v1/devices/${deviceId}/revoke`, {});
+  if (errors > 0) process.exitCode = 1;
+}
+
+main().catch((e) => fail(e?.stack ?? String(e)));
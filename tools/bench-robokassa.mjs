@@ -0,0 +1,159 @@
+#!/usr/bin/env node
+
+// Robokassa ResultURL burst benchmark: creates BENCH_PAYMENTS invoices, then fires
+// their signed result callbacks at the API, each one BENCH_DUPLICATES times in
+// parallel (Robokassa retries), and reports accepted callbacks/sec. With the
+// inbox (ROBOKASSA_INBOX=1, default) it also waits for the worker to drain and
+// reports processed payments/sec (needs API_DEBUG_STATS=1 for the counters).
+//
+//   API_BASE=http://localhost:3001 ROBOKASSA_PASSWORD2=... BENCH_PAYMENTS=500 \
+//     BENCH_CONCURRENCY=50 BENCH_DUPLICATES=2 node tools/bench-robokassa.mjs
+//
+// ROBOKASSA_PASSWORD2 / ROBOKASSA_HASH must match the API's; each run pays real
+// rows in the target DB (user tg:bench-pay:<ts>), so point it at a dev database.
+
+import { createHash } from "node:crypto";
+
+const API_BASE = process.env.API_BASE ?? "http://localhost:3001";
+const PAYMENTS = Number.parseInt(process.env.BENCH_PAYMENTS ?? "500", 10);
+const CONCURRENCY = Number.parseInt(process.env.BENCH_CONCURRENCY ?? "50", 10);
+const DUPLICATES = Math.max(1, Number.parseInt(process.env.BENCH_DUPLICATES ?? "2", 10));
+const PLAN_CODE = process.env.BENCH_PLAN ?? "basic";
+const PASSWORD2 = process.env.ROBOKASSA_PASSWORD2;
+const HASH = (process.env.ROBOKASSA_HASH ?? "MD5").toUpperCase() === "SHA256" ? "sha256" : "md5";
+const DRAIN_TIMEOUT_MS = Number.parseInt(process.env.BENCH_DRAIN_TIMEOUT_MS ?? "120000", 10);
+const USER_ID = process.env.BENCH_USER_ID ?? `tg:bench-pay:${Date.now()}`;
+
+function fail(message) {
+  console.error(`FAIL bench-robokassa: ${message}`);
+  process.exit(1);
+}
+
+async function request(method, path, { json, form } = {}) {
+  const res = await fetch(`${API_BASE}${path}`, {
+    method,
+    headers: json
+      ? { "content-type": "application/json" }
+      : form
+        ? { "content-type": "application/x-www-form-urlencoded" }
+        : {},
+    body: json ? JSON.stringify(json) : form ? form.toString() : undefined,
+  });
+  const text = await res.text();
+  let body = null;
+  try {
+    body = text ? JSON.parse(text) : null;
+  } catch {
+    // plain text (OK<invId>, "bad sign", ...)
+  }
+  return { status: res.status, body, text };
+}
+
+function percentile(sorted, p) {
+  if (sorted.length === 0) return 0;
+  const i = Math.min(sorted.length - 1, Math.ceil((p / 100) * sorted.length) - 1);
+  return sorted[Math.max(0, i)];
+}
+
+async function runPool(items, concurrency, fn) {
+  const latencies = [];
+  let errors = 0;
+  let next = 0;
+
+  const workers = Array.from({ length: Math.min(concurrency, items.length) }, async () => {
+    while (next < items.length) {
+      const item = items[next++];
+      const t0 = performance.now();
+      const ok = await fn(item).catch(() => false);
+      latencies.push(performance.now() - t0);
+      if (!ok) errors++;
+    }
+  });
+
+  const startedAt = performance.now();
+  await Promise.all(workers);
+  return { latencies, errors, elapsedMs: performance.now() - startedAt };
+}
+
+// the same signature the API checks: OutSum:InvId:Password2[:Shp_k=v...] (Shp_ sorted)
+function signedCallback(payUrl) {
+  const q = new URL(payUrl).searchParams;
+  const outSum = q.get("OutSum");
+  const invId = q.get("InvId");
+  const shp = [...q.entries()].filter(([k]) => k.startsWith("Shp_")).sort((a, b) => a[0].localeCompare(b[0]));
+  const base = [outSum, invId, PASSWORD2, ...shp.map(([k, v]) => `${k}=${v}`)].join(":");
+
+  const form = new URLSearchParams({ OutSum: outSum, InvId: invId });
+  for (const [k, v] of shp) form.set(k, v);
+  form.set("SignatureValue", createHash(HASH).update(base, "utf8").digest("hex"));
+  return { invId, form };
+}
+
+async function inboxStats() {
+  const r = await request("GET", "/v1/debug/stats");
+  return r.status === 200 ? r.body?.paymentInbox ?? null : null;
+}
+
+async function main() {
+  if (!PASSWORD2) fail("ROBOKASSA_PASSWORD2 is required (same value as the API)");
+
+  console.log(`creating ${PAYMENTS} invoices (plan ${PLAN_CODE}, user ${USER_ID})...`);
+  const callbacks = [];
+  const created = await runPool(
+    Array.from({ length: PAYMENTS }, (_, i) => i),
+    CONCURRENCY,
+    async () => {
+      const r = await request("POST", "/v1/payments/robokassa/create", {
+        json: { userId: USER_ID, planCode: PLAN_CODE },
+      });
+      if (r.status !== 200 || !r.body?.payUrl) throw new Error(`create: ${r.status} ${r.text}`);
+      callbacks.push(signedCallback(r.body.payUrl));
+      return true;
+    }
+  );
+  if (created.errors > 0) fail(`${created.errors} invoices could not be created`);
+
+  const before = await inboxStats();
+
+  // every callback DUPLICATES times, duplicates interleaved the way provider retries arrive
+  const deliveries = [];
+  for (let d = 0; d < DUPLICATES; d++) deliveries.push(...callbacks);
+
+  const { latencies, errors, elapsedMs } = await runPool(deliveries, CONCURRENCY, async (cb) => {
+    const r = await request("POST", "/v1/payments/robokassa/result", { form: cb.form });
+    return r.status === 200 && r.text === `OK${cb.invId}`;
+  });
+
+  const sorted = [...latencies].sort((a, b) => a - b);
+  const fmt = (x) => `${x.toFixed(2)}ms`;
+  console.log(`callbacks: ${deliveries.length} (${PAYMENTS} invoices x ${DUPLICATES}), concurrency ${CONCURRENCY}`);
+  console.log(`accepted: ${(deliveries.length / (elapsedMs / 1000)).toFixed(1)} callbacks/s`);
+  console.log(
+    `latency: p50=${fmt(percentile(sorted, 50))} p95=${fmt(percentile(sorted, 95))} ` +
+      `p99=${fmt(percentile(sorted, 99))} max=${fmt(sorted[sorted.length - 1] ?? 0)}`
+  );
+  console.log(`errors: ${errors}`);
+
+  // inbox mode: wait until the worker has applied every invoice
+  if (before) {
+    const startedAt = performance.now();
+    let after = before;
+    while (performance.now() - startedAt < DRAIN_TIMEOUT_MS) {
+      after = await inboxStats();
+      if (after && after.paid - before.paid >= PAYMENTS) break;
+      await new Promise((r) => setTimeout(r, 200));
+    }
+    const paid = (after?.paid ?? 0) - before.paid;
+    const drainMs = elapsedMs + (performance.now() - startedAt);
+    console.log(`processed: ${paid}/${PAYMENTS} payments, ${(paid / (drainMs / 1000)).toFixed(1)} payments/s end to end`);
+    if (paid < PAYMENTS) {
+      console.log("not all payments were applied by this instance's worker (other replicas, or timeout)");
+    }
+  } else {
+    console.log("no /v1/debug/stats (API_DEBUG_STATS=1): skipping inbox drain measurement");
+  }
+
+  if (errors > 0) process.exitCode = 1;
+}
+
+main().catch((e) => fail(e?.stack ?? String(e)));
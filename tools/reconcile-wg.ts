@@ -1,13 +1,19 @@
 #!/usr/bin/env node
 /**
- * WireGuard reconciliation: DB -> Node
+ * WireGuard reconciliation: DB -> Nodes
  * Default: dry-run; apply: --apply (needs CONFIRM=YES)
+ *
+ * Every enabled node in the Node table is reconciled concurrently
+ * (--concurrency, default 4); each node's plan is applied as batched `wg set` calls.
  */
-import { execFileSync } from "node:child_process";
+import { execFile } from "node:child_process";
 import process from "node:process";
+import { promisify } from "node:util";
 import { PrismaClient } from "@prisma/client";
 
-type DesiredPeer = { nodeId: string; publicKey: string; allowedIp: string };
+const execFileAsync = promisify(execFile);
+
+type NodeRow = { id: string; sshHost: string; sshUser: string; wgInterface: string };
 type ActualPeer = { publicKey: string; allowedIps: string[] };
 
 type PlanAction =
@@ -15,17 +21,31 @@ type PlanAction =
   | { kind: "update"; publicKey: string; allowedIpCidr: string }
   | { kind: "remove"; publicKey: string };
 
+type NodeReport = {
+  nodeId: string;
+  desired: number;
+  actual: number;
+  add: number;
+  update: number;
+  remove: number;
+  applied: boolean;
+  ms: number;
+  error?: string;
+};
+
 const argv = process.argv.slice(2);
 const APPLY = argv.includes("--apply");
 const VERBOSE = argv.includes("--verbose");
-const NODE_ID_FILTER = (() => {
-  const i = argv.indexOf("--node-id");
+function argValue(name: string): string | undefined {
+  const i = argv.indexOf(name);
   return i === -1 ? undefined : argv[i + 1];
-})();
+}
+const NODE_ID_FILTER = argValue("--node-id");
+const CONCURRENCY = Math.max(1, Number(argValue("--concurrency") ?? 4) || 4);
+const PAGE_SIZE = Math.max(1, Number(argValue("--page-size") ?? 1000) || 1000);
+// peer clauses per `wg set` call; keeps the remote command line well under ARG_MAX
+const CLAUSES_PER_CALL = 200;
 
-const WG_INTERFACE = process.env.WG_INTERFACE || "wg0";
-const SSH_HOST = process.env.WG_NODE_SSH_HOST || "wg-node-1";
-const SSH_USER = process.env.WG_NODE_SSH_USER || "root";
 const SSH_PORT = process.env.WG_NODE_SSH_PORT || "22";
 const SSH_IDENTITY = process.env.WG_NODE_SSH_IDENTITY;
 function parseSshOpts(raw: string | undefined): string[] {
@@ -51,34 +71,29 @@ function pickPrimaryAllowedIp(allowedIps: string[]): string | undefined {
   return a32 || allowedIps[0];
 }
 
-function sshArgs(): string[] {
-  const args: string[] = [
-    "-p", SSH_PORT,
-    "-o", "StrictHostKeyChecking=no",
-    "-o", "UserKnownHostsFile=/dev/null",
-  ];
-  if (SSH_IDENTITY) args.push("-i", SSH_IDENTITY);
-  return args;
-}
-
 function isLikelyWgPublicKey(k: string): boolean {
   // wg pubkey is base64, typically 44 chars with '=' padding, but be tolerant
   return /^[A-Za-z0-9+/]{42,}={0,2}$/.test(k) && !k.includes("REPLACE_WITH");
 }
-function sshExec(command: string): string {
+async function sshExec(node: NodeRow, command: string): Promise<string> {
   const optArgs = parseSshOpts(process.env.WG_NODE_SSH_OPTS);
   const args = [
     "-p", String(SSH_PORT),
     ...optArgs,
     ...(SSH_IDENTITY ? ["-i", SSH_IDENTITY] : []),
-    `${SSH_USER}@${SSH_HOST}`,
+    `${node.sshUser}@${node.sshHost}`,
     command,
   ];
-  if (VERBOSE) log(`[ssh] ${SSH_USER}@${SSH_HOST}: ${command}`);
-  return execFileSync("ssh", args, { encoding: "utf8" }).toString();
+  if (VERBOSE) log(`[ssh ${node.id}] ${node.sshUser}@${node.sshHost}: ${command}`);
+  const { stdout } = await execFileAsync("ssh", args, {
+    encoding: "utf8",
+    timeout: 60_000,
+    maxBuffer: 64 * 1024 * 1024,
+  });
+  return String(stdout);
 }
-function wgDump(): string {
-  return sshExec(`${SUDO ? "sudo " : ""}wg show ${WG_INTERFACE} dump`);
+function wgDump(node: NodeRow): Promise<string> {
+  return sshExec(node, `${SUDO ? "sudo " : ""}wg show ${node.wgInterface} dump`);
 }
 function parseWgDump(text: string): ActualPeer[] {
   const lines = text.split("\n").map((l) => l.trim()).filter(Boolean);
@@ -96,23 +111,33 @@ function parseWgDump(text: string): ActualPeer[] {
   return peers;
 }
 
-async function loadDesiredPeers(prisma: PrismaClient): Promise<DesiredPeer[]> {
-  const rows = await prisma.peer.findMany({
-    where: { revokedAt: null, ...(NODE_ID_FILTER ? { nodeId: NODE_ID_FILTER } : {}) } as any,
-    select: { nodeId: true, publicKey: true, allowedIp: true } as any,
-  });
-  const out: DesiredPeer[] = [];
-  for (const r of rows as any[]) {
-    if (!r?.nodeId || !r?.publicKey || !r?.allowedIp) continue;
-    out.push({ nodeId: String(r.nodeId), publicKey: String(r.publicKey), allowedIp: String(r.allowedIp) });
+// Streams the node's active peers page by page (cursor on id) into publicKey -> cidr.
+async function loadDesiredPeers(prisma: PrismaClient, nodeId: string): Promise<Map<string, string>> {
+  const desired = new Map<string, string>();
+  let cursor: string | undefined;
+
+  for (;;) {
+    const rows = await prisma.peer.findMany({
+      where: { nodeId, revokedAt: null },
+      select: { id: true, publicKey: true, allowedIp: true },
+      orderBy: { id: "asc" },
+      take: PAGE_SIZE,
+      ...(cursor ? { cursor: { id: cursor }, skip: 1 } : {}),
+    });
+
+    for (const r of rows) {
+      if (!r.publicKey || !r.allowedIp) continue;
+      desired.set(r.publicKey, normCidr(r.allowedIp));
+    }
+
+    if (rows.length < PAGE_SIZE) break;
+    cursor = rows[rows.length - 1].id;
   }
-  return out;
-}
 
-function buildPlan(desired: DesiredPeer[], actual: ActualPeer[]): PlanAction[] {
-  const desiredByKey = new Map<string, string>();
-  for (const d of desired) desiredByKey.set(d.publicKey, normCidr(d.allowedIp));
+  return desired;
+}
 
+function buildPlan(desiredByKey: Map<string, string>, actual: ActualPeer[]): PlanAction[] {
   const actualByKey = new Map<string, string>();
   for (const a of actual) {
     const primary = pickPrimaryAllowedIp(a.allowedIps);
@@ -139,9 +164,9 @@ function buildPlan(desired: DesiredPeer[], actual: ActualPeer[]): PlanAction[] {
   return plan;
 }
 
-function formatPlan(plan: PlanAction[]): string {
-  if (plan.length === 0) return "PLAN: no changes";
-  const lines: string[] = [`PLAN: ${plan.length} change(s)`];
+function formatPlan(nodeId: string, plan: PlanAction[]): string {
+  if (plan.length === 0) return `[${nodeId}] PLAN: no changes`;
+  const lines: string[] = [`[${nodeId}] PLAN: ${plan.length} change(s)`];
   for (const p of plan) {
     if (p.kind === "remove") lines.push(`- remove ${p.publicKey}`);
     if (p.kind === "add") lines.push(`+ add    ${p.publicKey} -> ${p.allowedIpCidr}`);
@@ -150,39 +175,98 @@ function formatPlan(plan: PlanAction[]): string {
   return lines.join("\n");
 }
 
-function applyPlan(plan: PlanAction[]) {
-  for (const p of plan) {
-    if (p.kind === "remove") sshExec(`${SUDO ? "sudo " : ""}wg set ${WG_INTERFACE} peer ${p.publicKey} remove`);
-    else sshExec(`${SUDO ? "sudo " : ""}wg set ${WG_INTERFACE} peer ${p.publicKey} allowed-ips ${p.allowedIpCidr}`);
+// One `wg set` per CLAUSES_PER_CALL actions instead of one ssh round trip per action.
+async function applyPlan(node: NodeRow, plan: PlanAction[]) {
+  for (let i = 0; i < plan.length; i += CLAUSES_PER_CALL) {
+    const clauses = plan.slice(i, i + CLAUSES_PER_CALL).map((p) =>
+      p.kind === "remove"
+        ? `peer ${p.publicKey} remove`
+        : `peer ${p.publicKey} allowed-ips ${p.allowedIpCidr}`
+    );
+    await sshExec(node, `${SUDO ? "sudo " : ""}wg set ${node.wgInterface} ${clauses.join(" ")}`);
   }
 }
 
+async function reconcileNode(prisma: PrismaClient, node: NodeRow): Promise<NodeReport> {
+  const startedAt = Date.now();
+  const report: NodeReport = {
+    nodeId: node.id, desired: 0, actual: 0, add: 0, update: 0, remove: 0, applied: false, ms: 0,
+  };
+
+  try {
+    const [desired, dump] = await Promise.all([loadDesiredPeers(prisma, node.id), wgDump(node)]);
+    const actual = parseWgDump(dump);
+    report.desired = desired.size;
+    report.actual = actual.length;
+    if (desired.size === 0) {
+      warn(`[${node.id}] WARN: DB desired peers is empty (state=ACTIVE). With --apply this would remove all peers from node.`);
+    }
+
+    const plan = buildPlan(desired, actual);
+    for (const p of plan) report[p.kind]++;
+    log(formatPlan(node.id, plan));
+
+    if (APPLY && plan.length > 0) {
+      for (const a of plan) {
+        if (!isLikelyWgPublicKey(a.publicKey)) throw new Error(`Invalid publicKey in plan: ${a.publicKey}`);
+      }
+      await applyPlan(node, plan);
+      report.applied = true;
+    }
+  } catch (e: any) {
+    report.error = String(e?.stderr || e?.message || e).trim();
+  }
+
+  report.ms = Date.now() - startedAt;
+  return report;
+}
+
+// Bounded worker pool: at most `limit` nodes in flight.
+async function runPool<T, R>(items: T[], limit: number, fn: (item: T) => Promise<R>): Promise<R[]> {
+  const results: R[] = new Array(items.length);
+  let next = 0;
+  const workers = Array.from({ length: Math.min(limit, items.length) }, async () => {
+    while (next < items.length) {
+      const i = next++;
+      results[i] = await fn(items[i]);
+    }
+  });
+  await Promise.all(workers);
+  return results;
+}
+
 async function main() {
   if (!process.env.DATABASE_URL) fatal("DATABASE_URL is not set");
-
-  log(`WG reconcile (host=${SSH_HOST}, iface=${WG_INTERFACE})`);
-  log(`Mode: ${APPLY ? "APPLY" : "DRY-RUN"}${NODE_ID_FILTER ? ` (nodeId=${NODE_ID_FILTER})` : ""}`);
+  if (APPLY && process.env.CONFIRM !== "YES") fatal("Refusing to apply without CONFIRM=YES");
 
   const prisma = new PrismaClient();
   try {
-    const desired = await loadDesiredPeers(prisma);
-    if (desired.length === 0) warn("WARN: DB desired peers is empty (state=ACTIVE). With --apply this would remove all peers from node.");
+    const nodes = await prisma.node.findMany({
+      where: NODE_ID_FILTER ? { id: NODE_ID_FILTER } : { enabled: true },
+      select: { id: true, sshHost: true, sshUser: true, wgInterface: true },
+      orderBy: { id: "asc" },
+    });
+    if (nodes.length === 0) fatal(`No nodes to reconcile${NODE_ID_FILTER ? ` (nodeId=${NODE_ID_FILTER})` : ""}`);
 
-    const actual = parseWgDump(wgDump());
-    if (VERBOSE) { log(`DB desired: ${desired.length}`); log(`WG actual: ${actual.length}`); }
+    log(`WG reconcile (${nodes.length} node(s), concurrency=${CONCURRENCY})`);
+    log(`Mode: ${APPLY ? "APPLY" : "DRY-RUN"}${NODE_ID_FILTER ? ` (nodeId=${NODE_ID_FILTER})` : ""}`);
 
-    const plan = buildPlan(desired, actual);
-    log(formatPlan(plan));
-
-    if (!APPLY) { log("OK: dry-run complete (use --apply to execute)"); return; }
-    if (process.env.CONFIRM !== "YES") fatal("Refusing to apply without CONFIRM=YES");
-    if (plan.length === 0) { log("OK: nothing to apply"); return; }
+    const startedAt = Date.now();
+    const reports = await runPool(nodes, CONCURRENCY, (node) => reconcileNode(prisma, node));
 
-    for (const a of plan) {
-      if (!isLikelyWgPublicKey(a.publicKey)) fatal(`Invalid publicKey in plan: ${a.publicKey}`);
+    log("");
+    log("node\tdesired\tactual\tadd\tupdate\tremove\tapplied\tms\terror");
+    for (const r of reports) {
+      log([r.nodeId, r.desired, r.actual, r.add, r.update, r.remove, r.applied ? "yes" : "no", r.ms, r.error ?? ""].join("\t"));
     }
-    applyPlan(plan);
-    log("OK: apply complete");
+
+    const failed = reports.filter((r) => r.error);
+    const drift = reports.reduce((sum, r) => sum + r.add + r.update + r.remove, 0);
+    log(`TOTAL: ${reports.length} node(s), drift=${drift}, failed=${failed.length}, ${Date.now() - startedAt}ms`);
+
+    if (failed.length > 0) process.exitCode = 1;
+    else if (!APPLY) log("OK: dry-run complete (use --apply to execute)");
+    else log("OK: apply complete");
   } finally {
     await prisma.$disconnect().catch(() => {});
   }
@@ -0,0 +1,144 @@
+import { PrismaClient } from "@prisma/client";
+
+// Node registry admin: list nodes with load, add/update a node, drain/enable/disable it.
+
+function usage(): never {
+  console.error(
+    [
+      "Usage:",
+      "  tsx tools/wg-nodes.ts list [--json]",
+      "  tsx tools/wg-nodes.ts upsert --id <id> --sshHost <host> --sshUser <user> --endpointHost <host>",
+      "                              --serverPublicKey <key> [--name <name>] [--wgInterface wg0] [--wgPort 51820]",
+      "                              [--poolStart 10.9.0.2 --poolEnd 10.9.255.254] [--capacity <n>]",
+      "  tsx tools/wg-nodes.ts drain|undrain|enable|disable --id <id>",
+      "",
+      "Example:",
+      "  tsx tools/wg-nodes.ts upsert --id wg-node-2 --sshHost 10.0.0.12 --sshUser yc-user \\",
+      "    --endpointHost vpn2.example.com --serverPublicKey <base64> --poolStart 10.9.0.2 --poolEnd 10.9.255.254",
+      "  tsx tools/wg-nodes.ts drain --id wg-node-1",
+    ].join("\n")
+  );
+  process.exit(1);
+}
+
+function parseFlags(argv: string[]): Record<string, string | true> {
+  const out: Record<string, string | true> = {};
+  for (let i = 0; i < argv.length; i++) {
+    const key = argv[i];
+    if (!key.startsWith("--")) continue;
+
+    const value = argv[i + 1];
+    if (!value || value.startsWith("--")) {
+      out[key.slice(2)] = true;
+      continue;
+    }
+    out[key.slice(2)] = value;
+    i++;
+  }
+  return out;
+}
+
+function str(flags: Record<string, string | true>, name: string): string | undefined {
+  const v = flags[name];
+  return typeof v === "string" ? v : undefined;
+}
+
+function int(flags: Record<string, string | true>, name: string): number | undefined {
+  const v = str(flags, name);
+  if (v === undefined) return undefined;
+  const n = Number(v);
+  if (!Number.isInteger(n) || n <= 0) throw new Error(`--${name} must be a positive integer`);
+  return n;
+}
+
+async function list(prisma: PrismaClient, asJson: boolean) {
+  const nodes = await prisma.node.findMany({ orderBy: { id: "asc" } });
+  const counts = await prisma.peer.groupBy({
+    by: ["nodeId"],
+    where: { revokedAt: null },
+    _count: { _all: true },
+  });
+  const activeByNode = new Map(counts.map((c) => [c.nodeId, c._count._all]));
+
+  const rows = nodes.map((n) => ({
+    id: n.id,
+    state: !n.enabled ? "disabled" : n.draining ? "draining" : "active",
+    sshHost: n.sshHost,
+    endpoint: `${n.endpointHost}:${n.wgPort}`,
+    pool: `${n.poolStart ?? "(env)"}..${n.poolEnd ?? "(env)"}`,
+    capacity: n.capacity,
+    activePeers: activeByNode.get(n.id) ?? 0,
+  }));
+
+  if (asJson) console.log(JSON.stringify(rows, null, 2));
+  else console.table(rows);
+}
+
+async function upsert(prisma: PrismaClient, flags: Record<string, string | true>) {
+  const id = str(flags, "id");
+  const sshHost = str(flags, "sshHost");
+  const sshUser = str(flags, "sshUser");
+  const endpointHost = str(flags, "endpointHost");
+  const serverPublicKey = str(flags, "serverPublicKey");
+  if (!id || !sshHost || !sshUser || !endpointHost || !serverPublicKey) usage();
+
+  const poolStart = str(flags, "poolStart");
+  const poolEnd = str(flags, "poolEnd");
+  if (Boolean(poolStart) !== Boolean(poolEnd)) throw new Error("--poolStart and --poolEnd go together");
+
+  const data = {
+    name: str(flags, "name") ?? id,
+    sshHost,
+    sshUser,
+    endpointHost,
+    serverPublicKey,
+    wgInterface: str(flags, "wgInterface") ?? "wg0",
+    wgPort: int(flags, "wgPort") ?? 51820,
+    poolStart: poolStart ?? null,
+    poolEnd: poolEnd ?? null,
+    capacity: int(flags, "capacity") ?? null,
+  };
+
+  const node = await prisma.node.upsert({
+    where: { id },
+    update: data,
+    create: { id, ...data },
+  });
+  console.log(`node ${node.id} saved`);
+}
+
+async function setState(prisma: PrismaClient, action: string, id: string | undefined) {
+  if (!id) usage();
+  const data =
+    action === "drain"
+      ? { draining: true }
+      : action === "undrain"
+        ? { draining: false }
+        : action === "enable"
+          ? { enabled: true }
+          : { enabled: false };
+
+  await prisma.node.update({ where: { id }, data });
+  console.log(`node ${id}: ${action} ok`);
+}
+
+async function main() {
+  const [action, ...rest] = process.argv.slice(2);
+  const flags = parseFlags(rest);
+  const prisma = new PrismaClient();
+
+  try {
+    if (action === "list") await list(prisma, flags.json === true);
+    else if (action === "upsert") await upsert(prisma, flags);
+    else if (["drain", "undrain", "enable", "disable"].includes(action ?? "")) {
+      await setState(prisma, action, str(flags, "id"));
+    } else usage();
+  } finally {
+    await prisma.$disconnect();
+  }
+}
+
+main().catch((error) => {
+  console.error(error);
+  process.exit(1);
+});